@@ -0,0 +1,93 @@
+# auth_cookie.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure the Cookie header that browsers send on every request, with JWTs and with session tokens.
+
+Usage: python bin/benchmarks/auth_cookie.py
+
+"jwt" is the portal5auth cookie as it used to be written, one JWT per grant
+(with uuid4 identifiers); "session" is the cookie written now. The other
+portal5 cookies are included in the header size.
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from portal5.utils.jwtkit import JWTKit  # noqa: E402
+
+ORIGIN = 'https://portal5.example'
+CLIENT = '203.0.113.7'
+VERSION = '1e0c4a'
+
+kit = JWTKit()
+kit.key = 'benchmark-secret-key'
+kit._iss = kit._aud = ORIGIN
+kit._claims.update(iss=ORIGIN, aud=ORIGIN)
+
+OTHER_COOKIES = {
+    'portal5prefs': '31',
+    'portal5prefs2': base64.b64encode(json.dumps({'lang': 'en'}).encode()).decode(),
+}
+
+
+def grant(privilege, expires=180, **claims):
+    claims = {'version': VERSION, 'variant': 31, 'privilege': privilege, **claims}
+    return kit.make_claims(sub=CLIENT, exp=timedelta(seconds=expires), **claims)
+
+
+def scenarios():
+    init = grant('init')
+    nochange = grant('nochange', expires=43200)
+    update = grant('update', session=nochange['jti'], variant=55, signals={})
+    return (
+        ('after init', [init]),
+        ('after settings', [nochange]),
+        ('after saving', [update, nochange]),
+    )
+
+
+def legacy(payloads):
+    return ' '.join([kit.encode_token({**p, 'jti': str(uuid.uuid4())}) for p in payloads])
+
+
+def cookie_header(auth):
+    return '; '.join([f'{k}={v}' for k, v in {**OTHER_COOKIES, 'portal5auth': auth}.items()])
+
+
+def main():
+    print(f'{"cookie":<16}{"jwt bytes":>11}{"session bytes":>15}{"header jwt":>12}{"header session":>16}')
+    for name, payloads in scenarios():
+        old, new = legacy(payloads), kit.encode_tokens(payloads)
+        print(f'{name:<16}{len(old):>11}{len(new):>15}{len(cookie_header(old)):>12}{len(cookie_header(new)):>16}')
+
+    payloads = scenarios()[-1][1]
+    value = kit.encode_tokens(payloads)
+    n = 20000
+    start = time.perf_counter()
+    for _ in range(n):
+        kit._verified.clear()
+        kit.decode_tokens(value)
+    print(f'verifying a two-grant session token: {(time.perf_counter() - start) / n * 1e6:.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# blocklist_files.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure load time, memory and lookups of a large blocklist file.
+
+Usage: python bin/benchmarks/blocklist_files.py [entries]
+
+Each strategy runs in a fresh process, like a worker would:
+"rules" reads the file into in-memory `domain` rules; "compile" builds the
+index of a BlocklistFile from the file; "mmap" loads the index that "compile"
+left behind, which is what every other worker does. RSS is the growth of the
+process while loading, split into private (anon) and shared (file) pages.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from portal5.utils import fetch  # noqa: E402
+from portal5.utils.blacklist import BlocklistFile, RequestFilter, RequestRule  # noqa: E402
+
+LOOKUPS = 20000
+
+
+def rss():
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in {'RssAnon', 'RssFile'}:
+                values[key] = int(value.split()[0]) / 1024
+    return values
+
+
+def load(strategy, path):
+    if strategy == 'rules':
+        with open(path) as f:
+            return RequestFilter(*(RequestRule('domain', line.strip()) for line in f))
+    return RequestFilter(BlocklistFile(path))
+
+
+def run(strategy, path, entries):
+    requests = [
+        fetch.prepare_request(f'https://{"cdn.tracker" if i % 2 else "www.site"}{i * 7919 % entries}.example/a.js')
+        for i in range(LOOKUPS)
+    ]
+    before = rss()
+    start = time.perf_counter()
+    filters = load(strategy, path)
+    filters.compile()
+    loaded = time.perf_counter() - start
+    after = rss()
+
+    start = time.perf_counter()
+    blocked = sum(filters.match(r) is not None for r in requests)
+    lookup = (time.perf_counter() - start) / LOOKUPS * 1e6
+
+    anon = after.get('RssAnon', 0) - before.get('RssAnon', 0)
+    file = after.get('RssFile', 0) - before.get('RssFile', 0)
+    print(f'{strategy:<10}{loaded:>10.2f}{anon:>12.1f}{file:>12.1f}{lookup:>12.2f}{blocked:>10}', flush=True)
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'blocklist.txt')
+        with open(path, 'w') as f:
+            f.writelines(f'tracker{i}.example\n' for i in range(entries))
+
+        print(f'{"strategy":<10}{"load s":>10}{"anon MiB":>12}{"file MiB":>12}{"us/lookup":>12}{"blocked":>10}')
+        for strategy in ('rules', 'compile', 'mmap'):
+            pid = os.fork()
+            if not pid:
+                try:
+                    run(strategy, path, entries)
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    main()
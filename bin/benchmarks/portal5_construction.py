@@ -0,0 +1,112 @@
+# portal5_construction.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure the cost of the per-request Portal5 object, by route class, with eager and lazy parsing.
+
+Usage: python bin/benchmarks/portal5_construction.py [requests]
+
+Each route class constructs a Portal5 object, reads what the route reads, and
+runs the after-request actions on an empty response. "eager" additionally loads
+every field on construction, which is what the constructor used to do.
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+
+from flask import Request, Response
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from portal5 import app  # noqa: E402
+from portal5.portal5 import Portal5  # noqa: E402
+
+Portal5.VERSION = 'bench'
+
+HEADER = json.dumps({
+    'id': '1b4e28ba-2fa1-11d2-883f-0016d3cca427', 'version': 'bench', 'prefs': 31,
+    'mode': 'no-cors', 'referrer': 'https://www.example.org/', 'origin': 'https://www.example.org', 'signals': {},
+})
+COOKIES = '; '.join((
+    'portal5prefs=31',
+    'portal5prefs2=' + base64.b64encode(json.dumps({'lang': 'en'}).encode()).decode(),
+    'portal5auth=' + 'x' * 300,
+))
+
+
+def ping(p5):
+    p5.up_to_date
+
+
+def script(p5):
+    pass
+
+
+def proxied(p5):
+    p5.valid
+    p5.origin_domain
+    p5.mode, p5.referrer
+    p5.get_bitmask()
+
+
+ROUTES = (
+    ('ping', ping, {}),
+    ('script', script, {'Cookie': COOKIES}),
+    ('proxied', proxied, {'Cookie': COOKIES, 'X-Portal5': HEADER}),
+)
+
+
+def eager(p5):
+    for name in (*Portal5.HEADER_FIELDS, *Portal5._loaders):
+        getattr(p5, name)
+
+
+def lazy(p5):
+    pass
+
+
+def run(environ, route, load):
+    p5 = Portal5(Request(environ))
+    load(p5)
+    route(p5)
+    response = Response()
+    for action in p5.after_request:
+        action(p5, response)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f'{"route":<10}{"eager us":>10}{"lazy us":>10}')
+    # Auth cookies are written with the app's token kit
+    app.app_context().push()
+    for name, route, headers in ROUTES:
+        environ = EnvironBuilder(path='/', base_url='https://portal5.example', headers=headers).get_environ()
+        results = {}
+        for strategy, load in (('eager', eager), ('lazy', lazy)):
+            for _ in range(100):
+                run(environ, route, load)
+            start = time.perf_counter()
+            for _ in range(n):
+                run(environ, route, load)
+            results[strategy] = (time.perf_counter() - start) / n * 1e6
+        print(f'{name:<10}{results["eager"]:>10.2f}{results["lazy"]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
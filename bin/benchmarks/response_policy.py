@@ -0,0 +1,155 @@
+# response_policy.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure adding response headers to the routes' responses, before and after response policies.
+
+Usage: python bin/benchmarks/response_policy.py [responses]
+
+"stacked" wraps a view once per decorator, like the decorators did before, with
+every layer wrapping the response and setting its headers; "policy" declares
+the same headers with security.response_policy. For each route, the time per
+response, the Python calls made and the header writes are reported.
+"""
+
+import os
+import sys
+import time
+from functools import wraps
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from flask import Flask, Response, g  # noqa: E402
+from werkzeug.datastructures import Headers  # noqa: E402
+
+from portal5.utils import fetch, security  # noqa: E402
+
+SERVER_MAP = {'origins': {'main': 'https://portal5.example', 'static': 'https://static.portal5.example'}}
+JS = 'application/javascript'
+
+
+def stacked_header(name, value=None):
+    def wrapper(view_func):
+        @wraps(view_func)
+        def postprocess(*args, **kwargs):
+            out = fetch.wrap_response(view_func(*args, **kwargs))
+            out.headers[name] = value or g.server_map['origins']['main']
+            return out
+        return postprocess
+    return wrapper
+
+
+def stacked_csp(view_func):
+    @wraps(view_func)
+    def add_csp(*args, **kwargs):
+        out = fetch.wrap_response(view_func(*args, **kwargs))
+        security.update_csp(out, *security.protected_directives(g.server_map))
+        return out
+    return add_csp
+
+
+def stacked_mimetype(view_func):
+    @wraps(view_func)
+    def add_type(*args, **kwargs):
+        out = fetch.wrap_response(view_func(*args, **kwargs))
+        if out.status_code < 300:
+            out.mimetype = JS
+        return out
+    return add_type
+
+
+cors = stacked_header('Access-Control-Allow-Origin')
+referrer = stacked_header('Referrer-Policy', 'no-referrer')
+clear_all = stacked_header('Clear-Site-Data', '"cache", "cookies", "storage"')
+clear_some = stacked_header('Clear-Site-Data', '"cookies", "storage"')
+
+ROUTES = {
+    '/init': (
+        (cors, stacked_csp, referrer),
+        dict(allow_origin=security.SAME_ORIGIN, csp=security.PROTECTED_CSP, referrer='no-referrer'),
+    ),
+    'OPTIONS /settings': ((cors,), dict(allow_origin=security.SAME_ORIGIN)),
+    '/settings': ((cors, stacked_csp), dict(allow_origin=security.SAME_ORIGIN, csp=security.PROTECTED_CSP)),
+    '/~reset': ((clear_all,), dict(clear_site_data=('cache', 'cookies', 'storage'))),
+    '/~/client/init.js': ((clear_some, stacked_mimetype), dict(clear_site_data=('cookies', 'storage'), mimetype=JS)),
+    '/~/sw.js': ((stacked_mimetype,), dict(mimetype=JS)),
+}
+
+
+def view():
+    return Response('body')
+
+
+def build(decorators):
+    func = view
+    for decorator in reversed(decorators):
+        func = decorator(func)
+    return func
+
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+        self.writes = 0
+
+    def profile(self, frame, event, arg):
+        if event == 'call':
+            self.calls += 1
+
+    def count(self, func):
+        originals = {name: getattr(Headers, name) for name in ('__setitem__', '__delitem__', 'set', 'add', 'extend')}
+
+        def counted(original):
+            def write(*args, **kwargs):
+                self.writes += 1
+                return original(*args, **kwargs)
+            return write
+
+        for name, original in originals.items():
+            setattr(Headers, name, counted(original))
+        sys.setprofile(self.profile)
+        try:
+            func()
+        finally:
+            sys.setprofile(None)
+            for name, original in originals.items():
+                setattr(Headers, name, original)
+        return self.calls, self.writes
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    app = Flask(__name__)
+    print(f'{"route":<20}{"strategy":<10}{"us/response":>13}{"calls":>8}{"writes":>8}')
+    totals = {}
+    with app.test_request_context('/'):
+        g.server_map = SERVER_MAP
+        for route, (decorators, policy) in ROUTES.items():
+            views = {'stacked': build(decorators), 'policy': security.response_policy(**policy)(view)}
+            outputs = {}
+            for name, func in views.items():
+                outputs[name] = sorted(func().headers.items())
+                start = time.perf_counter()
+                for _ in range(n):
+                    func()
+                elapsed = (time.perf_counter() - start) / n * 1e6
+                calls, writes = Counter().count(func)
+                totals[name] = totals.get(name, 0) + elapsed
+                print(f'{route:<20}{name:<10}{elapsed:>13.2f}{calls:>8}{writes:>8}')
+            assert outputs['stacked'] == outputs['policy'], outputs
+    print(f'all routes: {totals["stacked"]:.2f} -> {totals["policy"]:.2f} us')
+
+
+if __name__ == '__main__':
+    main()
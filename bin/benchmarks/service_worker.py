@@ -0,0 +1,91 @@
+# service_worker.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure the work done for one service worker update check, before and after worker caching.
+
+Usage: python bin/benchmarks/service_worker.py [checks]
+
+"render" builds the worker settings and renders the worker template, which is
+what every check used to do; "cached" responds from the render cache and fills
+in the worker id; "304" is a check from a client that already holds the
+current variant. The worker template is read from the bundle sources, so the
+bundle does not need to be built. Token verification happens before either and
+is not measured.
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from flask import Response, g, render_template  # noqa: E402
+from jinja2 import ChoiceLoader, FunctionLoader  # noqa: E402
+
+from portal5 import app  # noqa: E402
+from portal5.app import get_p5  # noqa: E402
+from portal5.bundle import respond_with_worker  # noqa: E402
+from portal5.utils.rendering import render_cache  # noqa: E402
+
+SOURCE = os.path.join(os.path.dirname(__file__), '..', '..', 'portal5', 'bundle', 'src', 'main', 'index.js')
+HEADER = json.dumps({'id': '1b4e28ba-2fa1-11d2-883f-0016d3cca427', 'prefs': 31, 'signals': {}})
+
+
+def load_worker(name):
+    if name == 'public/sw.js':
+        with open(SOURCE) as f:
+            return f.read()
+
+
+def render(p5):
+    settings, rules = p5.make_worker_settings(None, g.server_map['origins']['main'])
+    return Response(render_template('public/sw.js', settings=settings, url_rules=rules), headers={'Service-Worker-Allowed': '/'})
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    app.jinja_env.loader = ChoiceLoader([FunctionLoader(load_worker), app.jinja_env.loader])
+
+    base = f'http://{app.config["SERVER_NAME"]}'
+    with app.test_request_context('/~/sw.js', base_url=base, headers={'X-Portal5': HEADER}):
+        app.try_trigger_before_first_request_functions()
+        app.preprocess_request()
+        etag, _ = respond_with_worker(get_p5()).get_etag()
+    revalidation = {'X-Portal5': HEADER, 'If-None-Match': f'W/"{etag}"'}
+
+    print(f'{"strategy":<10}{"status":>8}{"us/check":>12}')
+    results = {}
+    for name, func, headers in (
+        ('render', render, {'X-Portal5': HEADER}),
+        ('cached', respond_with_worker, {'X-Portal5': HEADER}),
+        ('304', respond_with_worker, revalidation),
+    ):
+        with app.test_request_context('/~/sw.js', base_url=base, headers=headers):
+            app.preprocess_request()
+            p5 = get_p5()
+            status = func(p5).status_code
+            start = time.perf_counter()
+            for _ in range(n):
+                func(p5)
+            results[name] = (time.perf_counter() - start) / n * 1e6
+        print(f'{name:<10}{status:>8}{results[name]:>12.2f}')
+    for name in ('cached', '304'):
+        print(f'{name}: {results["render"] / results[name]:.1f}x faster than render')
+    print(render_cache.get_stats())
+
+
+if __name__ == '__main__':
+    main()
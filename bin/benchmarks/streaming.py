@@ -0,0 +1,111 @@
+# streaming.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Compare the upstream body streaming engine against the old 1 KiB read loop.
+
+Usage: python bin/benchmarks/streaming.py [size in MiB] [rounds]
+
+A local HTTP server in a separate process serves a body of the given size;
+the body is fetched through the upstream client and drained with each
+strategy. Throughput is wall-clock; CPU time is that of this process only.
+"""
+
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import requests  # noqa: E402
+
+from portal5.utils import streaming  # noqa: E402
+from portal5.utils.upstream import UpstreamClient  # noqa: E402
+
+MiB = 1024 * 1024
+
+
+def serve(sock: socket.socket, size):
+    block = os.urandom(MiB)
+    while True:
+        conn, _ = sock.accept()
+        with conn:
+            buf = b''
+            while b'\r\n\r\n' not in buf:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                buf += data
+            if not buf:
+                continue
+            conn.sendall(f'HTTP/1.1 200 OK\r\nContent-Length: {size}\r\nConnection: close\r\n\r\n'.encode())
+            remaining = size
+            while remaining:
+                n = min(remaining, MiB)
+                conn.sendall(block[:n])
+                remaining -= n
+
+
+def legacy_pipe(response):
+    while True:
+        chunk = response.raw.read(1024)
+        if not chunk:
+            break
+        yield chunk
+
+
+def engine_pipe(response):
+    yield from streaming.iter_raw(response.raw)
+
+
+def run(client, url, pipe):
+    response = client.send(requests.Request('GET', url).prepare())
+    wall, cpu = time.perf_counter(), time.process_time()
+    received = chunks = 0
+    for chunk in pipe(response):
+        received += len(chunk)
+        chunks += 1
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    response.close()
+    return received, chunks, wall, cpu
+
+
+def main():
+    size = int(sys.argv[1]) * MiB if len(sys.argv) > 1 else 256 * MiB
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(8)
+    server = multiprocessing.Process(target=serve, args=(sock, size), daemon=True)
+    server.start()
+    url = 'http://%s:%d/' % sock.getsockname()
+
+    client = UpstreamClient()
+    print(f'{"strategy":<10}{"MiB/s":>10}{"CPU s/GiB":>12}{"chunks":>10}')
+    for name, pipe in (('1 KiB', legacy_pipe), ('engine', engine_pipe)):
+        results = [run(client, url, pipe) for _ in range(rounds)]
+        received = sum(r[0] for r in results)
+        chunks = sum(r[1] for r in results) // rounds
+        wall = sum(r[2] for r in results)
+        cpu = sum(r[3] for r in results)
+        print(f'{name:<10}{received / MiB / wall:>10.1f}{cpu / (received / (1024 * MiB)):>12.2f}{chunks:>10}')
+
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# url_filters.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure checking outbound requests against a large domain blocklist.
+
+Usage: python bin/benchmarks/url_filters.py [domains] [requests]
+
+"callables" expresses every blocked domain as a RequestTest, which is how the
+list had to be written before declarative rules, and is called one by one;
+"indexed" expresses them as `domain` rules, looked up in the compiled index.
+A few scheme, path, regex and CIDR rules are added to both. Checks that host
+rules for IP addresses still match alongside CIDR rules.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from portal5.utils import fetch  # noqa: E402
+from portal5.utils.blacklist import RequestFilter, RequestRule, RequestTest  # noqa: E402
+from portal5.utils.urls import split_url  # noqa: E402
+
+EXTRA = [('scheme', 'ftp'), ('path', '/wp-admin/'), ('regex', r'\.exe$'), ('cidr', '10.0.0.0/8')]
+
+
+def domain_test(domain):
+    def test(r):
+        host = split_url(r.url).hostname
+        return host == domain or host.endswith('.' + domain)
+    return RequestTest(test, name=domain)
+
+
+def main():
+    domains = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    blocked = [f'tracker{i}.example' for i in range(domains)]
+    extra = [RequestRule(kind, value) for kind, value in EXTRA]
+
+    filters = {
+        'callables': RequestFilter(*map(domain_test, blocked), *extra),
+        'indexed': RequestFilter(*(RequestRule('domain', d) for d in blocked), *extra),
+    }
+    requests = [
+        fetch.prepare_request(url) for i in range(n) for url in (
+            f'https://www.site{i}.example/path/to/page.html',
+            f'https://cdn.tracker{i * 37 % domains}.example/pixel.gif',
+        )
+    ][:n]
+
+    print(f'{"strategy":<12}{"compile ms":>12}{"us/request":>12}{"blocked":>10}')
+    results = {}
+    for name, f in filters.items():
+        start = time.perf_counter()
+        f.compile()
+        compiled = (time.perf_counter() - start) * 1e3
+        start = time.perf_counter()
+        verdicts = [f.match(r) for r in requests]
+        results[name] = (time.perf_counter() - start) / len(requests) * 1e6
+        blocked_count = sum(v is not None for v in verdicts)
+        print(f'{name:<12}{compiled:>12.1f}{results[name]:>12.2f}{blocked_count:>10}')
+    print(f'speedup: {results["callables"] / results["indexed"]:.0f}x')
+
+    # A host rule for an IP address still applies when there are CIDR rules
+    mixed = RequestFilter(RequestRule('host', '10.1.2.3'), RequestRule('cidr', '192.168.0.0/16'))
+    assert mixed.match(fetch.prepare_request('http://10.1.2.3/')) is not None
+    assert mixed.match(fetch.prepare_request('http://192.168.1.1/')) is not None
+    assert mixed.match(fetch.prepare_request('http://10.1.2.4/')) is None
+
+
+if __name__ == '__main__':
+    main()
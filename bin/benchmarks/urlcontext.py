@@ -0,0 +1,276 @@
+# urlcontext.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure the URL handling done for one proxied request, before and after the per-request URL context.
+
+Usage: python bin/benchmarks/urlcontext.py [requests]
+
+"legacy" runs the steps as they were before the URL context, copied below from
+the previous revision: normalize_url, Portal5.origin_domain (read twice),
+conceal_origin, copy_headers, copy_cookies, enforce_cors, break_csp and
+add_clear_site_data_header, each parsing the URLs it needs. "context" builds one
+URLContext the way parse_url does, conceals the origin from it, completes it with
+the remote URL and runs the current steps on it. Responses carry a Location but
+no CSP, so that the CSP cache is left out. Requests cycle through a small set of
+pages, like subresources of a handful of sites would.
+"""
+
+import os
+import sys
+import time
+from operator import attrgetter
+from urllib.parse import SplitResult, urljoin, urlsplit
+
+import requests
+from flask import Response, abort
+from werkzeug.datastructures import Headers, MultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from portal5.utils import fetch, security  # noqa: E402
+from portal5.utils.urls import URLContext  # noqa: E402
+
+SERVER_HOST = 'portal5.example'
+SERVER_MAP = {
+    'domains': {'main': 'portal5.example', 'static': 'static.portal5.example'},
+    'origins': {'main': 'https://portal5.example', 'static': 'https://static.portal5.example'},
+}
+SERVER_MAP['all_origins'] = frozenset(SERVER_MAP['origins'].values())
+
+PAGES = [
+    (f'/https://www.site{i}.example/path/to/resource-{j}.js', f'https://www.site{i}.example')
+    for i in range(8) for j in range(32)
+]
+
+
+def legacy_normalize_url(url, origin_override=None) -> SplitResult:
+    url_parts = urlsplit(url)
+    scheme = url_parts.scheme
+    domain = url_parts.netloc
+    path = url_parts.path
+    if origin_override:
+        origin_override = urlsplit(origin_override)
+        scheme = origin_override.scheme
+        domain = origin_override.netloc
+    if not domain:
+        split = url_parts.path.lstrip('/').split('/', 1)
+        domain = split[0]
+        path = split[1] if len(split) == 2 else ''
+    return SplitResult(scheme, domain, path, url_parts.query, url_parts.fragment)
+
+
+def legacy_origin_domain(origin, referrer):
+    if origin:
+        return urlsplit(origin).netloc
+    if referrer:
+        return urlsplit(referrer).netloc
+    return None
+
+
+def legacy_conceal_origin(find, replace, url: SplitResult, **multidicts):
+    path = url.path.replace(find, replace)
+    query = url.query.replace(find, replace)
+    url = SplitResult(url.scheme, url.netloc, path, query, url.fragment)
+
+    for name in multidicts:
+        dict_ = multidicts[name]
+        multidicts[name] = type(dict_)({
+            k: list(map(lambda v: v.replace(find, replace), dict_.getlist(k, type=str))) for k in dict_.keys()
+        })
+
+    return {'url': url, **multidicts}
+
+
+def legacy_copy_headers(remote, response, *, server_map, **kwargs):
+    server_origin = server_map['origins']['main']
+    remote_url: SplitResult = urlsplit(remote.url)
+    headers = Headers(remote.headers.items())
+
+    headers.pop('Set-Cookie', None)
+    headers.pop('Transfer-Encoding', None)
+    response.headers = headers
+
+    if 'Location' in headers:
+        headers['Location'] = f'{server_origin}/{urljoin(remote_url.geturl(), headers["Location"])}'
+
+    response.headers.update(headers)
+    return headers
+
+
+def legacy_copy_cookies(remote, response, *, server_map, **kwargs):
+    server_domain = server_map['domains']['main']
+    remote_url: SplitResult = urlsplit(remote.url)
+    cookie_jar = remote.cookies
+
+    cookies = []
+    get_cookie_main = attrgetter('name', 'value', 'expires')
+    get_cookie_secure = attrgetter('secure')
+    get_cookie_rest = attrgetter('_rest')
+    set_cookie_args = ('key', 'value', 'expires', 'path', 'domain', 'secure', 'httponly', 'samesite')
+
+    for cookie in cookie_jar:
+        cookie_main = get_cookie_main(cookie)
+        cookie_is_secure = get_cookie_secure(cookie)
+        _rest = get_cookie_rest(cookie)
+        cookie_domain = server_domain if cookie.domain_specified and server_domain not in {'localhost', '127.0.0.1'} else None
+        cookie_path = f'{remote_url.scheme}://{remote_url.netloc}{cookie.path}'.rstrip('/') if cookie.path_specified else None
+        cookie_rest = ('HttpOnly' in _rest, _rest.get('SameSite', None))
+        cookies.append({
+            k: v
+            for k, v in dict(
+                zip(set_cookie_args, [*cookie_main, cookie_path, cookie_domain, cookie_is_secure, *cookie_rest]),
+            ).items()
+            if v is not None
+        })
+
+    for cookie in cookies:
+        response.set_cookie(**cookie)
+
+    return cookies
+
+
+def legacy_enforce_cors(remote, response, *, request_mode, request_origin, server_map, **kwargs):
+    remote_origin = urlsplit(remote.url)
+    remote_origin = f'{remote_origin.scheme}://{remote_origin.netloc}'
+    allow_origin = remote.headers.get('Access-Control-Allow-Origin', None)
+    if allow_origin == '*' or not allow_origin and request_mode != 'cors':
+        return
+
+    if allow_origin and allow_origin != request_origin:
+        response.headers.pop('Access-Control-Allow-Origin', None)
+        return
+
+    if not allow_origin and request_mode == 'cors' and request_origin != remote_origin:
+        return abort(403)
+
+    response.headers['Access-Control-Allow-Origin'] = server_map['origins']['main']
+
+
+def legacy_break_csp(remote, response, *, request_origin, server_map, **kwargs):
+    origins = set(server_map['origins'].values())
+    non_source_directives = {
+        'plugin-types', 'sandbox',
+        'block-all-mixed-content', 'referrer',
+        'require-sri-for', 'require-trusted-types-for',
+        'trusted-types', 'upgrade-insecure-requests',
+    }
+    adverse_directives = {'report-uri', 'report-to'}
+
+    for header in {'Content-Security-Policy', 'Content-Security-Policy-Report-Only'}:
+        csp = remote.headers.get(header, None)
+        if not csp:
+            continue
+
+        policies = [p.strip().split(' ') for p in csp.split(';')]
+        policies = {p[0]: set(p[1:]) for p in policies if p[0] not in adverse_directives}
+
+        for directive, options in policies.items():
+            if not directive:
+                continue
+            if directive in non_source_directives:
+                continue
+            if "'strict-dynamic'" in options:
+                continue
+            if "'none'" not in options:
+                options |= origins
+            if "'self'" in options:
+                options.add(request_origin)
+
+        broken_csp = '; '.join([' '.join([k, *filter(None, v)]) for k, v in policies.items()])
+        response.headers[header] = broken_csp
+        return policies
+    return {}
+
+
+def legacy_add_clear_site_data_header(remote, response, *, request_mode, request_origin, **kwargs):
+    remote_url = urlsplit(remote.url)
+    remote_origin = f'{remote_url.scheme}://{remote_url.netloc}'
+    if request_mode == 'navigate' and request_origin != remote_origin:
+        response.headers.add('Clear-Site-Data', '"cookies"')
+
+
+def make_info():
+    return {
+        'headers': MultiDict({'Accept': '*/*', 'User-Agent': 'benchmark'}),
+        'params': MultiDict({'v': '1'}),
+        'cookies': MultiDict({'session': 'abc'}),
+    }
+
+
+def make_remote(url, origin):
+    remote = requests.Response()
+    remote.url = url
+    remote.status_code = 200
+    remote.headers.update({'Content-Type': 'text/javascript', 'Location': 'next.js', 'Access-Control-Allow-Origin': origin})
+    return remote
+
+
+def legacy(path, origin, remote):
+    requested = legacy_normalize_url(path)
+    kwargs = {'url': requested, **make_info()}
+    if legacy_origin_domain(origin, None):
+        kwargs = legacy_conceal_origin(SERVER_HOST, legacy_origin_domain(origin, None), requested, **make_info())
+    kwargs['url'].geturl()
+
+    response = Response()
+    options = {'server_map': SERVER_MAP, 'request_mode': 'cors', 'request_origin': origin}
+    legacy_copy_headers(remote, response, **options)
+    legacy_copy_cookies(remote, response, **options)
+    legacy_enforce_cors(remote, response, **options)
+    legacy_add_clear_site_data_header(remote, response, **options)
+    legacy_break_csp(remote, response, **options)
+    return response
+
+
+def context(path, origin, remote):
+    url_context = URLContext.build(fetch.normalize_url(path), origin, SERVER_HOST, SERVER_MAP)
+    kwargs = {'url': url_context.requested, **make_info()}
+    if url_context.client_domain:
+        kwargs = security.conceal_origin(url_context, **make_info())
+    kwargs['url'].geturl()
+
+    url_context = url_context.with_remote(remote.url)
+    response = Response()
+    options = {'url_context': url_context, 'request_mode': 'cors', 'request_origin': origin}
+    fetch.copy_headers(remote, response, **options)
+    fetch.copy_cookies(remote, response, **options)
+    security.enforce_cors(remote, response, **options)
+    security.add_clear_site_data_header(remote, response, **options)
+    security.break_csp(remote, response, **options)
+    return response
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    pages = [(path, origin, make_remote(path[1:], origin)) for path, origin in PAGES]
+    pages = (pages * (n // len(pages) + 1))[:n]
+
+    for path, origin, remote in pages[:len(PAGES)]:
+        a, b = legacy(path, origin, remote), context(path, origin, remote)
+        assert sorted(a.headers.items()) == sorted(b.headers.items()), (a.headers, b.headers)
+
+    print(f'{"strategy":<10}{"us/request":>12}')
+    results = {}
+    for name, func in (('legacy', legacy), ('context', context)):
+        start = time.perf_counter()
+        for path, origin, remote in pages:
+            func(path, origin, remote)
+        results[name] = (time.perf_counter() - start) / n * 1e6
+        print(f'{name:<10}{results[name]:>12.2f}')
+    print(f'saving: {results["legacy"] - results["context"]:.2f} us/request ({1 - results["context"] / results["legacy"]:.0%})')
+
+
+if __name__ == '__main__':
+    main()
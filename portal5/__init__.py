@@ -16,13 +16,13 @@
 
 import secrets
 
-from flask import Flask, g, render_template, request
+from flask import Flask, g, render_template, request, send_from_directory
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from . import config, i18n
 from .app import portal5
 from .bundle import bundle
-from .utils import blacklist, security
+from .utils import blacklist, fetch, rendering, security
 
 
 def load_blueprints(app: Flask):
@@ -34,15 +34,19 @@ def setup_error_handling(app: Flask):
     def handle_error(e):
         return render_template('exceptions/error.html', statuscode=e.code, message=e.description, unsafe_markup=getattr(e, 'unsafe_markup', False)), e.code
 
-    for exc in (400, 401, 403, 404, 451, 500, 502, 503):
+    for exc in (400, 401, 403, 404, 451, 500, 502, 503, 504):
         app.register_error_handler(exc, handle_error)
 
 
 def setup_urls(app: Flask):
     app.static_folder = 'bundle/static'
+
+    def static(filename):
+        return send_from_directory(app.static_folder, filename, cache_timeout=app.config['BUNDLE_STATIC_MAX_AGE'])
+
     app.add_url_rule(
         '/<path:filename>', subdomain='static',
-        endpoint='static', view_func=app.send_static_file,
+        endpoint='static', view_func=static,
     )
 
     @app.route('/favicon.ico')
@@ -63,6 +67,7 @@ def setup_context(app: Flask):
             },
         }
         server_map['origins'] = {k: f'{request.scheme}://{v}' for k, v in server_map['domains'].items()}
+        server_map['all_origins'] = frozenset(server_map['origins'].values())
 
         app.config['SERVER_MAP'] = server_map
 
@@ -96,8 +101,10 @@ def create_app(*, override=None) -> Flask:
     setup_jinja(app)
 
     security.setup_jwt(app)
+    fetch.setup_upstream(app)
     blacklist.setup_filters(app)
     i18n.setup_languages(app)
+    rendering.setup_rendering(app)
 
     setup_urls(app)
     setup_error_handling(app)
@@ -14,16 +14,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import threading
+from collections import Counter
 from functools import wraps
 from urllib.parse import SplitResult, quote, unquote, urljoin, urlsplit
 
 from cryptography.fernet import Fernet, InvalidToken
-from flask import Blueprint, Request, Response, abort, current_app, g, redirect, render_template, request
+from flask import Blueprint, Request, Response, abort, current_app, g, jsonify, redirect, render_template, request
 
 from . import endpoints, exceptions, i18n
 from .portal5 import Portal5
-from .utils import fetch, security
+from .utils import fetch, probe, security
 from .utils.jwtkit import get_jwt
+from .utils.rendering import render_cache
+from .utils.urls import URLContext
 
 APPNAME = 'portal5'
 
@@ -33,6 +37,9 @@ portal5 = Blueprint(
     static_folder=None, static_url_path=None,
 )
 
+canonicalization_stats = Counter()
+canonicalization_lock = threading.Lock()
+
 
 def get_p5() -> Portal5:
     """Return the :class Portal5: instance in the current request context.
@@ -43,6 +50,9 @@ def get_p5() -> Portal5:
     return getattr(g, 'p5', None)
 
 
+postprocess = Portal5.postprocess(get_p5)
+
+
 @portal5.before_app_first_request
 def setup():
     conf = current_app.config.get_namespace('PORTAL5_')
@@ -56,12 +66,19 @@ def setup():
 
 @portal5.before_request
 def parse_p5():
-    g.p5 = Portal5(request)
-    i18n.override_language(g.p5.get_lang())
+    p5 = get_p5()
+    if p5 is None:
+        return
+    i18n.override_language(p5.get_lang)
 
 
 @portal5.url_value_preprocessor
 def parse_url(endpoint, values):
+    # Runs before the before_request functions, so the Portal5 instance is created here, for the client origin
+    p5 = None
+    if not endpoints.in_fast_lane():
+        p5 = g.p5 = Portal5(request)
+
     requested = values.pop('requested', None)
     if not requested or not urlsplit(requested).netloc:
         origin_override = request.args.get('_portal5origin')
@@ -71,10 +88,14 @@ def parse_url(endpoint, values):
         requested = unquote(requested)
     else:
         requested = request.path
-    g.requested = fetch.normalize_url(requested, origin_override)
+    g.url_context = URLContext.build(
+        fetch.normalize_url(requested, origin_override),
+        p5.client_origin if p5 else None,
+        request.host, current_app.config['SERVER_MAP'],
+    )
 
 
-@security.referrer_policy('no-referrer')
+@security.response_policy(referrer='no-referrer')
 def redirect_to_init(path=None):
     return redirect(f'/init?continue={path}' if path else '/init', 307)
 
@@ -113,16 +134,17 @@ def revalidate_if_outdated(view_func):
 
 @portal5.route('/init', methods=('GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'))
 @endpoints.client_side_handler('passthrough')
-@security.access_control_same_origin
-@security.csp_protected
-@security.referrer_policy('no-referrer')
+@security.response_policy(
+    allow_origin=security.SAME_ORIGIN, csp=security.PROTECTED_CSP,
+    referrer='no-referrer', cookies=postprocess,
+)
 def install_worker():
     return render_template(f'{APPNAME}/init.html')
 
 
 @portal5.route('/settings', methods=('OPTIONS',))
 @endpoints.client_side_handler('passthrough')
-@security.access_control_same_origin
+@security.response_policy(allow_origin=security.SAME_ORIGIN)
 def settings_options():
     res = Response('', 204)
     res.headers['Access-Control-Allow-Methods'] = 'GET, POST, HEAD, OPTIONS'
@@ -135,8 +157,7 @@ def settings_options():
 @requires_worker
 @requires_identity
 @revalidate_if_outdated
-@security.access_control_same_origin
-@security.csp_protected
+@security.response_policy(allow_origin=security.SAME_ORIGIN, csp=security.PROTECTED_CSP, cookies=postprocess)
 def get_prefs():
     p5 = get_p5()
 
@@ -164,8 +185,7 @@ def get_prefs():
     Portal5.jwt_version_is_outdated,
     respond_with=lambda *__, **_: exceptions.PortalSettingsNotSaved(),
 )
-@security.access_control_same_origin
-@security.csp_protected
+@security.response_policy(allow_origin=security.SAME_ORIGIN, csp=security.PROTECTED_CSP, cookies=postprocess)
 def save_prefs():
     p5 = get_p5()
     prefs = {**request.form}
@@ -204,24 +224,48 @@ def save_prefs():
 @portal5.route('/~multiple-choices', methods=('GET', 'POST'))
 @endpoints.client_side_handler('passthrough')
 @requires_worker
-@security.referrer_policy('no-referrer')
+@security.response_policy(referrer='no-referrer')
 def multiple_choices():
-    if not fetch.guard_incoming_url(g.requested, request):
-        return redirect('/' + g.requested.geturl(), 307)
+    requested = g.url_context.requested
+    if not fetch.guard_incoming_url(requested, request):
+        return redirect('/' + requested.geturl(), 307)
     request_info = dict(**request.json) if request.json else get_p5().signals.get('disambiguate', {})
     try:
         candidates = request_info.get('candidates', [])
         candidates = {i['dest']: i for i in candidates}
         candidates = [{k: urlsplit(v) for k, v in candidate.items()} for candidate in candidates.values()]
         candidates = sorted(candidates, key=lambda d: d['dest'])
-        return render_template(f'{APPNAME}/disambiguate.html', candidates=candidates, info=request_info), 300
+        if 'disambiguate_via_head' in get_p5().prefs:
+            candidates = rank_candidates(candidates)
+        autosubmit = len(candidates) == 1 and candidates[0].get('rank') == probe.ACCEPTED
+        return render_template(f'{APPNAME}/disambiguate.html', candidates=candidates, info=request_info, autosubmit=autosubmit), 300
     except KeyError:
         abort(400)
 
 
+def rank_candidates(candidates):
+    """Test all candidate destinations at once with HEAD requests and order them by their verdicts.
+
+    Candidates that are rejected by the URL filters or by the remote server are dropped,
+    unless all of them are. If a single candidate is found to exist, only it is returned.
+    """
+    filters = current_app.config.get('PORTAL_URL_FILTERS')
+    allowed = [c for c in candidates if not filters.test(fetch.prepare_request(c['dest'].geturl(), method='HEAD'))]
+    verdicts = fetch.probe_urls(c['dest'].geturl() for c in allowed)
+
+    for candidate in candidates:
+        candidate['rank'] = probe.rank(verdicts.get(candidate['dest'].geturl(), 400))
+    ranked = sorted(candidates, key=lambda c: c['rank'])
+
+    accepted = [c for c in ranked if c['rank'] == probe.ACCEPTED]
+    if len(accepted) == 1:
+        return accepted
+    return [c for c in ranked if c['rank'] != probe.REJECTED] or candidates
+
+
 @portal5.route('/~deflect', methods=('GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'))
 @endpoints.client_side_handler('passthrough')
-@security.referrer_policy('no-referrer')
+@security.response_policy(referrer='no-referrer')
 def deflect():
     destination = request.args.get('to')
     if not destination:
@@ -231,7 +275,7 @@ def deflect():
 
 @portal5.route('/direct/<path:requested>', methods=('GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'))
 def direct_deliver():
-    return deliver(resolve_url(g.requested, prefix='/direct'))
+    return deliver(resolve_url(g.url_context, prefix='/direct'))
 
 
 @portal5.route('/', defaults={'requested': '/'})
@@ -239,16 +283,27 @@ def direct_deliver():
 @requires_worker
 @revalidate_if_outdated
 def request_with_worker():
-    return deliver(resolve_url(g.requested))
+    return deliver(resolve_url(g.url_context))
 
 
 @portal5.route('/', defaults={'requested': '/'})
 @portal5.route('/<path:requested>', methods=('PUT', 'DELETE', 'HEAD', 'OPTIONS'))
 def request_no_worker():
-    return deliver(resolve_url(g.requested))
+    return deliver(resolve_url(g.url_context))
+
+
+def canonicalization_rule(requested: SplitResult, path: str):
+    if requested.netloc and request.args.get('_portal5origin'):
+        return 'origin_override'
+    if urlsplit(path).netloc != requested.netloc:
+        return 'missing_slashes'
+    if not requested.path:
+        return 'default_path'
+    return 'other'
 
 
-def resolve_url(requested: SplitResult, *, prefix=''):
+def resolve_url(url_context: URLContext, *, prefix=''):
+    requested = url_context.requested
     url_ = requested
     if not url_.path:
         url_ = SplitResult(*[*requested[:2], '/', *requested[3:]])
@@ -258,39 +313,61 @@ def resolve_url(requested: SplitResult, *, prefix=''):
         abort(guard)
 
     if url_.geturl() != request.path[1:]:
+        rule = canonicalization_rule(requested, request.path[1:])
+        with canonicalization_lock:
+            canonicalization_stats[rule] += 1
+
         if request.query_string:
             url = urljoin(url_.geturl(), f'?{request.query_string.decode("utf8")}')
         else:
             url = url_.geturl()
-        return redirect(f'{request.scheme}://{request.host}{prefix}/{url}', 307)
+        canonical = f'{request.scheme}://{request.host}{prefix}/{url}'
+
+        # With the service worker present, serve the resource right away and let the worker update the URL,
+        # but only where it restores the final URL, as for collapsed redirects in deliver()
+        p5 = get_p5()
+        if current_app.config.get('PORTAL5_SERVE_CANONICAL') and p5.valid and p5.redirect == 'follow' and request.method == 'GET':
+            g.canonical_location = canonical
+            return url_context._replace(requested=url_)
+        return redirect(canonical, 307)
 
-    return url_
+    return url_context
 
 
-def deliver(url: SplitResult):
-    if not isinstance(url, SplitResult):
-        return url
+def deliver(url_context: URLContext):
+    if not isinstance(url_context, URLContext):
+        return url_context
 
     p5 = get_p5()
-    outbound = fetch.prepare_request(**p5(url, request))
+    outbound = fetch.prepare_request(**p5(url_context, request))
 
     filters = current_app.config.get('PORTAL_URL_FILTERS')
-    should_abort = filters.test(outbound)
-    if should_abort:
-        abort(should_abort)
+    rule = filters.match(outbound)
+    if rule:
+        abort(exceptions.PortalSelfProtect(outbound.url, rule))
 
-    remote, response = fetch.pipe_request(outbound)
+    # Redirects can only be collapsed if the service worker is there to restore the final URL,
+    # and only for requests where the browser would have followed them
+    follow_redirects = (lambda r: filters.match(r) is None) if p5.valid and p5.redirect == 'follow' else None
+
+    remote, response = fetch.pipe_request(outbound, follow_redirects)
     p5.process_response(
         remote, response,
         server_map=g.server_map,
+        url_context=url_context.with_remote(remote.url),
     )
 
+    if remote.url != outbound.url:
+        response.headers['X-Portal5-Location'] = f'{url_context.server_origin}/{remote.url}'
+    elif 'canonical_location' in g:
+        response.headers['X-Portal5-Location'] = g.canonical_location
+
     return response
 
 
 @portal5.route('/~reset')
 @endpoints.client_side_handler('passthrough')
-@security.clear_site_data()
+@security.response_policy(clear_site_data=('cache', 'cookies', 'storage'))
 def reset():
     res = Response('', status=204)
     return res
@@ -302,5 +379,25 @@ def uninstall():
     return render_template(f'{APPNAME}/uninstall.html')
 
 
-portal5.after_request(Portal5.postprocess(get_p5))
+@portal5.route('/~introspect')
+@endpoints.client_side_handler('passthrough')
+def introspect():
+    if not current_app.config.get('PORTAL5_INTROSPECTION'):
+        return abort(404)
+    return jsonify(
+        upstream=fetch.upstream.stats(),
+        breaker=fetch.breaker.get_stats(),
+        cache=fetch.response_cache.get_stats(),
+        coalescing=fetch.coalescer.get_stats(),
+        probing=fetch.prober.get_stats(),
+        redirects=fetch.redirects.get_stats(),
+        canonicalization=dict(canonicalization_stats),
+        jwt=security.jwt_kit.get_stats(),
+        csp=security.get_csp_stats(),
+        filters=current_app.config['PORTAL_URL_FILTERS'].get_stats(),
+        rendering=render_cache.get_stats(),
+    )
+
+
+portal5.after_request(postprocess)
 endpoints.add_client_handler('/~disambiguate', 'disambiguate')
@@ -16,15 +16,17 @@
 
 import base64
 import json
-from functools import wraps
+import uuid
 
-from flask import Blueprint, Response, abort, g, render_template, request
+from flask import Blueprint, abort, g, render_template, request
+from flask.json import dumps as json_dumps
 
 from . import endpoints, i18n
-from .app import get_p5
+from .app import get_p5, postprocess
 from .portal5 import Portal5
-from .utils import fetch, security
+from .utils import security
 from .utils.jwtkit import get_jwt, get_private_claims, verify_claims
+from .utils.rendering import digest, render_cache, tojson
 
 APPNAME = 'bundle'
 bundle = Blueprint(
@@ -32,16 +34,24 @@ bundle = Blueprint(
     static_folder=None, static_url_path=None,
 )
 
+WORKER_ID_SLOT = 'portal5-worker-id-slot'
+WORKER_SIGNALS_SLOT = 'portal5-worker-signals-slot'
+INJECTION_BASE_SLOT = 'portal5-injection-base-slot'
+worker_rules = {}
+
 
 @bundle.before_app_first_request
 def setup():
     endpoints.resolve_client_handlers(APPNAME)
+    worker_rules['digest'] = digest(json_dumps({'endpoints': endpoints.endpoint_handlers, 'passthrough': endpoints.passthrough_rules}))
 
 
 @bundle.before_request
 def parse_p5():
+    if endpoints.in_fast_lane():
+        return
     g.p5 = Portal5(request)
-    i18n.override_language(g.p5.get_lang())
+    i18n.override_language(g.p5.get_lang)
 
 
 def mimetype(mime_):
@@ -51,20 +61,9 @@ def mimetype(mime_):
         'json': 'application/json',
     }
 
-    def wrapper(view_func, mime=mime_):
-        if mime not in types:
-            return view_func
-        mime = types[mime]
-
-        @wraps(view_func)
-        def add_type(*args, **kwargs):
-            out = fetch.wrap_response(view_func(*args, **kwargs))
-            if out.status_code < 300:
-                out.mimetype = mime
-            return out
-
-        return add_type
-    return wrapper
+    if mime_ not in types:
+        return lambda view_func: view_func
+    return security.response_policy(mimetype=types[mime_])
 
 
 def get_public_path(prefix='public'):
@@ -73,7 +72,7 @@ def get_public_path(prefix='public'):
 
 
 @bundle.route('/client/init.js')
-@security.clear_site_data('cookies', 'storage')
+@security.response_policy(clear_site_data=('cookies', 'storage'), cookies=postprocess)
 @mimetype('js')
 def init_with_token():
     p5 = get_p5()
@@ -85,7 +84,7 @@ def init_with_token():
 @security.expects_jwt_in('cookies', key=Portal5.COOKIE_AUTH)
 @security.rejects_jwt_where(security.jwt_is_not_supplied, respond_with=lambda *__, **_: ('', 304))
 @security.rejects_jwt_where(security.jwt_has_invalid_subject, Portal5.jwt_version_is_outdated)
-@mimetype('js')
+@security.response_policy(mimetype='application/javascript', cookies=postprocess)
 def service_worker():
     p5 = get_p5()
 
@@ -107,23 +106,39 @@ def service_worker():
     else:
         return abort(401)
 
-    settings, rules = p5.make_worker_settings(None, g.server_map['origins']['main'])
-    response = Response(
-        render_template(
-            get_public_path(),
-            settings=settings,
-            url_rules=rules,
-        ),
-        headers={'Service-Worker-Allowed': '/'},
-    )
+    response = respond_with_worker(p5)
     p5.clear_tokens()
     return response
 
 
+def respond_with_worker(p5: Portal5):
+    """Respond with the worker for the preferences and signals of :param p5:.
+
+    The worker is rendered once per variant, with placeholders for the worker id and the signals,
+    which come from the client and are filled in for each response.
+    """
+    signals = tojson(p5.signals)
+
+    def make_context():
+        settings, rules = p5.make_worker_settings(WORKER_ID_SLOT, g.server_map['origins']['main'])
+        settings['signals'] = WORKER_SIGNALS_SLOT
+        return dict(settings=settings, url_rules=rules)
+
+    def fill(body):
+        body = body.replace(f'"{WORKER_ID_SLOT}"', tojson(p5.id or str(uuid.uuid4())))
+        return body.replace(f'"{WORKER_SIGNALS_SLOT}"', signals)
+
+    return render_cache.respond(
+        get_public_path(), p5.get_bitmask(), Portal5.VERSION, worker_rules['digest'],
+        context=make_context, fill=fill, fill_vary=(signals,),
+        headers={'Service-Worker-Allowed': '/'},
+    )
+
+
 @bundle.route('/ping')
+@endpoints.fast_lane
 def ping():
-    p5 = get_p5()
-    if p5.up_to_date:
+    if Portal5.read_header(request).get('version') == Portal5.VERSION:
         return '', 204
     return '', 400
 
@@ -131,7 +146,7 @@ def ping():
 @bundle.route('/client/preferences.js')
 @mimetype('js')
 def preferences():
-    return render_template(get_public_path(), **get_p5().make_dependency_dicts())
+    return render_cache.respond(get_public_path(), context=get_p5().make_dependency_dicts)
 
 
 @bundle.route('/client/injection.js')
@@ -142,22 +157,33 @@ def dispatch_observer():
         args = json.loads(base64.b64decode(request.args.get('args')).decode())
     except (TypeError, ValueError, json.JSONDecodeError):
         return abort(400)
-    return render_template(get_public_path(), **args)
+    if not isinstance(args, dict):
+        return abort(400)
+    base = str(args['base']) if 'base' in args else ''
+
+    # The base URL comes from the page, so it is filled in rather than cached per value
+    return render_cache.respond(
+        get_public_path(),
+        context=lambda: {'base': INJECTION_BASE_SLOT},
+        fill=lambda body: body.replace(INJECTION_BASE_SLOT, base),
+        fill_vary=(base,),
+    )
 
 
 @bundle.route('/injection-manager.html')
 @bundle.route('/injection-manager~fonts.html')
 @endpoints.client_side_handler('passthrough', mode=('same-origin',), referrer=None)
 def injection_manager_template():
-    return render_template(get_public_path('www'))
+    return render_cache.respond(get_public_path('www'), i18n.get_lang())
 
 
 @bundle.route('/client/<path:file>')
 @bundle.route('/client/async-css.js')
+@endpoints.fast_lane
 @endpoints.client_side_handler('passthrough', mode=('no-cors',), referrer=None)
 @mimetype('js')
 def scripts(file=None):
-    return Response(render_template(get_public_path()))
+    return render_cache.respond(get_public_path())
 
 
-bundle.after_request(Portal5.postprocess(get_p5))
+bundle.after_request(postprocess)
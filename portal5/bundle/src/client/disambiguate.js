@@ -108,5 +108,10 @@ class Form {
 }
 
 window.addEventListener('DOMContentLoaded', () => {
-    window.form = new Form(document.getElementById('mainForm'))
+    let form = new Form(document.getElementById('mainForm'))
+    window.form = form
+    if ('autosubmit' in form.form.dataset) {
+        form.toggle(Object.keys(form.candidates)[0], true)
+        form.form.submit()
+    }
 })
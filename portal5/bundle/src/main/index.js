@@ -332,13 +332,17 @@ async function interceptFetch(event) {
         return makeRedirect(final.href)
     }
     let outbound = await makeFetch(request, referrer, final)
-    return doFetch(outbound, {
-        script_injection: {
-            run: Portal5.inject,
-            signal: 'hijack',
-            args: [dest],
+    return doFetch(
+        outbound,
+        {
+            script_injection: {
+                run: Portal5.inject,
+                signal: 'hijack',
+                args: [dest],
+            },
         },
-    })
+        followsRedirects(request)
+    )
 }
 
 async function resolveFetch(event) {
@@ -372,6 +376,7 @@ async function makeFetch(request, referrer, destination) {
     let requestOpts = await Utils.makeRequestOptions(request)
     if (requestOpts.mode === 'navigate') requestOpts.redirect = 'manual'
     p5.setReferrer(request, referrer, destination)
+    p5.redirect = followsRedirects(request) ? 'follow' : 'manual'
     if (request.method === 'GET' && request.mode === 'navigate') {
         p5.applyDirective(self.directives)
     }
@@ -381,7 +386,12 @@ async function makeFetch(request, referrer, destination) {
     return outbound
 }
 
-async function doFetch(request, useFeatures = null) {
+// Only collapse redirects that the browser would have followed itself
+function followsRedirects(request) {
+    return request.method === 'GET' && (request.redirect === 'follow' || request.mode === 'navigate')
+}
+
+async function doFetch(request, useFeatures = null, followRedirects = false) {
     let response = await fetch(request)
 
     let directives = Portal5.parseDirectives(response)
@@ -402,9 +412,22 @@ async function doFetch(request, useFeatures = null) {
     }
 
     for (let k in directives) self.directives[k] = directives[k]
+
+    // The server followed redirects: keep the final response and redirect locally to its URL
+    let location = response.headers.get('X-Portal5-Location')
+    if (followRedirects && location && location !== request.url) {
+        self.redirectedResponses.add(location, response, 'response', 30000)
+        return Response.redirect(location, 302)
+    }
     return response
 }
 
+function fromRedirected(event) {
+    if (event.request.method !== 'GET') return
+    let response = self.redirectedResponses.remove(event.request.url, 'response')
+    if (response) return event.respondWith(response)
+}
+
 self.destinationRequiresRedirect = {
     document: true,
     embed: true,
@@ -419,6 +442,7 @@ self.directives = {}
 
 self.clientRecords = new ClientRecordStorage()
 self.requestOptsCache = new TranscientStorage()
+self.redirectedResponses = new TranscientStorage()
 
 self.addEventListener('install', (event) => {
     event.waitUntil(skipWaiting())
@@ -429,6 +453,7 @@ self.addEventListener('activate', (event) => {
 })
 
 self.addEventListener('fetch', securityCheck)
+self.addEventListener('fetch', fromRedirected)
 self.addEventListener('fetch', withDefinedHandlers)
 self.addEventListener('fetch', noRewrite)
 self.addEventListener('fetch', (event) => {
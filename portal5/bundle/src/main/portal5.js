@@ -78,7 +78,7 @@ class Portal5 {
         let attributes = []
         switch (mode) {
             case 'regular':
-                attributes = ['version', 'prefs', 'mode', 'origin', 'referrer', 'signals']
+                attributes = ['version', 'prefs', 'mode', 'redirect', 'origin', 'referrer', 'signals']
                 break
             case 'identity':
                 attributes = ['id', 'version', 'prefs', 'signals']
@@ -58,9 +58,9 @@ class Utils {
 
 class TranscientStorage {
     add(id, data, namespace = 'data', ttl = null) {
-        id = namespace + ':' + id
-        this[id] = data
-        if (ttl) setTimeout(() => this.remove(id), ttl)
+        let key = namespace + ':' + id
+        this[key] = data
+        if (ttl) setTimeout(() => delete this[key], ttl)
     }
     get(id, namespace = 'data') {
         return this[namespace + ':' + id]
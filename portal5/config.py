@@ -18,8 +18,16 @@ import os
 
 # PORTAL_URL_FILTERS = [
 #     dict(name='*', description='all URLs', test=lambda r: True),
-#     dict(name='http://*', description='No plain-text HTTP', test=lambda r: urlsplit(r.url).scheme == 'http'),
+#     dict(name='http://*', description='No plain-text HTTP', test=lambda r: urlsplit(r.url).scheme == 'http', host_only=True),
+#     dict(domain='example.org', description='example.org and its subdomains'),
+#     dict(host='www.example.com'), dict(scheme='ftp'), dict(path='/admin/'),
+#     dict(regex=r'\.exe$'), dict(cidr='10.0.0.0/8', description='Private network'),
+#     dict(file='/etc/portal5/blocklist.txt', description='Blocklist'),
 # ]
+# PORTAL_URL_FILTERS_CHECK_INTERVAL = 5
+# PORTAL_URL_FILTERS_RELOAD_ON_SIGHUP = True
+# PORTAL_URL_FILTERS_VERDICT_CACHE_SIZE = 4096
+# PORTAL_URL_FILTERS_VERDICT_CACHE_TTL = 300
 
 SERVER_NAME = os.getenv('SERVER_NAME')
 
@@ -36,3 +44,45 @@ LANGUAGES = ['en', 'zh_cn']
 # JWT_SECRET_KEY = None
 
 JWT_IDENTITY_CLAIM = 'sub'
+JWT_VERIFIED_CACHE_SIZE = 1024
+
+UPSTREAM_POOL_CONNECTIONS = 64
+UPSTREAM_POOL_MAXSIZE = 16
+UPSTREAM_POOL_BLOCK = False
+UPSTREAM_IDLE_TIMEOUT = 60
+UPSTREAM_MAX_LIFETIME = 600
+UPSTREAM_CONNECT_TIMEOUT = 5
+UPSTREAM_READ_TIMEOUT = 30
+UPSTREAM_TOTAL_TIMEOUT = 60
+
+UPSTREAM_BREAKER_ENABLED = True
+UPSTREAM_BREAKER_THRESHOLD = 5
+UPSTREAM_BREAKER_COOLDOWN = 15
+
+UPSTREAM_PROBE_WORKERS = 16
+UPSTREAM_PROBE_DEADLINE = 2.5
+UPSTREAM_PROBE_TTL = 300
+
+UPSTREAM_REDIRECTS_FOLLOW = False
+UPSTREAM_REDIRECTS_MAX_HOPS = 5
+UPSTREAM_REDIRECTS_CACHE_SIZE = 4096
+UPSTREAM_REDIRECTS_CACHE_TTL = 86400
+
+UPSTREAM_CACHE_ENABLED = False
+UPSTREAM_CACHE_MEMORY_SIZE = 64 * 1024 * 1024
+UPSTREAM_CACHE_MEMORY_MAX_ENTRY = 1024 * 1024
+# UPSTREAM_CACHE_DISK_PATH = '/var/cache/portal5'
+UPSTREAM_CACHE_DISK_SIZE = 1024 * 1024 * 1024
+UPSTREAM_CACHE_DISK_MAX_ENTRY = 64 * 1024 * 1024
+
+UPSTREAM_COALESCE_ENABLED = True
+UPSTREAM_COALESCE_BUFFER_SIZE = 4 * 1024 * 1024
+UPSTREAM_COALESCE_TIMEOUT = 10
+UPSTREAM_COALESCE_VARY = ('Accept', 'Accept-Encoding', 'Accept-Language', 'Origin', 'User-Agent')
+
+BUNDLE_RENDER_CACHE_SIZE = 256
+BUNDLE_STATIC_MAX_AGE = 7 * 86400
+
+PORTAL5_SERVE_CANONICAL = False
+
+PORTAL5_INTROSPECTION = False
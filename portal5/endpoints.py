@@ -15,7 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-from flask import current_app
+from flask import current_app, request
 
 endpoints = {}
 endpoint_handlers = {}
@@ -44,6 +44,19 @@ def client_side_handler(handler_name, **kwargs):
     return collector
 
 
+def fast_lane(view_func):
+    """Mark :param view_func: as an endpoint that is served without a :class Portal5: object.
+
+    Such endpoints must not depend on the X-Portal5 header, preferences or tokens.
+    """
+    view_func.fast_lane = True
+    return view_func
+
+
+def in_fast_lane():
+    return getattr(current_app.view_functions.get(request.endpoint), 'fast_lane', False)
+
+
 def add_client_handler(path, handler_name, virtual=True, **fetch_params):
     fetch_params = {
         'mode': ('navigate',),
@@ -31,7 +31,7 @@ def setup_languages(app: Flask):
     @babel.localeselector
     def get_locale():
         lang = (
-            getattr(g, '_lang', None)
+            get_lang()
             or request.args.get('lang', None)
             or request.accept_languages.best_match(app.config['LANGUAGES'])
         )
@@ -42,7 +42,8 @@ def setup_languages(app: Flask):
     @app.before_request
     def language_provider():
         if not getattr(g, '_lang', None):
-            g._lang = get_locale()
+            # Matched against Accept-Language only if a template asks for it
+            g._lang = get_locale
         g.get_lang = get_lang
 
     @app.cli.group()
@@ -69,8 +70,13 @@ def setup_languages(app: Flask):
 
 
 def override_language(lang):
+    """Use :param lang: for the current request; if it is callable, it is called when the language is first needed."""
     g._lang = lang
 
 
 def get_lang():
-    return g._lang
+    lang = getattr(g, '_lang', None)
+    if callable(lang):
+        g._lang = None
+        lang = g._lang = lang()
+    return lang
@@ -18,8 +18,8 @@ import base64
 import json
 import uuid
 from datetime import timedelta
-from functools import reduce
-from urllib.parse import SplitResult, urlsplit
+from functools import lru_cache, reduce
+from typing import Dict, FrozenSet, NamedTuple
 
 from cryptography.fernet import Fernet
 from flask import Request, Response
@@ -27,8 +27,10 @@ from flask_babel import _
 
 from . import endpoints
 from .utils import fetch, security
-from .utils.bitmasklib import bits_to_mask, constrain_ones, mask_to_bits
+from .utils.bitmasklib import bits_to_mask, constrain_ones, mask_to_bits, width
 from .utils.jwtkit import JWTKit, get_all_jwts, get_private_claims
+from .utils.pipeline import ResponsePlan
+from .utils.urls import URLContext, netloc_of, origin_of
 
 
 class PreferenceMixin:
@@ -36,42 +38,32 @@ class PreferenceMixin:
 
     COOKIE_PREFS = 'portal5prefs'
 
-    def __init__(self, request):
-        if self.prefs is not None:
-            self.set_bitmask(self.prefs)
-        else:
-            prefs = request.cookies.get(self.COOKIE_PREFS, None, int)
-            if prefs:
-                self.set_bitmask(prefs)
-            else:
+    def load_prefs(self):
+        mask = self._header.get('prefs')
+        if mask is None:
+            mask = self._request.cookies.get(self.COOKIE_PREFS, None, int)
+            if not mask:
                 self.signals['nopref'] = 1
-                self.set_bitmask(bits_to_mask(self._defaults))
-
-        try:
-            self.prefs2 = json.loads(base64.b64decode(request.cookies.get(self.COOKIE_PREFS2, '')).decode('utf8'))
-        except Exception:
-            self.prefs2 = {}
-
+                mask = bits_to_mask(self._defaults)
+        self.apply_bitmask(mask)
         self.register_action(self.write_prefs_cookie)
 
     def get_bitmask(self):
-        mask = self.prefs_to_bitmask(self.prefs)
-        mask_ = self.resolve_dependencies(mask)
-        if mask != mask_:
-            self.set_bitmask(mask_)
-            mask = mask_
-        return mask
+        return self.bitmask
 
     def set_bitmask(self, mask):
-        self.prefs = self.bitmask_to_prefs(self.resolve_dependencies(mask))
+        # Load the stored preferences first, so that the change is written back
+        self.get_bitmask()
+        self.apply_bitmask(mask)
 
-    @classmethod
-    def resolve_dependencies(cls, mask):
-        return reduce(lambda m, s: m | constrain_ones(m, s[0], s[1]), cls._dependencies.items(), mask)
+    def apply_bitmask(self, mask):
+        state = get_preference_state(mask)
+        self.prefs = state.prefs
+        self.bitmask = state.mask
 
     @classmethod
     def bitmask_to_prefs(cls, mask):
-        return set(filter(None, {cls._keys.get(k, None) for k in mask_to_bits(mask)}))
+        return FEATURES_PREFS[mask & FEATURES_ALL] if mask > 0 else FEATURES_PREFS[0]
 
     @classmethod
     def prefs_to_bitmask(cls, prefs):
@@ -106,26 +98,18 @@ class PreferenceMixin:
         return prefs
 
     def make_client_prefs(self):
-        bitmask = self.get_bitmask()
         prefs = {
-            'value': bitmask,
-            'local': {FEATURES_KEYS[k]: 1 for k in mask_to_bits(bitmask) & FEATURES_CLIENT_SPECIFIC},
+            'value': self.bitmask,
+            'local': get_preference_state(self.bitmask).client_prefs,
         }
         return {'prefs': prefs}
 
     def make_dependency_dicts(self):
-        return dict(zip(
-            ('dep', 'req'),
-            [
-                {FEATURES_KEYS[k].replace('_', '-'): [FEATURES_KEYS[v].replace('_', '-') for v in l] for k, l in d.items()}
-                for d in (FEATURES_DEPENDENCIES, FEATURES_REQUIREMENTS)
-            ],
-        ))
+        return FEATURES_DEPENDENCY_DICTS
 
     @property
     def requires_vendor(self):
-        bitmask = self.get_bitmask()
-        return bool(bits_to_mask(FEATURES_BUNDLE_REQUIRING) & bitmask)
+        return get_preference_state(self.bitmask).requires_vendor
 
 
 class PreferenceMixin2:
@@ -133,9 +117,9 @@ class PreferenceMixin2:
 
     COOKIE_PREFS2 = 'portal5prefs2'
 
-    def __init__(self, request):
+    def load_prefs2(self):
         try:
-            self.prefs2 = json.loads(base64.b64decode(request.cookies.get(self.COOKIE_PREFS2, '')).decode('utf8'))
+            self.prefs2 = json.loads(base64.b64decode(self._request.cookies.get(self.COOKIE_PREFS2, '')).decode('utf8'))
         except Exception:
             self.prefs2 = {}
 
@@ -156,29 +140,8 @@ class PreferenceMixin2:
 class FeaturesMixin:
     __slots__ = ()
 
-    def process_response(self, remote, response: Response, **kwargs):
-        kwargs.update({f'request_{k}': getattr(self, k) for k in self.__slots__})
-
-        if 'set_headers' in self.prefs:
-            fetch.copy_headers(remote, response, **kwargs)
-        elif 'Content-Encoding' in remote.headers:
-            response.headers['Content-Encoding'] = remote.headers['Content-Encoding']
-
-        if 'set_cookies' in self.prefs:
-            fetch.copy_cookies(remote, response, **kwargs)
-
-        if 'enforce_cors' in self.prefs:
-            security.enforce_cors(remote, response, **kwargs)
-
-        if 'clear_cookies_on_navigate' in self.prefs:
-            security.add_clear_site_data_header(remote, response, **kwargs)
-
-        if 'break_csp' in self.prefs:
-            csp = security.break_csp(remote, response, **kwargs)
-
-            if 'script_injection' in self.prefs:
-                if "'strict-dynamic'" not in csp.get('script-src', set()) | csp.get('script-src-elem', set()):
-                    self.set_signal('hijack')
+    def process_response(self, remote, response: Response, *, url_context, **kwargs):
+        get_response_plan(self.get_bitmask()).apply(self, remote, response, url_context)
 
 
 class JWTMixin:
@@ -186,11 +149,9 @@ class JWTMixin:
 
     COOKIE_AUTH = 'portal5auth'
 
-    def __init__(self, request):
-        self.tokens = []
+    def load_tokens(self):
+        self.tokens = [''] if self._request.cookies.get(self.COOKIE_AUTH, None) is None else []
         self.register_action(self.write_auth_cookie)
-        if request.cookies.get(self.COOKIE_AUTH, None) is None:
-            self.tokens = ['']
 
     def issue_new_token(self, identity, privilege, expires=180, **claims):
         user_claims = {
@@ -199,7 +160,7 @@ class JWTMixin:
             'privilege': privilege,
             **claims,
         }
-        token = JWTKit.get_jwtkit().create_token(
+        token = JWTKit.get_jwtkit().make_claims(
             sub=identity, exp=timedelta(seconds=expires) if isinstance(expires, int) else None,
             **user_claims,
         )
@@ -208,15 +169,16 @@ class JWTMixin:
 
     @classmethod
     def write_auth_cookie(cls, p5, response):
+        # Tokens are kept as payloads and encoded together, mostly into a single session token
         if p5.tokens:
-            response.set_cookie(cls.COOKIE_AUTH, ' '.join(p5.tokens), max_age=cls.COOKIE_MAX_AGE, path='/', secure=True, httponly=True, samesite='Lax')
+            value = JWTKit.get_jwtkit().encode_tokens([t for t in p5.tokens if t])
+            response.set_cookie(cls.COOKIE_AUTH, value, max_age=cls.COOKIE_MAX_AGE, path='/', secure=True, httponly=True, samesite='Lax')
 
     def persist_tokens(self):
-        jwtkit = JWTKit.get_jwtkit()
-        self.tokens.extend([jwtkit.encode_token(token) for token in get_all_jwts()])
+        self.tokens.extend(get_all_jwts())
 
     def clear_tokens(self):
-        self.tokens = ['']
+        self.tokens[:] = ['']
 
     @classmethod
     def jwt_version_is_outdated(cls, jwt, *args, **kwargs):
@@ -236,7 +198,10 @@ class PostprocessingMixin:
     def postprocess(cls, getter):
         def process(response):
             p5: cls = getter()
-            for action in p5.after_request:
+            if p5 is None:
+                return response
+            actions, p5.after_request = p5.after_request, []
+            for action in actions:
                 action(p5, response)
             return response
         return process
@@ -245,8 +210,10 @@ class PostprocessingMixin:
 class WorkerSignalMixin:
     __slots__ = ()
 
-    def __init__(self):
-        self.signals = self.signals or {}
+    def load_signals(self):
+        self.signals = self._header.get('signals') or {}
+
+    def load_feedback(self):
         self.feedback = set()
         self.register_action(Portal5.set_signal_header)
 
@@ -287,18 +254,67 @@ for k, v in FEATURES_DEPENDENCIES.items():
 FEATURES_CLIENT_SPECIFIC = {0, 3, 7}
 FEATURES_BUNDLE_REQUIRING = {7}
 
+FEATURES_WIDTH = width(FEATURES_KEYS)
+FEATURES_ALL = (1 << FEATURES_WIDTH) - 1
+
+
+def resolve_dependencies(mask):
+    return reduce(lambda m, s: m | constrain_ones(m, s[0], s[1]), FEATURES_DEPENDENCIES.items(), mask)
+
+
+class PreferenceState(NamedTuple):
+    mask: int
+    prefs: FrozenSet[str]
+    client_prefs: Dict[str, int]
+    requires_vendor: bool
+
+
+def make_preference_state(mask) -> PreferenceState:
+    mask = resolve_dependencies(mask)
+    bits = mask_to_bits(mask)
+    return PreferenceState(
+        mask=mask,
+        prefs=FEATURES_PREFS[mask],
+        client_prefs={FEATURES_KEYS[k]: 1 for k in bits & FEATURES_CLIENT_SPECIFIC},
+        requires_vendor=bool(bits & FEATURES_BUNDLE_REQUIRING),
+    )
+
+
+# All possible preference states are computed ahead of time.
+FEATURES_PREFS = tuple(frozenset(FEATURES_KEYS[k] for k in mask_to_bits(m) if k in FEATURES_KEYS) for m in range(FEATURES_ALL + 1))
+FEATURES_STATES = tuple(make_preference_state(m) for m in range(FEATURES_ALL + 1))
+
+FEATURES_DEPENDENCY_DICTS = dict(zip(
+    ('dep', 'req'),
+    [
+        {FEATURES_KEYS[k].replace('_', '-'): [FEATURES_KEYS[v].replace('_', '-') for v in l] for k, l in d.items()}
+        for d in (FEATURES_DEPENDENCIES, FEATURES_REQUIREMENTS)
+    ],
+))
+
+
+def get_preference_state(mask) -> PreferenceState:
+    return FEATURES_STATES[mask & FEATURES_ALL] if mask > 0 else FEATURES_STATES[0]
+
+
+@lru_cache(maxsize=None)
+def get_response_plan(bitmask) -> ResponsePlan:
+    return ResponsePlan(Portal5.bitmask_to_prefs(bitmask))
+
 
 class Portal5(PostprocessingMixin, WorkerSignalMixin, JWTMixin, PreferenceMixin, PreferenceMixin2, FeaturesMixin):
     __slots__ = (
-        'id', 'version', 'prefs', 'prefs2',
-        'mode', 'referrer', 'origin',
+        'id', 'version', 'prefs', 'prefs2', 'bitmask',
+        'mode', 'redirect', 'referrer', 'origin',
         'signals', 'feedback',
         'tokens', 'after_request',
+        '_request', '_header',
     )
 
     VERSION = None
 
     HEADER = 'X-Portal5'
+    HEADER_FIELDS = frozenset({'id', 'version', 'mode', 'redirect', 'referrer', 'origin'})
 
     COOKIE_MAX_AGE = 86400 * 365
 
@@ -311,20 +327,33 @@ class Portal5(PostprocessingMixin, WorkerSignalMixin, JWTMixin, PreferenceMixin,
     _passthrough_conf: dict = None
 
     def __init__(self, request: Request):
-        try:
-            fetch = json.loads(request.headers.get(self.HEADER, '{}'))
-        except Exception:
-            fetch = {}
+        # Everything else is parsed from the request when it is first accessed (see __getattr__),
+        # and the actions that write state back to the response are registered at that time.
+        self._request = request
+        PostprocessingMixin.__init__(self)
 
-        for k in self.__slots__:
-            if not hasattr(self, k):
-                setattr(self, k, fetch.get(k, None))
+    def __getattr__(self, name):
+        # Only called for slots that have not been assigned yet
+        if name in self.HEADER_FIELDS:
+            value = self._header.get(name)
+            setattr(self, name, value)
+            return value
+        loader = self._loaders.get(name)
+        if loader is None:
+            raise AttributeError(name)
+        loader(self)
+        return object.__getattribute__(self, name)
+
+    def load_header(self):
+        self._header = self.read_header(self._request)
 
-        PostprocessingMixin.__init__(self)
-        WorkerSignalMixin.__init__(self)
-        JWTMixin.__init__(self, request)
-        PreferenceMixin.__init__(self, request)
-        PreferenceMixin2.__init__(self, request)
+    @classmethod
+    def read_header(cls, request: Request) -> dict:
+        try:
+            header = json.loads(request.headers.get(cls.HEADER, '{}'))
+        except Exception:
+            return {}
+        return header if isinstance(header, dict) else {}
 
     @property
     def valid(self):
@@ -337,12 +366,20 @@ class Portal5(PostprocessingMixin, WorkerSignalMixin, JWTMixin, PreferenceMixin,
     @property
     def origin_domain(self):
         if self.origin:
-            return urlsplit(self.origin).netloc
+            return netloc_of(self.origin)
         if self.referrer:
-            return urlsplit(self.referrer).netloc
+            return netloc_of(self.referrer)
         return None
 
-    def __call__(self, url: SplitResult, request: Request, **overrides):
+    @property
+    def client_origin(self):
+        if self.origin:
+            return self.origin
+        if self.referrer:
+            return origin_of(self.referrer)
+        return None
+
+    def __call__(self, url_context: URLContext, request: Request, **overrides):
         info = fetch.extract_request_info(request)
 
         headers = info['headers']
@@ -363,10 +400,10 @@ class Portal5(PostprocessingMixin, WorkerSignalMixin, JWTMixin, PreferenceMixin,
         if self.origin and (self.mode == 'cors' or request.method not in {'GET', 'HEAD'}):
             headers['Origin'] = self.origin
 
-        if self.origin_domain:
-            kwargs = security.conceal_origin(request.host, self.origin_domain, url, **info)
+        if url_context.client_domain:
+            kwargs = security.conceal_origin(url_context, **info)
         else:
-            kwargs = {'url': url, **info}
+            kwargs = {'url': url_context.requested, **info}
 
         kwargs['method'] = request.method
         kwargs['url'] = kwargs['url'].geturl()
@@ -391,6 +428,16 @@ class Portal5(PostprocessingMixin, WorkerSignalMixin, JWTMixin, PreferenceMixin,
 
         return settings, rules
 
+    _loaders = {
+        '_header': load_header,
+        'signals': WorkerSignalMixin.load_signals,
+        'feedback': WorkerSignalMixin.load_feedback,
+        'tokens': JWTMixin.load_tokens,
+        'prefs': PreferenceMixin.load_prefs,
+        'bitmask': PreferenceMixin.load_prefs,
+        'prefs2': PreferenceMixin2.load_prefs2,
+    }
+
 
 def print_features():
     return {
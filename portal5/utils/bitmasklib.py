@@ -13,9 +13,10 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-"""Utility functions for manipulating bitmasks."""
+"""Utility functions for manipulating bitmasks.
 
-from functools import reduce
+Bitmasks are plain Python integers, so none of these functions are limited to 64 bits.
+"""
 
 
 def bits_to_mask(bits):
@@ -31,7 +32,10 @@ def bits_to_mask(bits):
     :return: The equivalent bitmask
     :rtype: int
     """
-    return reduce(lambda x, y: x | y, (2 ** b for b in bits), 0)
+    mask = 0
+    for b in bits:
+        mask |= 1 << b
+    return mask
 
 
 def mask_to_bits(mask):
@@ -47,10 +51,14 @@ def mask_to_bits(mask):
     :return: A collection of integers specifying bits that are on.
     :rtype: Collection[int]
     """
-    n = 0
-    while 1 << n <= mask:
-        n += 1
-    return {d for d in range(0, n) if 2 ** d & mask}
+    bits = set()
+    if mask < 0:
+        return bits
+    while mask:
+        lowest = mask & -mask
+        bits.add(lowest.bit_length() - 1)
+        mask ^= lowest
+    return bits
 
 
 def constrain_ones(mask, bit, ones):
@@ -69,7 +77,7 @@ def constrain_ones(mask, bit, ones):
     :return: The modified bitmask
     :rtype: int
     """
-    power = 2 ** bit
+    power = 1 << bit
     sync = power | bits_to_mask(ones)
     return mask | sync if mask & power & sync else mask
 
@@ -90,6 +98,16 @@ def constrain_zeroes(mask, bit, zeroes):
     :return: The modified bitmask
     :rtype: int
     """
-    power = 2 ** bit
+    power = 1 << bit
     sync = power | bits_to_mask(zeroes)
     return mask if mask & power & sync else mask & ~sync
+
+
+def width(bits):
+    """Return the smallest number of digits that can hold all bits in :param bits:.
+
+    :param bits: A collection of integers specifying bits
+    :type bits: Collection[int]
+    :rtype: int
+    """
+    return bits_to_mask(bits).bit_length()
@@ -13,19 +13,60 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Outbound request filters.
 
+Declarative rules (exact host, domain suffix, scheme, path prefix, regex and
+CIDR ranges for literal IP addresses) are compiled into an index, so that a
+request is checked against all of them with one lookup per rule kind:
+host names walk a trie of reversed labels, path prefixes and regexes share a
+single combined pattern, and IP ranges are looked up by prefix length.
+Large lists are read from files (:class BlocklistFile:) and memory-mapped.
+Arbitrary callables (:class RequestTest:) are still supported, but are called
+one by one after the index and the lists had no match.
+"""
+
+import ipaddress
+import json
+import mmap
+import os
+import re
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
 from collections.abc import Callable, Hashable, MutableSet
+from contextlib import contextmanager
+from hashlib import blake2b
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import requests
 
 from .. import exceptions
+from .urls import split_url
 
 
 class RequestTest(Hashable):
-    def __init__(self, test: Callable, name=None, description=None):
+    """A request filter calling :param test: with each request.
+
+    :param host_only: Whether the verdict only depends on the scheme and the host of the URL,
+        so that it can be cached per host
+    """
+
+    def __init__(self, test: Callable, name=None, description=None, host_only=False):
         object.__setattr__(self, '_test', test)
         object.__setattr__(self, 'name', name or test.__name__)
         self.description = description
+        self.host_only = host_only
 
     def __setattr__(self, name, value):
         if name in {'_test', 'name'}:
@@ -46,10 +87,418 @@ class RequestTest(Hashable):
         return wrap
 
 
+class RequestRule(RequestTest):
+    """A declarative request filter rule.
+
+    :param kind: One of `host` (exact host name), `domain` (the domain and all its subdomains),
+        `scheme`, `path` (path prefix), `regex` (searched in the full URL) and `cidr` (literal IP addresses)
+    """
+    KINDS = ('host', 'domain', 'scheme', 'path', 'regex', 'cidr')
+    HOST_KINDS = frozenset({'host', 'domain', 'scheme', 'cidr'})
+
+    def __init__(self, kind, value, name=None, description=None):
+        if kind not in self.KINDS:
+            raise ValueError(f'Unknown rule kind "{kind}"')
+        if kind in {'host', 'domain', 'scheme'}:
+            value = value.lower().strip('.')
+            if kind == 'domain' and value.startswith('*.'):
+                value = value[2:]
+        elif kind == 'regex':
+            re.compile(value)
+        elif kind == 'cidr':
+            value = str(ipaddress.ip_network(value, strict=False))
+        object.__setattr__(self, 'kind', kind)
+        object.__setattr__(self, 'value', value)
+        super().__init__(self._match, name or f'{kind}:{value}', description, kind in self.HOST_KINDS)
+
+    def __setattr__(self, name, value):
+        if name in {'kind', 'value'}:
+            raise ValueError(f'Setting immutable attribute "{name}" is not allowed')
+        return super().__setattr__(name, value)
+
+    def __eq__(self, other):
+        return isinstance(other, RequestRule) and (self.kind, self.value) == (other.kind, other.value)
+
+    def __hash__(self):
+        return hash((self.kind, self.value))
+
+    def _match(self, req: requests.PreparedRequest) -> bool:
+        return RuleIndex([self]).match(req) is self
+
+    @classmethod
+    def from_kwargs(cls, kwargs: dict):
+        kinds = [k for k in cls.KINDS if k in kwargs]
+        if len(kinds) != 1:
+            raise ValueError(f'Filter rule must have exactly one of {", ".join(cls.KINDS)}')
+        kwargs = {**kwargs}
+        kind = kinds[0]
+        return cls(kind, kwargs.pop(kind), **kwargs)
+
+
+FILTER_DEFAULTS = {
+    'check_interval': 5,
+    'reload_on_sighup': True,
+    'verdict_cache_size': 4096,
+    'verdict_cache_ttl': 300,
+}
+
+SUFFIX = '*'
+EXACT = '.'
+
+URL_PREFIX = r'^[^:/?#]+://[^/?#]*'
+
+
+def ip_literal(host) -> Optional[str]:
+    """Return the literal IP address in :param host:, or None if it is a host name."""
+    try:
+        return ipaddress.ip_address(host)
+    except ValueError:
+        return None
+
+
+def combinable(expression) -> bool:
+    """Whether :param expression: can be an alternative of a combined pattern.
+
+    Patterns with groups of their own (whose numbering would change) or with global flags
+    are searched separately.
+    """
+    try:
+        return not re.compile(f'(?:{expression})').groups
+    except re.error:
+        return False
+
+
+class RuleIndex:
+    """Declarative rules compiled for lookup."""
+    __slots__ = ('trie', 'schemes', 'pattern', 'groups', 'patterns', 'networks', 'size')
+
+    def __init__(self, rules):
+        self.size = len(rules)
+        self.trie = {}
+        self.schemes: Dict[str, RequestRule] = {}
+        self.networks: Dict[Tuple[int, int], Dict[int, RequestRule]] = {}
+        expressions: List[Tuple[str, RequestRule]] = []
+
+        for rule in rules:
+            kind, value = rule.kind, rule.value
+            if kind in {'host', 'domain'}:
+                node = self.trie
+                for label in reversed(value.split('.')):
+                    node = node.setdefault(label, {})
+                node.setdefault(SUFFIX if kind == 'domain' else EXACT, rule)
+            elif kind == 'scheme':
+                self.schemes.setdefault(value, rule)
+            elif kind == 'cidr':
+                network = ipaddress.ip_network(value)
+                ranges = self.networks.setdefault((network.version, network.prefixlen), {})
+                ranges.setdefault(int(network.network_address), rule)
+            elif kind == 'path':
+                expressions.append((URL_PREFIX + re.escape(value), rule))
+            else:
+                expressions.append((value, rule))
+
+        self.patterns = [(re.compile(e), rule) for e, rule in expressions if not combinable(e)]
+        expressions = [(e, rule) for e, rule in expressions if combinable(e)]
+        self.groups = {f'r{i}': rule for i, (_, rule) in enumerate(expressions)}
+        self.pattern = re.compile('|'.join(f'(?P<r{i}>{e})' for i, (e, _) in enumerate(expressions))) if expressions else None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def host_only(self):
+        return self.pattern is None and not self.patterns
+
+    def match(self, req: requests.PreparedRequest) -> Optional[RequestRule]:
+        url = split_url(req.url)
+        rule = self.schemes.get(url.scheme)
+        if rule:
+            return rule
+
+        host = (url.hostname or '').rstrip('.')
+        if self.networks:
+            address = ip_literal(host)
+            if address is not None:
+                rule = self.match_address(address)
+        if not rule and self.trie:
+            rule = self.match_host(host)
+        if rule:
+            return rule
+
+        if self.pattern:
+            matched = self.pattern.search(req.url)
+            if matched:
+                return self.groups[matched.lastgroup]
+        for pattern, rule in self.patterns:
+            if pattern.search(req.url):
+                return rule
+        return None
+
+    def match_host(self, host) -> Optional[RequestRule]:
+        node = self.trie
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                return None
+            if SUFFIX in node:
+                return node[SUFFIX]
+        return node.get(EXACT)
+
+    def match_address(self, address) -> Optional[RequestRule]:
+        value = int(address)
+        bits = address.max_prefixlen
+        for (version, prefixlen), ranges in self.networks.items():
+            if version != address.version:
+                continue
+            rule = ranges.get(value >> (bits - prefixlen) << (bits - prefixlen))
+            if rule:
+                return rule
+        return None
+
+
+class ListIndex:
+    """A compiled blocklist file, memory-mapped.
+
+    Layout: header, sorted 64-bit hashes of blocked domains, sorted 64-bit hashes of blocked hosts,
+    then the rules of other kinds as JSON. Hashes are in native byte order.
+    """
+    __slots__ = ('source', 'domains', 'hosts', 'rules', 'entries', '_mmap')
+
+    MAGIC = b'P5BL' if sys.byteorder == 'little' else b'P5BB'
+    FORMAT = 2
+    HEADER = struct.Struct('=4sHHqqQQQ')
+
+    def __init__(self, path, source, description=None):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_, _, mtime, size, domains, hosts, rules = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC or format_ != self.FORMAT or (mtime, size) != source:
+            raise ValueError('Stale blocklist index')
+        offset = self.HEADER.size
+        self._mmap = data
+        self.source = source
+        self.domains = memoryview(data)[offset:offset + domains * 8].cast('Q')
+        offset += domains * 8
+        self.hosts = memoryview(data)[offset:offset + hosts * 8].cast('Q')
+        offset += hosts * 8
+        rules = json.loads(data[offset:offset + rules].decode('utf8'))
+        self.rules = RuleIndex([RequestRule(kind, value, description=description) for kind, value in rules])
+        self.entries = domains + hosts + len(rules)
+
+    @classmethod
+    def build(cls, lines, path, source):
+        """Compile :param lines: of a blocklist file and write the index to :param path: atomically.
+
+        :return: The number of lines that were skipped because they are not valid entries
+        """
+        domains = set()
+        hosts = set()
+        rules = []
+        invalid = 0
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, sep, value = line.partition(':')
+            if not sep or kind not in RequestRule.KINDS:
+                kind, value = 'domain', line
+            try:
+                rule = RequestRule(kind, value.strip())
+            except (ValueError, re.error):
+                invalid += 1
+                continue
+            if kind == 'domain':
+                domains.add(list_hash(b'd', rule.value))
+            elif kind == 'host':
+                hosts.add(list_hash(b'h', rule.value))
+            else:
+                rules.append((rule.kind, rule.value))
+
+        rules = json.dumps(rules).encode('utf8')
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.blocklist-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, cls.FORMAT, 0, *source, len(domains), len(hosts), len(rules)))
+                array('Q', sorted(domains)).tofile(f)
+                array('Q', sorted(hosts)).tofile(f)
+                f.write(rules)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return invalid
+
+    def match_domain(self, host) -> Optional[str]:
+        labels = host.split('.')
+        for i in range(len(labels) - 1, -1, -1):
+            if sorted_contains(self.domains, list_hash(b'd', '.'.join(labels[i:]))):
+                return '.'.join(labels[i:])
+        return None
+
+
+def list_hash(kind: bytes, value) -> int:
+    return int.from_bytes(blake2b(kind + value.encode('utf8'), digest_size=8).digest(), sys.byteorder)
+
+
+def sorted_contains(values, value) -> bool:
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+
+class BlocklistFile(Hashable):
+    """A blocklist file with one entry per line, compiled into a :class ListIndex:.
+
+    Each line is either a domain (blocking it and all its subdomains) or `kind:value` for
+    any other kind of :class RequestRule:. Lines starting with `#` are comments.
+
+    The index is written next to the file (or to :param index:), and reused by all worker
+    processes, which share its pages. It is rebuilt when the file changes, when :meth reload:
+    is called, or on the next request after :meth request_reload: (e.g. on SIGHUP); requests
+    are served from the previous index until the new one is in place.
+    """
+
+    def __init__(self, path, index=None, name=None, description=None, check_interval=5):
+        object.__setattr__(self, 'path', os.path.abspath(path))
+        self.name = name or os.path.basename(path)
+        self.description = description
+        self.index_path = index or f'{self.path}.idx'
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.stats = {k: 0 for k in ('loads', 'compiles', 'invalid', 'errors')}
+        self.load_time = 0
+        self.generation = 0
+        self._index = self.load()
+        self._checked = time.monotonic()
+        self._reloading = False
+        self._reload_requested = False
+
+    def __setattr__(self, name, value):
+        if name == 'path':
+            raise ValueError(f'Setting immutable attribute "{name}" is not allowed')
+        return object.__setattr__(self, name, value)
+
+    def __eq__(self, other):
+        return isinstance(other, BlocklistFile) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def source(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> ListIndex:
+        start = time.perf_counter()
+        source = self.source()
+        try:
+            index = ListIndex(self.index_path, source, self.description)
+        except (OSError, ValueError, struct.error):
+            with self.lock_index():
+                try:
+                    # Another process may have compiled it while this one waited for the lock
+                    index = ListIndex(self.index_path, source, self.description)
+                except (OSError, ValueError, struct.error):
+                    with open(self.path, encoding='utf8', errors='replace') as f:
+                        self.incr('invalid', ListIndex.build(f, self.index_path, source))
+                    self.incr('compiles')
+                    index = ListIndex(self.index_path, source, self.description)
+        self.incr('loads')
+        self.load_time = time.perf_counter() - start
+        return index
+
+    @contextmanager
+    def lock_index(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f'{self.index_path}.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def incr(self, counter, value=1):
+        with self.lock:
+            self.stats[counter] += value
+
+    def reload(self, wait=False):
+        """Load the index again (recompiling it if the file has changed) in the background."""
+        with self.lock:
+            if self._reloading:
+                return
+            self._reloading = True
+            self._reload_requested = False
+        thread = threading.Thread(target=self._reload, name=f'blocklist-{self.name}', daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+
+    def _reload(self):
+        try:
+            self._index = self.load()
+            self.generation += 1
+        except Exception:
+            self.incr('errors')
+        finally:
+            self._reloading = False
+
+    def request_reload(self):
+        """Have the next request reload the index. Only sets a flag, so that it is safe to call from a signal handler."""
+        self._reload_requested = True
+
+    def refresh(self):
+        if self._reload_requested:
+            self.reload()
+            return
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            changed = self.source() != self._index.source
+        except OSError:
+            changed = False
+        if changed:
+            self.reload()
+
+    @property
+    def host_only(self):
+        return self._index.rules.host_only
+
+    def match(self, req: requests.PreparedRequest, host) -> Optional[RequestRule]:
+        self.refresh()
+        index = self._index
+        if index.domains or index.hosts:
+            domain = index.match_domain(host)
+            if domain is not None:
+                return RequestRule('domain', domain, description=self.description)
+            if sorted_contains(index.hosts, list_hash(b'h', host)):
+                return RequestRule('host', host, description=self.description)
+        return index.rules.match(req) if index.rules else None
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'entries': self._index.entries, 'load_ms': round(self.load_time * 1e3, 1)}
+
+
 class RequestFilter(MutableSet):
-    def __init__(self, *iterable):
-        iterable = iterable or set()
-        self._tests = {*iterable}
+    """A set of request filters.
+
+    When all of them are host-only, verdicts are cached per (scheme, host) for up to
+    :param cache_ttl: seconds; the cache is emptied whenever the filters or the lists change.
+    """
+
+    def __init__(self, *iterable, cache_size=FILTER_DEFAULTS['verdict_cache_size'], cache_ttl=FILTER_DEFAULTS['verdict_cache_ttl']):
+        self._tests = dict.fromkeys(iterable)
+        self._index = None
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.stats = {k: 0 for k in ('hits', 'misses', 'invalidated')}
+        self.miss_time = 0
+        self._verdicts = OrderedDict()
+        self._generation = None
 
     def __contains__(self, item):
         return item in self._tests
@@ -61,26 +510,151 @@ class RequestFilter(MutableSet):
         return self._tests.__len__()
 
     def add(self, value):
-        return self._tests.add(value)
+        self._tests[value] = None
+        self._index = None
+        self._generation = None
 
     def discard(self, value):
-        return self._tests.discard(value)
+        self._tests.pop(value, None)
+        self._index = None
+        self._generation = None
 
-    def test(self, request: requests.PreparedRequest):
-        for f in self._tests:
+    def compile(self) -> Tuple[RuleIndex, List[BlocklistFile], List[RequestTest]]:
+        index = self._index
+        if index is None:
+            tests = list(self._tests)
+            index = self._index = (
+                RuleIndex([t for t in tests if isinstance(t, RequestRule)]),
+                [t for t in tests if isinstance(t, BlocklistFile)],
+                [t for t in tests if not isinstance(t, (RequestRule, BlocklistFile))],
+            )
+        return index
+
+    def match(self, request: requests.PreparedRequest) -> Optional[RequestTest]:
+        """Return the first rule or test that :param request: is rejected by, or None."""
+        if not self._tests:
+            return None
+        compiled = self.compile()
+        if not self.cache_size or not self.host_only(compiled):
+            return self.evaluate(request, compiled)
+        lists = compiled[1]
+        for blocklist in lists:
+            blocklist.refresh()
+
+        url = split_url(request.url)
+        key = (url.scheme, url.hostname)
+        generation = tuple(f.generation for f in lists)
+        now = time.monotonic()
+        with self.lock:
+            if generation != self._generation:
+                if self._verdicts:
+                    self.stats['invalidated'] += 1
+                self._verdicts.clear()
+                self._generation = generation
+            entry = self._verdicts.get(key)
+            if entry is not None and entry[1] > now:
+                self._verdicts.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+
+        start = time.perf_counter()
+        rule = self.evaluate(request, compiled)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.stats['misses'] += 1
+            self.miss_time += elapsed
+            if generation == self._generation:
+                self._verdicts[key] = (rule, now + self.cache_ttl)
+                self._verdicts.move_to_end(key)
+                while len(self._verdicts) > self.cache_size:
+                    self._verdicts.popitem(last=False)
+        return rule
+
+    @staticmethod
+    def host_only(compiled) -> bool:
+        rules, lists, tests = compiled
+        return rules.host_only and all(f.host_only for f in lists) and all(getattr(f, 'host_only', False) for f in tests)
+
+    def evaluate(self, request: requests.PreparedRequest, compiled) -> Optional[RequestTest]:
+        rules, lists, tests = compiled
+        rule = rules.match(request) if rules else None
+        if rule:
+            return rule
+        if lists:
+            host = (split_url(request.url).hostname or '').rstrip('.')
+            for blocklist in lists:
+                rule = blocklist.match(request, host)
+                if rule:
+                    return rule
+        for f in tests:
             should_abort = False
             try:
                 should_abort = f(request)
             except Exception:
                 pass
             if should_abort:
-                return exceptions.PortalSelfProtect(request.url, f)
+                return f
+        return None
+
+    def test(self, request: requests.PreparedRequest):
+        rule = self.match(request)
+        if rule:
+            return exceptions.PortalSelfProtect(request.url, rule)
         return None
 
+    def reload(self):
+        for blocklist in self.compile()[1]:
+            blocklist.reload()
+
+    def request_reload(self):
+        for blocklist in self.compile()[1]:
+            blocklist.request_reload()
+
+    def get_stats(self):
+        rules, lists, tests = self.compile()
+        with self.lock:
+            hits, misses = self.stats['hits'], self.stats['misses']
+            verdicts = {
+                **self.stats,
+                'entries': len(self._verdicts),
+                'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else 0,
+                'saved_ms': round(hits * self.miss_time / misses * 1e3, 1) if misses else 0,
+            }
+        return {
+            'rules': len(self._tests) - len(lists) - len(tests),
+            'tests': len(tests),
+            'lists': {blocklist.name: blocklist.get_stats() for blocklist in lists},
+            'verdicts': verdicts,
+        }
+
 
 def setup_filters(app):
     filter_kwargs = app.config.get('PORTAL_URL_FILTERS', {})
-    tests = RequestFilter()
+    conf = {**FILTER_DEFAULTS, **app.config.get_namespace('PORTAL_URL_FILTERS_')}
+    tests = RequestFilter(cache_size=conf['verdict_cache_size'], cache_ttl=conf['verdict_cache_ttl'])
     for kwargs in filter_kwargs:
-        tests.add(RequestTest(**kwargs))
+        if isinstance(kwargs, str):
+            kwargs = {'file': kwargs}
+        if 'test' in kwargs:
+            tests.add(RequestTest(**kwargs))
+        elif 'file' in kwargs:
+            kwargs = {'check_interval': conf['check_interval'], **kwargs}
+            tests.add(BlocklistFile(kwargs.pop('file'), **kwargs))
+        else:
+            tests.add(RequestRule.from_kwargs(kwargs))
     app.config['PORTAL_URL_FILTERS'] = tests
+
+    if conf['reload_on_sighup'] and tests.compile()[1] and hasattr(signal, 'SIGHUP'):
+        previous = signal.getsignal(signal.SIGHUP)
+
+        def reload(signum, frame):
+            # Reloading takes locks that the interrupted thread may be holding, so leave it to the next request
+            tests.request_reload()
+            if callable(previous):
+                previous(signum, frame)
+
+        try:
+            signal.signal(signal.SIGHUP, reload)
+        except ValueError:
+            # Not in the main thread
+            pass
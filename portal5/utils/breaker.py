@@ -0,0 +1,177 @@
+# breaker.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Per-host circuit breaker for upstream requests.
+
+A host whose requests fail repeatedly (connection errors, TLS errors and
+timeouts) is tripped: for the duration of the cooldown, further requests to
+it fail immediately with the last error seen instead of tying up a worker
+thread. Once the cooldown has passed, a single request is let through as a
+probe; if it succeeds the host is closed again, otherwise it is tripped for
+another cooldown.
+
+Only hosts that are currently failing are tracked.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+
+FAILURES = (requests.ConnectionError, requests.Timeout)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(requests.ConnectionError):
+    """Raised instead of contacting a host that is currently tripped.
+
+    :attr cause: the exception class of the failure that tripped the host
+    """
+
+    def __init__(self, *args, cause=requests.ConnectionError, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cause = cause
+
+
+class HostState:
+    __slots__ = ('failures', 'opened_until', 'probing', 'cause')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_until = None
+        self.probing = False
+        self.cause = None
+
+    def status(self, now):
+        if self.opened_until is None:
+            return CLOSED
+        if now < self.opened_until or self.probing:
+            return OPEN
+        return HALF_OPEN
+
+
+class CircuitBreaker:
+    DEFAULTS = {
+        'enabled': True,
+        'threshold': 5,
+        'cooldown': 15,
+        'max_hosts': 4096,
+    }
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.threshold = self.DEFAULTS['threshold']
+        self.cooldown = self.DEFAULTS['cooldown']
+        self.max_hosts = self.DEFAULTS['max_hosts']
+        self.stats = {k: 0 for k in ('tripped', 'fast_failed', 'probes', 'recovered')}
+        self._hosts = OrderedDict()
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = {**self.DEFAULTS, **app.config.get_namespace('UPSTREAM_BREAKER_')}
+        self.enabled = bool(conf['enabled'])
+        self.threshold = conf['threshold']
+        self.cooldown = conf['cooldown']
+        self.max_hosts = conf['max_hosts']
+        with self.lock:
+            self._hosts.clear()
+
+    @staticmethod
+    def host_of(outbound: requests.PreparedRequest):
+        url = urlsplit(outbound.url)
+        return f'{url.scheme}://{url.netloc.lower()}'
+
+    def _acquire(self, host):
+        """Check whether a request to :param host: may be sent, returning True if it is the half-open probe."""
+        with self.lock:
+            state = self._hosts.get(host)
+            if state is None:
+                return False
+            status = state.status(time.monotonic())
+            if status == OPEN:
+                self.stats['fast_failed'] += 1
+                raise CircuitOpen(f'{host} is unavailable', cause=state.cause)
+            if status == HALF_OPEN:
+                state.probing = True
+                self.stats['probes'] += 1
+                return True
+            return False
+
+    def _succeeded(self, host):
+        with self.lock:
+            state = self._hosts.pop(host, None)
+            if state is not None and state.opened_until is not None:
+                self.stats['recovered'] += 1
+
+    def _failed(self, host, error, probe):
+        with self.lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = HostState()
+                while len(self._hosts) > self.max_hosts:
+                    self._hosts.popitem(last=False)
+            self._hosts.move_to_end(host)
+            state.failures += 1
+            state.cause = error.__class__
+            if probe or state.failures >= self.threshold and state.opened_until is None:
+                state.opened_until = time.monotonic() + self.cooldown
+                self.stats['tripped'] += 1
+            state.probing = False
+
+    def _abandoned(self, host):
+        with self.lock:
+            state = self._hosts.get(host)
+            if state is not None:
+                state.probing = False
+
+    def send(self, outbound: requests.PreparedRequest, send) -> requests.Response:
+        """Send :param outbound: using :param send:, unless its host is tripped, in which case raise :class CircuitOpen:."""
+        if not self.enabled:
+            return send(outbound)
+
+        host = self.host_of(outbound)
+        probe = self._acquire(host)
+        try:
+            response = send(outbound)
+        except FAILURES as e:
+            self._failed(host, e, probe)
+            raise
+        except BaseException:
+            if probe:
+                self._abandoned(host)
+            raise
+        self._succeeded(host)
+        return response
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            hosts = {
+                host: {
+                    'state': state.status(now),
+                    'failures': state.failures,
+                    'cause': state.cause.__name__ if state.cause else None,
+                    'retry_in': max(0, round(state.opened_until - now, 1)) if state.opened_until is not None else None,
+                }
+                for host, state in self._hosts.items()
+            }
+            return {**self.stats, 'hosts': hosts}
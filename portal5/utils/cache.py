@@ -0,0 +1,643 @@
+# cache.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Shared HTTP cache (RFC 7234) for upstream responses.
+
+The cache stores remote responses *as received*, before any of the per-user
+rewriting done in :meth Portal5.process_response:, and hands out synthesized
+:class requests.Response: objects on hits, so that the same post-processing
+applies to cached and uncached responses alike.
+
+Entries live either in a bounded in-memory tier or, if a cache directory is
+configured, in an on-disk tier that is written to while the body is being
+streamed to the client. Disk entries are shared by worker processes using the
+same directory; size accounting for the disk tier is done per process.
+"""
+
+import calendar
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from werkzeug.datastructures import RequestCacheControl, ResponseCacheControl
+from werkzeug.http import parse_cache_control_header, parse_date, parse_etags, unquote_etag
+
+from .streaming import read_available
+
+CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+UNSAFE_METHODS = {'POST', 'PUT', 'DELETE', 'PATCH'}
+UNSTORED_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'set-cookie', 'age',
+}
+NOT_MODIFIED_HEADERS = (
+    'Cache-Control', 'Content-Location', 'Date', 'ETag', 'Expires', 'Last-Modified', 'Vary',
+)
+HEURISTIC_FRESHNESS_LIMIT = 86400
+STALE_TMP_AGE = 3600
+
+
+def _timestamp(value):
+    date = parse_date(value) if value else None
+    return calendar.timegm(date.utctimetuple()) if date else None
+
+
+def _int(value, default=None):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def _digest(*parts):
+    return hashlib.sha256('\n'.join(parts).encode('utf8')).hexdigest()
+
+
+def _url_of(key):
+    return key.partition('\n')[0]
+
+
+def _vary_of(key):
+    return tuple(line.partition(':')[0] for line in key.split('\n')[1:])
+
+
+class CacheEntry:
+    __slots__ = (
+        'key', 'url', 'status', 'reason', 'headers', 'shared',
+        'initial_age', 'response_time', 'lifetime', 'size', 'body', 'path',
+    )
+
+    def __init__(self, key, url, status, reason, headers, shared, size=0, body=None, path=None, **freshness):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.shared = shared
+        self.size = size
+        self.body = body
+        self.path = path
+        self.initial_age = freshness.get('initial_age', 0)
+        self.response_time = freshness.get('response_time', time.time())
+        self.lifetime = freshness.get('lifetime', 0)
+
+    @property
+    def cache_control(self) -> ResponseCacheControl:
+        return parse_cache_control_header(self.headers.get('Cache-Control'), cls=ResponseCacheControl)
+
+    def age(self, now=None):
+        return self.initial_age + ((now or time.time()) - self.response_time)
+
+    def is_fresh(self, request_cc: RequestCacheControl = None, now=None):
+        age = self.age(now)
+        lifetime = self.lifetime
+        if request_cc is not None:
+            max_age = _int(request_cc.get('max-age'))
+            if max_age is not None:
+                lifetime = min(lifetime, max_age)
+            min_fresh = _int(request_cc.get('min-fresh'))
+            if min_fresh:
+                age += min_fresh
+        return age < lifetime
+
+    @property
+    def validators(self):
+        validators = {}
+        if 'ETag' in self.headers:
+            validators['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            validators['If-Modified-Since'] = self.headers['Last-Modified']
+        return validators
+
+    def open(self):
+        if self.path:
+            return open(self.path, 'rb')
+        return io.BytesIO(self.body or b'')
+
+    def to_meta(self):
+        return {
+            'key': self.key, 'url': self.url,
+            'status': self.status, 'reason': self.reason,
+            'headers': dict(self.headers.items()), 'shared': self.shared,
+            'size': self.size, 'initial_age': self.initial_age,
+            'response_time': self.response_time, 'lifetime': self.lifetime,
+        }
+
+    @classmethod
+    def from_meta(cls, meta, path):
+        meta = {**meta, 'headers': CaseInsensitiveDict(meta['headers'])}
+        return cls(path=path, **meta)
+
+
+def freshness_info(headers, request_time, response_time):
+    """Compute the initial age and freshness lifetime of a response (RFC 7234 Section 4.2)."""
+    cc = parse_cache_control_header(headers.get('Cache-Control'), cls=ResponseCacheControl)
+    date = _timestamp(headers.get('Date')) or response_time
+
+    apparent_age = max(0, response_time - date)
+    response_delay = response_time - request_time
+    initial_age = max(apparent_age, _int(headers.get('Age'), 0) + response_delay)
+
+    lifetime = _int(cc.get('s-maxage'))
+    if lifetime is None:
+        lifetime = _int(cc.get('max-age'))
+    if lifetime is None and 'Expires' in headers:
+        expires = _timestamp(headers['Expires'])
+        lifetime = max(0, expires - date) if expires else 0
+    if lifetime is None:
+        last_modified = _timestamp(headers.get('Last-Modified'))
+        if last_modified and last_modified < date:
+            lifetime = min((date - last_modified) // 10, HEURISTIC_FRESHNESS_LIMIT)
+        else:
+            lifetime = 0
+    return {'initial_age': initial_age, 'response_time': response_time, 'lifetime': lifetime}
+
+
+class CacheTier:
+    """LRU collection of cache entries bounded by total body size.
+
+    The number of variants held per URL is counted, and :param released: is called with
+    a URL once the tier no longer holds any of its variants.
+    """
+
+    def __init__(self, capacity, max_entry_size, released=None):
+        self.capacity = capacity
+        self.max_entry_size = max_entry_size
+        self.released = released
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._urls = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def holds(self, url):
+        return url in self._urls
+
+    def put(self, entry: CacheEntry):
+        url = _url_of(entry.key)
+        self._urls[url] = self._urls.get(url, 0) + 1
+        self.pop(entry.key)
+        self._entries[entry.key] = entry
+        self.size += entry.size
+        while self.size > self.capacity and self._entries:
+            key, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+            self._drop(key)
+            self.dispose(evicted)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+            self._drop(key)
+        return entry
+
+    def _drop(self, key):
+        url = _url_of(key)
+        count = self._urls.pop(url) - 1
+        if count:
+            self._urls[url] = count
+        else:
+            self.release(url)
+
+    def release(self, url):
+        if self.released:
+            self.released(url)
+
+    def dispose(self, entry: CacheEntry):
+        pass
+
+
+class DiskTier(CacheTier):
+    """Cache tier that keeps entries in files, together with a `.vary` file per URL as long as it holds variants of it."""
+
+    def __init__(self, directory, capacity, max_entry_size, released=None):
+        super().__init__(capacity, max_entry_size, released)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.sweep()
+
+    def sweep(self):
+        """Remove temporary files left behind by writers that did not finish, e.g. killed workers."""
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for f in it:
+                try:
+                    if f.name.endswith('.tmp') and now - f.stat().st_mtime > STALE_TMP_AGE:
+                        os.unlink(f.path)
+                except OSError:
+                    pass
+
+    def path_to(self, name, ext):
+        return os.path.join(self.directory, f'{name}.{ext}')
+
+    def load(self, key):
+        name = _digest(key)
+        try:
+            with open(self.path_to(name, 'json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('key') != key or not os.path.exists(self.path_to(name, 'body')):
+            return None
+        entry = CacheEntry.from_meta(meta, self.path_to(name, 'body'))
+        CacheTier.put(self, entry)
+        return entry
+
+    def load_vary(self, url):
+        try:
+            with open(self.path_to(_digest(url), 'vary')) as f:
+                return tuple(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def save_vary(self, url, vary):
+        self._write_atomic(self.path_to(_digest(url), 'vary'), json.dumps(vary))
+
+    def discard_vary(self, url):
+        try:
+            os.unlink(self.path_to(_digest(url), 'vary'))
+        except OSError:
+            pass
+
+    def open_body(self):
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+
+    def put(self, entry: CacheEntry, tmp_path=None):
+        name = _digest(entry.key)
+        if tmp_path:
+            os.replace(tmp_path, self.path_to(name, 'body'))
+        entry.path = self.path_to(name, 'body')
+        self._write_atomic(self.path_to(name, 'json'), json.dumps(entry.to_meta()))
+        self.save_vary(_url_of(entry.key), _vary_of(entry.key))
+        super().put(entry)
+
+    def release(self, url):
+        self.discard_vary(url)
+        super().release(url)
+
+    def dispose(self, entry: CacheEntry):
+        name = _digest(entry.key)
+        for ext in ('json', 'body'):
+            try:
+                os.unlink(self.path_to(name, ext))
+            except OSError:
+                pass
+
+    def _write_atomic(self, path, content):
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+
+
+class EntryWriter:
+    """Accumulate a response body as it is streamed, spilling to the disk tier when it grows too large for memory."""
+
+    def __init__(self, cache, entry: CacheEntry, expected_size=None):
+        self.cache = cache
+        self.entry = entry
+        self.expected_size = expected_size
+        self.size = 0
+        self.buffer = bytearray()
+        self.file = None
+        self.done = False
+
+    def write(self, data):
+        if self.done:
+            return
+        self.size += len(data)
+        memory, disk = self.cache.memory, self.cache.disk
+        try:
+            if self.file is not None:
+                if self.size > disk.max_entry_size:
+                    return self.abort()
+                self.file.write(data)
+            elif self.size <= memory.max_entry_size:
+                self.buffer += data
+            elif disk is not None and self.size <= disk.max_entry_size:
+                self.file = disk.open_body()
+                self.file.write(self.buffer)
+                self.file.write(data)
+                self.buffer = None
+            else:
+                self.abort()
+        except OSError:
+            self.abort()
+
+    def commit(self):
+        if self.done:
+            return
+        if self.expected_size is not None and self.size != self.expected_size:
+            return self.abort()
+        self.done = True
+        self.entry.size = self.size
+        if self.file is not None:
+            self.file.close()
+            self.cache.store(self.entry, tmp_path=self.file.name)
+        else:
+            self.entry.body = bytes(self.buffer)
+            self.cache.store(self.entry)
+        self.buffer = self.file = None
+
+    def abort(self):
+        self.done = True
+        self.buffer = None
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.unlink(self.file.name)
+            except OSError:
+                pass
+            self.file = None
+
+
+class StoringReader:
+    """Wrap the raw stream of an upstream response, copying the body into the cache as it is read."""
+
+    def __init__(self, raw, writer: EntryWriter):
+        self._raw = raw
+        self._writer = writer
+
+    def read(self, amt=None):
+        return self._store(self._raw.read(amt))
+
+    def read1(self, amt=-1):
+        return self._store(read_available(self._raw, amt))
+
+    def _store(self, data):
+        if data:
+            self._writer.write(data)
+        else:
+            self._writer.commit()
+        return data
+
+    def close(self):
+        self._writer.abort()
+        return self._raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class ResponseCache:
+    DEFAULTS = {
+        'enabled': False,
+        'memory_size': 64 * 1024 * 1024,
+        'memory_max_entry': 1024 * 1024,
+        'disk_path': None,
+        'disk_size': 1024 * 1024 * 1024,
+        'disk_max_entry': 64 * 1024 * 1024,
+    }
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.memory = CacheTier(0, 0)
+        self.disk = None
+        self.stats = {k: 0 for k in ('hits', 'misses', 'revalidated', 'not_modified', 'stored', 'invalidated')}
+        self._vary = {}
+        self._lock = threading.RLock()
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = {**self.DEFAULTS, **app.config.get_namespace('UPSTREAM_CACHE_')}
+        self.enabled = bool(conf['enabled'])
+        self.memory = CacheTier(conf['memory_size'], conf['memory_max_entry'], released=self._release)
+        self.disk = None
+        if conf['disk_path']:
+            self.disk = DiskTier(conf['disk_path'], conf['disk_size'], conf['disk_max_entry'], released=self._release)
+
+    def _incr(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+    def _variant_key(self, url, vary, headers):
+        values = [f'{h}:{headers.get(h, "")}' for h in vary]
+        return '\n'.join([url, *values])
+
+    def _holds(self, url):
+        return self.memory.holds(url) or self.disk is not None and self.disk.holds(url)
+
+    def _release(self, url):
+        # The Vary of a URL is only remembered while some variant of it is cached
+        if not self._holds(url):
+            self._vary.pop(url, None)
+
+    def lookup(self, outbound: requests.PreparedRequest):
+        with self._lock:
+            vary = self._vary.get(outbound.url)
+            if vary is None and self.disk is not None:
+                vary = self.disk.load_vary(outbound.url)
+            if vary is None:
+                return None
+            key = self._variant_key(outbound.url, vary, outbound.headers)
+            entry = self.memory.get(key)
+            if entry is None and self.disk is not None:
+                entry = self.disk.get(key) or self.disk.load(key)
+            if entry is not None:
+                self._vary[outbound.url] = vary
+        if entry is None:
+            return None
+        if not entry.shared and ('Authorization' in outbound.headers or 'Cookie' in outbound.headers):
+            return None
+        return entry
+
+    def store(self, entry: CacheEntry, tmp_path=None):
+        url = _url_of(entry.key)
+        with self._lock:
+            # Put the entry in place before removing it from the other tier, so that the URL is not released in between
+            if tmp_path:
+                self.disk.put(entry, tmp_path)
+                self.memory.pop(entry.key)
+            else:
+                self.memory.put(entry)
+                if self.disk is not None:
+                    stale = self.disk.pop(entry.key)
+                    if stale is not None:
+                        self.disk.dispose(stale)
+            if self._holds(url):
+                self._vary[url] = _vary_of(entry.key)
+            self._incr('stored')
+
+    def invalidate(self, url):
+        with self._lock:
+            self._vary.pop(url, None)
+            if self.disk is not None:
+                self.disk.discard_vary(url)
+        self._incr('invalidated')
+
+    def is_storable(self, outbound: requests.PreparedRequest, remote: requests.Response):
+        if outbound.method != 'GET' or 'Range' in outbound.headers:
+            return False
+        if remote.status_code not in CACHEABLE_STATUSES:
+            return False
+        request_cc = parse_cache_control_header(outbound.headers.get('Cache-Control'), cls=RequestCacheControl)
+        cc = parse_cache_control_header(remote.headers.get('Cache-Control'), cls=ResponseCacheControl)
+        if request_cc.no_store or cc.no_store or cc.private is not None:
+            return False
+        if 'Set-Cookie' in remote.headers or remote.headers.get('Vary', '').strip() == '*':
+            return False
+        if 'Authorization' in outbound.headers and not (cc.public or cc.must_revalidate or 's-maxage' in cc):
+            return False
+        if 'Cookie' in outbound.headers and not (cc.public or 's-maxage' in cc):
+            return False
+        return bool(
+            'max-age' in cc or 's-maxage' in cc
+            or any(h in remote.headers for h in ('Expires', 'Last-Modified', 'ETag'))
+        )
+
+    def make_entry(self, outbound, remote, request_time, response_time):
+        vary = tuple(sorted({h.strip().title() for h in remote.headers.get('Vary', '').split(',') if h.strip()}))
+        cc = parse_cache_control_header(remote.headers.get('Cache-Control'), cls=ResponseCacheControl)
+        headers = CaseInsensitiveDict({k: v for k, v in remote.headers.items() if k.lower() not in UNSTORED_HEADERS})
+        return CacheEntry(
+            self._variant_key(outbound.url, vary, outbound.headers),
+            remote.url, remote.status_code, remote.reason, headers,
+            shared=bool(cc.public or 's-maxage' in cc),
+            **freshness_info(remote.headers, request_time, response_time),
+        )
+
+    def freshen(self, entry: CacheEntry, remote: requests.Response, request_time, response_time):
+        headers = CaseInsensitiveDict(entry.headers)
+        headers.update({k: v for k, v in remote.headers.items() if k.lower() not in UNSTORED_HEADERS | {'content-length'}})
+        entry.headers = headers
+        for k, v in freshness_info(headers, request_time, response_time).items():
+            setattr(entry, k, v)
+        with self._lock:
+            if self.disk is not None and entry.path:
+                self.disk.put(entry)
+
+    def respond(self, entry: CacheEntry, outbound: requests.PreparedRequest, status=None) -> requests.Response:
+        response = requests.Response()
+        response.url = entry.url
+        response.request = outbound
+        response.reason = entry.reason
+        headers = CaseInsensitiveDict(entry.headers)
+        headers['Age'] = str(int(entry.age()))
+        if status == 304:
+            response.status_code = 304
+            response.headers = CaseInsensitiveDict({k: headers[k] for k in (*NOT_MODIFIED_HEADERS, 'Age') if k in headers})
+            response.raw = io.BytesIO(b'')
+        else:
+            response.status_code = entry.status
+            response.headers = headers
+            response.raw = entry.open()
+        return response
+
+    def client_has_current(self, entry: CacheEntry, outbound: requests.PreparedRequest):
+        if entry.status != 200:
+            return False
+        if_none_match = outbound.headers.get('If-None-Match')
+        if if_none_match:
+            etag = entry.headers.get('ETag')
+            if not etag:
+                return False
+            return parse_etags(if_none_match).contains_weak(unquote_etag(etag)[0])
+        if_modified_since = _timestamp(outbound.headers.get('If-Modified-Since'))
+        last_modified = _timestamp(entry.headers.get('Last-Modified'))
+        return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+    def send(self, outbound: requests.PreparedRequest, send) -> requests.Response:
+        """Answer :param outbound: from the cache if possible, otherwise send it upstream using :param send:.
+
+        Cacheable responses are stored while their bodies are being read.
+        """
+        if outbound.method in UNSAFE_METHODS:
+            remote = send(outbound)
+            if remote.status_code < 400:
+                self.invalidate(outbound.url)
+            return remote
+        if outbound.method != 'GET':
+            return send(outbound)
+
+        request_cc = parse_cache_control_header(outbound.headers.get('Cache-Control'), cls=RequestCacheControl)
+        no_cache = request_cc.no_cache is not None or outbound.headers.get('Pragma') == 'no-cache'
+
+        entry = self.lookup(outbound)
+        if entry is not None and not no_cache and not entry.cache_control.no_cache and entry.is_fresh(request_cc):
+            if self.client_has_current(entry, outbound):
+                self._incr('not_modified')
+                return self.respond(entry, outbound, 304)
+            self._incr('hits')
+            return self.respond(entry, outbound)
+
+        if entry is None and request_cc.only_if_cached:
+            response = requests.Response()
+            response.status_code = 504
+            response.url = outbound.url
+            response.request = outbound
+            response.raw = io.BytesIO(b'')
+            return response
+
+        self._incr('misses')
+        validators = entry.validators if entry is not None else {}
+        upstream_request = outbound
+        if validators:
+            upstream_request = outbound.copy()
+            for k in ('If-None-Match', 'If-Modified-Since'):
+                upstream_request.headers.pop(k, None)
+            upstream_request.headers.update(validators)
+
+        request_time = time.time()
+        remote = send(upstream_request)
+        response_time = time.time()
+
+        if validators and remote.status_code == 304:
+            remote.close()
+            self.freshen(entry, remote, request_time, response_time)
+            self._incr('revalidated')
+            if self.client_has_current(entry, outbound):
+                self._incr('not_modified')
+                return self.respond(entry, outbound, 304)
+            return self.respond(entry, outbound)
+
+        if not self.is_storable(outbound, remote):
+            if entry is not None:
+                self.invalidate(outbound.url)
+            return remote
+
+        entry = self.make_entry(outbound, remote, request_time, response_time)
+        expected_size = _int(remote.headers.get('Content-Length'))
+        remote.raw = StoringReader(remote.raw, EntryWriter(self, entry, expected_size))
+        return remote
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                **self.stats,
+                'memory': {'entries': len(self.memory), 'size': self.memory.size, 'evictions': self.memory.evictions},
+            }
+            if self.disk is not None:
+                stats['disk'] = {'entries': len(self.disk), 'size': self.disk.size, 'evictions': self.disk.evictions}
+        return stats
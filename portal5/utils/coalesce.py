@@ -0,0 +1,326 @@
+# coalesce.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Single-flight coalescing of identical concurrent upstream requests.
+
+The first request for a given key (the leader) is sent upstream; identical
+requests arriving while it is in flight (followers) wait for its response and,
+if the response may be shared, read the same body through a bounded fan-out
+buffer instead of contacting the remote server themselves.
+
+Whichever reader is furthest ahead pulls the next chunk from upstream. If the
+buffer grows past its limit because some reader is lagging, the reader pulling
+data waits for the slowest readers to make progress, and cuts them off if they
+stall for longer than the configured timeout. Followers also wait at most that
+long for the leader's response, then send their request themselves.
+"""
+
+import copy
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import parse_cache_control_header
+
+from .streaming import MIN_CHUNK_SIZE, read_available
+
+CONDITIONAL_HEADERS = ('Cache-Control', 'Pragma', 'If-None-Match', 'If-Modified-Since')
+
+
+class FlightAborted(requests.exceptions.ChunkedEncodingError):
+    pass
+
+
+def relay_error(error: BaseException) -> BaseException:
+    """Return a copy of the leader's :param error: for a follower to raise, so that the shared one is not raised again."""
+    try:
+        return copy.copy(error)
+    except Exception:
+        return FlightAborted(f'Coalesced request failed: {error!r}')
+
+
+class FlightReader:
+    __slots__ = ('_flight',)
+
+    def __init__(self, flight):
+        self._flight = flight
+
+    def read(self, amt=None):
+        return self._flight.read(self, amt)
+
+    read1 = read
+
+    def close(self):
+        self._flight.detach(self)
+
+    @property
+    def closed(self):
+        return self not in self._flight.positions
+
+
+class Flight:
+    def __init__(self, coalescer, key):
+        self.coalescer = coalescer
+        self.key = key
+        self.cond = threading.Condition(coalescer.lock)
+        self.response = None
+        self.error = None
+        self.ready = False
+        self.shareable = False
+        self.positions = {}
+        self._raw = None
+        self._chunks = []
+        self._base = 0
+        self._buffered = 0
+        self._eof = False
+        self._pumping = False
+
+    @property
+    def joinable(self):
+        return not self.ready or self.shareable and self._base == 0 and self._raw is not None
+
+    def attach(self):
+        reader = FlightReader(self)
+        self.positions[reader] = [self._base, 0]
+        return reader
+
+    def publish(self, response: requests.Response, shareable):
+        with self.cond:
+            self.response = response
+            self.shareable = shareable
+            self.ready = True
+            if shareable:
+                self._raw = response.raw
+                response.raw = self.attach()
+            else:
+                self.positions.clear()
+                self.coalescer.retire(self)
+            self.cond.notify_all()
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.ready = True
+            self.positions.clear()
+            self.coalescer.retire(self)
+            self.cond.notify_all()
+
+    def wait(self, timeout=None) -> bool:
+        with self.cond:
+            return self.cond.wait_for(lambda: self.ready, timeout)
+
+    def read(self, reader, amt=None):
+        limit = self.coalescer.buffer_size
+        while True:
+            with self.cond:
+                while True:
+                    position = self.positions.get(reader)
+                    if position is None:
+                        raise FlightAborted('Reader fell too far behind the upstream response and was cut off')
+                    index, offset = position
+                    if index < self._base + len(self._chunks):
+                        return self._consume(reader, position, amt)
+                    if self._eof:
+                        return b''
+                    if not self._pumping:
+                        if self._buffered >= limit:
+                            self._wait_for_laggards()
+                            continue
+                        self._pumping = True
+                        break
+                    self.cond.wait()
+
+            try:
+                data = read_available(self._raw, amt if amt and amt > 0 else MIN_CHUNK_SIZE)
+            except BaseException:
+                with self.cond:
+                    self._pumping = False
+                    self._eof = True
+                    self.positions.clear()
+                    self.coalescer.retire(self)
+                    self.cond.notify_all()
+                raise
+
+            with self.cond:
+                self._pumping = False
+                if data:
+                    self._chunks.append(data)
+                    self._buffered += len(data)
+                else:
+                    self._eof = True
+                self.cond.notify_all()
+
+    def _consume(self, reader, position, amt):
+        index, offset = position
+        chunk = self._chunks[index - self._base]
+        if amt and amt > 0 and len(chunk) - offset > amt:
+            position[1] = offset + amt
+            return chunk[offset:offset + amt]
+        position[0] = index + 1
+        position[1] = 0
+        self._trim()
+        return chunk[offset:] if offset else chunk
+
+    def _wait_for_laggards(self):
+        slowest = min(p[0] for p in self.positions.values())
+        if self.cond.wait_for(lambda: min(p[0] for p in self.positions.values()) > slowest, self.coalescer.timeout):
+            return
+        for reader, position in list(self.positions.items()):
+            if position[0] == slowest:
+                del self.positions[reader]
+                self.coalescer.incr('cut_off')
+        self._trim()
+
+    def _trim(self):
+        if not self.positions:
+            return
+        slowest = min(p[0] for p in self.positions.values())
+        while self._chunks and self._base < slowest:
+            self._buffered -= len(self._chunks.pop(0))
+            self._base += 1
+        if self._base:
+            self.coalescer.retire(self)
+
+    def detach(self, reader):
+        with self.cond:
+            self.positions.pop(reader, None)
+            if self.positions:
+                self._trim()
+                self.cond.notify_all()
+                return
+            self.coalescer.retire(self)
+            raw, self._raw = self._raw, None
+            self._chunks = []
+            self._buffered = 0
+        if raw is not None and not self._eof:
+            raw.close()
+            release_conn = getattr(raw, 'release_conn', None)
+            if release_conn:
+                release_conn()
+
+
+class Coalescer:
+    DEFAULTS = {
+        'enabled': True,
+        'buffer_size': 4 * 1024 * 1024,
+        'timeout': 10,
+        'vary': ('Accept', 'Accept-Encoding', 'Accept-Language', 'Origin', 'User-Agent'),
+    }
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.buffer_size = self.DEFAULTS['buffer_size']
+        self.timeout = self.DEFAULTS['timeout']
+        self.vary = self.DEFAULTS['vary']
+        self.stats = {k: 0 for k in ('leaders', 'coalesced', 'detached', 'cut_off', 'timed_out')}
+        self._flights = {}
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = {**self.DEFAULTS, **app.config.get_namespace('UPSTREAM_COALESCE_')}
+        self.enabled = bool(conf['enabled'])
+        self.buffer_size = conf['buffer_size']
+        self.timeout = conf['timeout']
+        self.vary = tuple(conf['vary'])
+
+    def incr(self, counter, value=1):
+        self.stats[counter] += value
+
+    def retire(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def is_eligible(self, outbound: requests.PreparedRequest, cache_enabled=False):
+        if outbound.method != 'GET' or outbound.body is not None:
+            return False
+        headers = outbound.headers
+        if 'Range' in headers or 'Authorization' in headers:
+            return False
+        return cache_enabled or 'Cookie' not in headers
+
+    def is_shareable(self, outbound: requests.PreparedRequest, remote: requests.Response):
+        if 'Set-Cookie' in remote.headers:
+            return False
+        cc = parse_cache_control_header(remote.headers.get('Cache-Control'), cls=ResponseCacheControl)
+        if cc.private is not None:
+            return False
+        if 'Cookie' in outbound.headers:
+            return bool(cc.public or 's-maxage' in cc) and not cc.no_store
+        return True
+
+    def make_key(self, outbound: requests.PreparedRequest):
+        headers = outbound.headers
+        return (
+            outbound.method, outbound.url, 'Cookie' in headers,
+            *(headers.get(h) for h in self.vary),
+            *(headers.get(h) for h in CONDITIONAL_HEADERS),
+        )
+
+    def send(self, outbound: requests.PreparedRequest, send, cache_enabled=False) -> requests.Response:
+        """Send :param outbound: using :param send:, or share the response of an identical request already in flight."""
+        if not self.is_eligible(outbound, cache_enabled):
+            return send(outbound)
+
+        key = self.make_key(outbound)
+        with self.lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.joinable:
+                reader = flight.attach()
+            else:
+                flight = self._flights[key] = Flight(self, key)
+                reader = None
+                self.incr('leaders')
+
+        if reader is None:
+            try:
+                remote = send(outbound)
+            except BaseException as e:
+                flight.fail(e)
+                raise
+            flight.publish(remote, self.is_shareable(outbound, remote))
+            return remote
+
+        if not flight.wait(self.timeout):
+            with self.lock:
+                flight.positions.pop(reader, None)
+                self.incr('timed_out')
+            return send(outbound)
+        if flight.error is not None:
+            raise relay_error(flight.error) from flight.error
+        if not flight.shareable or reader.closed:
+            with self.lock:
+                self.incr('detached')
+            return send(outbound)
+
+        with self.lock:
+            self.incr('coalesced')
+        remote = flight.response
+        response = requests.Response()
+        response.status_code = remote.status_code
+        response.reason = remote.reason
+        response.headers = CaseInsensitiveDict(remote.headers)
+        response.url = remote.url
+        response.encoding = remote.encoding
+        response.elapsed = remote.elapsed
+        response.request = outbound
+        response.raw = reader
+        return response
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'in_flight': len(self._flights)}
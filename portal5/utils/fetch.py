@@ -14,18 +14,44 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
 from operator import attrgetter
 from textwrap import dedent
 from typing import Tuple
-from urllib.parse import SplitResult, urljoin, urlsplit
+from urllib.parse import SplitResult, urljoin
 
 import requests
-from flask import Request, Response, abort, stream_with_context
+from flask import Request, Response, abort, request, stream_with_context
 from flask_babel import _
 from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.wsgi import wrap_file
 from werkzeug.wrappers.response import Response as BaseResponse
 
 from .. import exceptions
+from . import streaming
+from .breaker import CircuitBreaker, CircuitOpen
+from .cache import ResponseCache
+from .coalesce import Coalescer
+from .probe import Prober
+from .redirects import RedirectFollower
+from .upstream import UpstreamClient
+from .urls import URLContext, split_url
+
+upstream = UpstreamClient()
+breaker = CircuitBreaker()
+response_cache = ResponseCache()
+coalescer = Coalescer()
+prober = Prober()
+redirects = RedirectFollower()
+
+
+def setup_upstream(app):
+    upstream.init_app(app)
+    breaker.init_app(app)
+    response_cache.init_app(app)
+    coalescer.init_app(app)
+    prober.init_app(app)
+    redirects.init_app(app)
 
 
 def extract_request_info(request: Request):
@@ -40,13 +66,14 @@ def stream_request_body(request: Request):
     return request.stream if request.content_length else None
 
 
+@lru_cache(maxsize=1024)
 def normalize_url(url, origin_override=None) -> SplitResult:
-    url_parts = urlsplit(url)
+    url_parts = split_url(url)
     scheme = url_parts.scheme
     domain = url_parts.netloc
     path = url_parts.path
     if origin_override:
-        origin_override = urlsplit(origin_override)
+        origin_override = split_url(origin_override)
         scheme = origin_override.scheme
         domain = origin_override.netloc
     if not domain:
@@ -82,21 +109,64 @@ def prepare_request(url, *, method='GET', filters=None, **requests_kwargs) -> re
 
 
 def _pipe(response: requests.Response):
-    while True:
-        chunk = response.raw.read(1024)
-        if not chunk:
-            break
-        yield chunk
+    try:
+        yield from streaming.iter_raw(response.raw)
+    finally:
+        response.close()
 
 
-def pipe_request(outbound: requests.PreparedRequest) -> Tuple[requests.Response, Response]:
-    try:
-        remote_response = requests.session().send(outbound, allow_redirects=False, stream=True)
+def _send_upstream(outbound: requests.PreparedRequest) -> requests.Response:
+    return breaker.send(outbound, upstream.send)
+
+
+def _send_cached(outbound: requests.PreparedRequest) -> requests.Response:
+    return response_cache.send(outbound, _send_upstream)
+
+
+def _send_probe(outbound: requests.PreparedRequest, **kwargs) -> requests.Response:
+    # Probes have a short deadline; their timeouts must not trip the breaker for real traffic
+    return upstream.send(outbound, **kwargs)
+
+
+def probe_urls(urls):
+    return prober.probe(urls, _send_probe)
+
+
+def _send_coalesced(outbound: requests.PreparedRequest) -> requests.Response:
+    send = _send_cached if response_cache.enabled else _send_upstream
+    if coalescer.enabled:
+        return coalescer.send(outbound, send, cache_enabled=response_cache.enabled)
+    return send(outbound)
 
-        flask_response = Response(
-            stream_with_context(_pipe(remote_response)),
-            status=remote_response.status_code,
-        )
+
+def send_request(outbound: requests.PreparedRequest, follow_redirects=None) -> requests.Response:
+    """Send :param outbound: upstream.
+
+    :param follow_redirects: If not None, a predicate deciding whether a redirected request may be sent;
+        safe redirects will then be followed on the server (if enabled), and the final response returned
+    """
+    if follow_redirects is not None:
+        return redirects.send(outbound, _send_coalesced, allow=follow_redirects)
+    return _send_coalesced(outbound)
+
+
+def pipe_request(outbound: requests.PreparedRequest, follow_redirects=None) -> Tuple[requests.Response, Response]:
+    try:
+        remote_response = send_request(outbound, follow_redirects)
+
+        body = streaming.file_source(remote_response.raw)
+        if body is not None:
+            flask_response = Response(
+                wrap_file(request.environ, body, streaming.MAX_CHUNK_SIZE),
+                status=remote_response.status_code,
+                direct_passthrough=True,
+            )
+        else:
+            flask_response = Response(
+                stream_with_context(_pipe(remote_response)),
+                status=remote_response.status_code,
+            )
+        flask_response.call_on_close(remote_response.close)
         return remote_response, flask_response
 
     # except Exception as e:
@@ -107,9 +177,12 @@ def pipe_request(outbound: requests.PreparedRequest) -> Tuple[requests.Response,
         return abort(int(e.response.status_code), _('Got HTTP %(code)d while accessing <code>%(url)s</code>', code=e.response.status_code, url=outbound.url))
     except requests.exceptions.TooManyRedirects:
         return abort(400, _('Unable to access <code>%(url)s</code><br/>Too many redirects.', url=outbound.url))
-    except requests.exceptions.SSLError:
-        return abort(502, _('Unable to access <code>%(url)s</code><br/>An TLS/SSL error occured, remote server may not support HTTPS.', url=outbound.url))
-    except requests.ConnectionError:
+    except (requests.ConnectionError, requests.Timeout) as e:
+        cause = e.cause if isinstance(e, CircuitOpen) else e.__class__
+        if issubclass(cause, requests.exceptions.SSLError):
+            return abort(502, _('Unable to access <code>%(url)s</code><br/>An TLS/SSL error occured, remote server may not support HTTPS.', url=outbound.url))
+        if issubclass(cause, requests.Timeout):
+            return abort(504, _('Unable to access <code>%(url)s</code><br/>Remote server took too long to respond.', url=outbound.url))
         return abort(502, _('Unable to access <code>%(url)s</code><br/>Resource may not exist, or be available to the server, or outgoing traffic at the server may be disrupted.', url=outbound.url))
     except Exception as e:
         return abort(500, dedent(_("""
@@ -119,25 +192,26 @@ def pipe_request(outbound: requests.PreparedRequest) -> Tuple[requests.Response,
         """, url=outbound.url, error=e.__class__.__name__)))
 
 
-def copy_headers(remote: requests.Response, response: Response, *, server_map, **kwargs) -> Headers:
-    server_origin = server_map['origins']['main']
-    remote_url: SplitResult = urlsplit(remote.url)
+def rewrite_location(location, remote_url, server_origin):
+    return f'{server_origin}/{urljoin(remote_url, location)}'
+
+
+def copy_headers(remote: requests.Response, response: Response, *, url_context: URLContext, **kwargs) -> Headers:
     headers = Headers(remote.headers.items())
 
     headers.pop('Set-Cookie', None)
     headers.pop('Transfer-Encoding', None)
-    response.headers = headers
 
     if 'Location' in headers:
-        headers['Location'] = f'{server_origin}/{urljoin(remote_url.geturl(), headers["Location"])}'
+        headers['Location'] = rewrite_location(headers['Location'], remote.url, url_context.server_origin)
 
-    response.headers.update(headers)
+    response.headers = headers
     return headers
 
 
-def copy_cookies(remote: requests.Response, response: Response, *, server_map, **kwargs) -> list:
-    server_domain = server_map['domains']['main']
-    remote_url: SplitResult = urlsplit(remote.url)
+def copy_cookies(remote: requests.Response, response: Response, *, url_context: URLContext, **kwargs) -> list:
+    server_domain = url_context.server_domain
+    remote_url: SplitResult = url_context.remote
     cookie_jar = remote.cookies
 
     cookies = []
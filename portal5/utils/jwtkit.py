@@ -14,18 +14,72 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import hmac
+import itertools
 import json
+import os
+import threading
 import time
-import uuid
+from collections import OrderedDict
 from collections.abc import Hashable, Mapping, MutableSet
-from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Dict, List
 
 import jwt
-from flask import Flask, _app_ctx_stack, current_app
+from flask import Flask, _request_ctx_stack, current_app
+from jwt import InvalidTokenError
+from jwt.utils import base64url_encode
 from pytz import UTC
 
+from . import sessions
+
+HMAC_DIGESTS = {
+    'HS256': hashlib.sha256,
+    'HS384': hashlib.sha384,
+    'HS512': hashlib.sha512,
+}
+
+
+def json_default(o):
+    if isinstance(o, datetime):
+        return int(o.timestamp())
+    if isinstance(o, timedelta):
+        return int((datetime.now(tz=UTC) + o).timestamp())
+    return str(o)
+
+
+json_encoder = json.JSONEncoder(separators=(',', ':'), default=json_default)
+
+
+def encode_segment(obj) -> bytes:
+    return base64url_encode(json_encoder.encode(obj).encode())
+
+
+class TokenIDs:
+    """Unique token identifiers: 16 hex digits, a random prefix per process and a counter."""
+
+    COUNTER_LIMIT = 1 << 24
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._prefix = None
+        self._counter = None
+
+    def __call__(self):
+        pid = os.getpid()
+        with self._lock:
+            count = next(self._counter) if pid == self._pid else self.COUNTER_LIMIT
+            if count >= self.COUNTER_LIMIT:
+                # Regenerated in forked workers, and when the counter runs out
+                self._pid = pid
+                self._prefix = os.urandom(5).hex()
+                self._counter = itertools.count()
+                count = next(self._counter)
+            prefix = self._prefix
+        return f'{prefix}{count:06x}'
+
 
 class JWTKit:
     JWT_OPTIONS = {k: True for k in {
@@ -37,16 +91,28 @@ class JWTKit:
         'verify_signature',
     }}
 
+    VERIFIED_CACHE_SIZE = 1024
+
     def __init__(self, app=None, algorithm='HS256'):
         self._algorithm = algorithm
+        self._header = encode_segment({'typ': 'JWT', 'alg': algorithm})
+        self._hmac_digest = HMAC_DIGESTS.get(algorithm)
+        self._next_jti = TokenIDs()
         self._key = None
+        self._key_bytes = b''
+        self._digest_key = b''
         self._claims = {}
+        self._lock = threading.Lock()
+        self._verified = OrderedDict()
+        self._verified_size = self.VERIFIED_CACHE_SIZE
+        self.stats = {k: 0 for k in ('hits', 'misses', 'expired')}
         if app:
             self.init_app(app)
 
     def init_app(self, app: Flask):
         conf = app.config.get_namespace('JWT_')
-        self._key = conf.get('secret_key', None)
+        self._verified_size = conf.get('verified_cache_size', self.VERIFIED_CACHE_SIZE)
+        self.key = conf.get('secret_key', None)
 
         default_claims = app.config.get_namespace('JWT_DEFAULT_')
         self._claims.update(default_claims)
@@ -59,10 +125,6 @@ class JWTKit:
             self._claims['iss'] = iss
             self._claims['aud'] = iss
 
-        @app.before_request
-        def create_store():
-            _app_ctx_stack.top.jwtstore = JWTStore()
-
         if not hasattr(app, 'extensions'):
             app.extensions = {}
         app.extensions['jwtkit'] = self
@@ -74,6 +136,15 @@ class JWTKit:
             raise ValueError('JWTKit has not been initialized with a key')
         return key
 
+    @key.setter
+    def key(self, key):
+        # Verified tokens are keyed by an HMAC under the signing key, and forgotten when it changes
+        self._key = key
+        self._key_bytes = key.encode('utf8') if key else b''
+        self._digest_key = hashlib.sha256(self._key_bytes).digest() if key else b''
+        with self._lock:
+            self._verified.clear()
+
     @classmethod
     def _resolve_time(cls, value, base=None):
         base = base or datetime.now(tz=UTC)
@@ -83,69 +154,170 @@ class JWTKit:
             return datetime.fromtimestamp(value, tz=UTC)
         return value
 
-    @contextmanager
-    def encoder_context(self, **kwargs):
-        _app_ctx_stack.top.jwt_context = kwargs
-        try:
-            yield
-        finally:
-            _app_ctx_stack.top.jwt_context = None
-
-    def get_from_context(self, key):
-        ctx = getattr(_app_ctx_stack.top, 'jwt_context', None)
-        if not ctx:
-            raise ValueError('Working outside of encoder context')
-        return ctx.get(key, None)
-
-    def _json_encoder_default(self, o):
-        if isinstance(o, datetime):
-            return int(o.timestamp())
-        if isinstance(o, timedelta):
-            iat = self.get_from_context('iat')
-            return int((iat + o).timestamp())
-        return str(o)
-
     def create_token(self, sub=None, aud=None, nbf=None, exp=None, **claims):
+        return self.encode_token(self.make_claims(sub, aud, nbf, exp, **claims))
+
+    def make_claims(self, sub=None, aud=None, nbf=None, exp=None, **claims) -> dict:
+        """Return the payload of a new token, with private :param claims: under the audience."""
         iat = datetime.now(tz=UTC)
         aud = aud or self._aud
-        jti = str(uuid.uuid4())
+        jti = self._next_jti()
 
         if nbf:
-            nbf = self._resolve_time(nbf, iat)
+            nbf = json_default(self._resolve_time(nbf, iat))
         if exp:
-            exp = self._resolve_time(exp, iat)
+            exp = json_default(self._resolve_time(exp, iat))
+        iat_ts = int(iat.timestamp())
 
         payload = {k: v for k, v in {
             **self._claims,
-            'iat': iat,
-            'nbf': nbf or iat,
+            'iat': iat_ts,
+            'nbf': nbf or iat_ts,
             'exp': exp,
             'sub': sub,
             'aud': aud,
             'jti': jti,
         }.items() if v}
-
-        with self.encoder_context(iat=iat):
-            payload[aud] = json.loads(json.dumps(claims, ensure_ascii=False, default=self._json_encoder_default))
-
-        return self.encode_token(payload)
+        payload[aud] = {k: json_default(iat + v) if isinstance(v, timedelta) else v for k, v in claims.items()}
+        return payload
 
     def encode_token(self, token):
-        return jwt.encode(token, self.key, self._algorithm).decode('utf8')
+        """Encode and sign :param token:.
+
+        HMAC-signed tokens are assembled here, with the constant header segment encoded once
+        and the claims serialized in a single pass; they verify with PyJWT like jwt.encode's.
+        """
+        if not self._hmac_digest:
+            return jwt.encode(json.loads(json_encoder.encode(token)), self.key, self._algorithm).decode('utf8')
+        signing_input = b'.'.join((self._header, encode_segment(token)))
+        signature = hmac.new(self._key_bytes or self.key.encode('utf8'), signing_input, self._hmac_digest).digest()
+        return b'.'.join((signing_input, base64url_encode(signature))).decode('utf8')
+
+    def encode_tokens(self, payloads) -> str:
+        """Encode :param payloads: into one space-separated value.
+
+        Payloads that fit are packed into compact session tokens, one per subject and worker version;
+        the others are encoded as JWTs. The order in which they are decoded is kept.
+        """
+        key = self._key_bytes or self.key.encode('utf8')
+        encoded = []
+        groups = {}
+        for payload in payloads:
+            session = sessions.session_of(payload, self._iss, self._aud)
+            if session is None:
+                encoded.append(self.encode_token(payload))
+                continue
+            grants = groups.get(session)
+            if grants is None or len(grants) == sessions.MAX_GRANTS:
+                grants = groups[session] = []
+                encoded.append(grants)
+            grants.append(payload)
+        return ' '.join([t if isinstance(t, str) else sessions.encode(t, key, self._aud) for t in encoded])
+
+    def decode_tokens(self, value, **kwargs):
+        """Decode the space-separated JWTs and session tokens in :param value: into the token store.
+
+        Tokens that fail to verify are skipped.
+        """
+        for token in value.split(' '):
+            token = token.strip()
+            if not token:
+                continue
+            try:
+                if token.startswith(sessions.PREFIX):
+                    self.decode_session(token, **kwargs)
+                else:
+                    self.decode_token(token, **kwargs)
+            except InvalidTokenError:
+                pass
+
+    def decode_session(self, token, iss=None, aud=None, allow_expired=False, leeway=0, **kwargs) -> List[dict]:
+        """Verify the session token :param token:, and add its grants that are currently valid to the token store.
+
+        Like JWTs, grants must be unexpired and have an expiration, unless :param allow_expired:.
+        """
+        iss = iss or self._iss
+        aud = aud or self._aud
+        cache_key = self._verified_key(token, sessions.PREFIX, iss, aud)
+        verified = self._lookup_verified(cache_key, False, 0)
+        if verified is None:
+            payloads = sessions.decode(token, self._key_bytes or self.key.encode('utf8'), iss, aud)
+            verified = tuple((payload, JWTStore.collect_claims(payload)) for payload in payloads)
+            self._remember_verified(cache_key, verified)
+
+        now = int(time.time())
+        valid = []
+        for payload, claims in verified:
+            if payload['nbf'] > now + leeway:
+                continue
+            if not allow_expired and ('exp' not in payload or now > payload['exp'] + leeway):
+                continue
+            self.add(payload, claims)
+            valid.append(payload)
+        return valid
 
     def decode_token(self, token, iss=None, aud=None, allow_expired=False, leeway=0, **kwargs):
+        """Verify and decode :param token:, and add it to the token store of the current request.
+
+        Verified payloads are cached, so the returned dict must be treated as read-only.
+        """
         iss = iss or self._iss
         aud = aud or self._aud
         exp = not allow_expired
-        options = {**self.JWT_OPTIONS, **kwargs, 'require_exp': exp, 'verify_exp': exp}
-        payload = jwt.decode(
-            token, self.key, self._algorithm,
-            options=options, audience=aud, issuer=iss, leeway=leeway,
-        )
-        payload[aud] = payload.get(aud, {})
-        self.add(payload)
+        cache_key = self._verified_key(token, iss, aud, exp, leeway, tuple(sorted(kwargs.items())))
+        verified = self._lookup_verified(cache_key, exp, leeway)
+        if verified is None:
+            options = {**self.JWT_OPTIONS, **kwargs, 'require_exp': exp, 'verify_exp': exp}
+            payload = jwt.decode(
+                token, self.key, self._algorithm,
+                options=options, audience=aud, issuer=iss, leeway=leeway,
+            )
+            payload[aud] = payload.get(aud, {})
+            verified = (payload, JWTStore.collect_claims(payload))
+            self._remember_verified(cache_key, verified)
+        payload, claims = verified
+        self.add(payload, claims)
         return payload
 
+    def _verified_key(self, token, *params):
+        try:
+            hash(params)
+            token = token.encode() if isinstance(token, str) else bytes(token)
+        except TypeError:
+            return None
+        digest = hashlib.blake2b(token, digest_size=20, key=self._digest_key).digest()
+        return (digest, *params)
+
+    def _lookup_verified(self, cache_key, exp, leeway):
+        if cache_key is None:
+            return None
+        with self._lock:
+            verified = self._verified.get(cache_key)
+            if verified is None:
+                self.stats['misses'] += 1
+                return None
+            # Only expiration can change since the token was verified; same check as PyJWT's
+            expires = verified[0].get('exp') if exp else None
+            if expires is not None and int(time.time()) > expires + leeway:
+                del self._verified[cache_key]
+                self.stats['expired'] += 1
+                return None
+            self._verified.move_to_end(cache_key)
+            self.stats['hits'] += 1
+            return verified
+
+    def _remember_verified(self, cache_key, verified):
+        if cache_key is None or not self._verified_size:
+            return
+        with self._lock:
+            self._verified[cache_key] = verified
+            while len(self._verified) > self._verified_size:
+                self._verified.popitem(last=False)
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, 'entries': len(self._verified)}
+
     @classmethod
     def get_jwtkit(cls):
         jwtkit: cls = current_app.extensions.get('jwtkit')
@@ -153,14 +325,28 @@ class JWTKit:
             raise AttributeError('No JWTKit instance found in current app context')
         return jwtkit
 
-    def add(self, jwt=None):
-        _app_ctx_stack.top.jwtstore.add(jwt)
+    def add(self, jwt=None, claims=None):
+        get_jwtstore().add(jwt, claims)
+
+
+RESERVED_CLAIMS = frozenset({'iss', 'sub', 'aud', 'iat', 'nbf', 'exp'})
 
 
 class JWTStore(MutableSet):
+    """The tokens of the current request, queryable by claims.
+
+    Claims are indexed on the first query that needs an index, and only for the keys
+    that were queried. Small stores are scanned instead.
+    """
+    __slots__ = ('_tokens', '_indices')
+
+    SCAN_LIMIT = 3
+
     def __init__(self):
+        # jti hash -> (token, indexable claims or None until needed)
         self._tokens = {}
-        self._indices = {}
+        # claim key -> {value: {jti hash: True}}
+        self._indices = None
 
     def __contains__(self, token):
         try:
@@ -173,7 +359,7 @@ class JWTStore(MutableSet):
             return False
 
     def __iter__(self):
-        return iter(self._tokens.values())
+        return (token for token, _ in self._tokens.values())
 
     def __len__(self):
         return len(self._tokens)
@@ -185,33 +371,50 @@ class JWTStore(MutableSet):
             raise ValueError('Token does not contain a valid "jti" claim')
         return token['jti']
 
-    def _collect_key_value_pairs(self, token):
-        reserved_claims = {'iss', 'sub', 'aud', 'iat', 'nbf', 'exp'} & token.keys()
-        reserved_claims = {(k, token[k]) for k in reserved_claims}
-
-        private_claims = set()
+    @staticmethod
+    def collect_claims(token) -> dict:
+        """Return the claims of :param token: that can be queried, with private claims prefixed with `_`."""
+        claims = {k: token[k] for k in RESERVED_CLAIMS & token.keys() if isinstance(token[k], Hashable)}
         aud = token.get('aud')
         if aud:
-            claims = token.get(aud, {})
-            if isinstance(claims, Mapping):
-                private_claims = {(f'_{k}', v) for k, v in claims.items() if isinstance(v, Hashable)}
-
-        return reserved_claims | private_claims
-
-    def add(self, token):
+            private_claims = token.get(aud, {})
+            if isinstance(private_claims, Mapping):
+                claims.update({f'_{k}': v for k, v in private_claims.items() if isinstance(v, Hashable)})
+        return claims
+
+    def _claims_of(self, jti_hash):
+        token, claims = self._tokens[jti_hash]
+        if claims is None:
+            claims = self.collect_claims(token)
+            self._tokens[jti_hash] = (token, claims)
+        return claims
+
+    def _index(self, index, key, jti_hash):
+        claims = self._claims_of(jti_hash)
+        if key in claims:
+            index.setdefault(claims[key], {})[jti_hash] = True
+
+    def _get_index(self, key):
+        if self._indices is None:
+            self._indices = {}
+        index = self._indices.get(key)
+        if index is None:
+            index = self._indices[key] = {}
+            for jti_hash in self._tokens:
+                self._index(index, key, jti_hash)
+        return index
+
+    def add(self, token, claims=None):
+        """Add :param token: to the store; :param claims: are its collected claims, if they are already known."""
         jti = self._guard(token)
-        existing = self._tokens.get(jti)
-        if existing:
-            self.discard(existing)
-
         jti_hash = hash(jti)
-        items = self._collect_key_value_pairs(token)
-        for k, v in items:
-            index: dict = self._indices.setdefault(k, {})
-            identifiers: dict = index.setdefault(v, {})
-            identifiers[jti_hash] = True
+        if jti_hash in self._tokens:
+            self.discard(jti)
 
-        self._tokens[jti_hash] = token
+        self._tokens[jti_hash] = (token, claims)
+        if self._indices:
+            for key, index in self._indices.items():
+                self._index(index, key, jti_hash)
 
     def discard(self, token):
         if isinstance(token, str):
@@ -220,20 +423,23 @@ class JWTStore(MutableSet):
             jti = self._guard(token)
 
         jti_hash = hash(jti)
-        token = self._tokens[jti_hash]
-        items = self._collect_key_value_pairs(token)
-        for k, v in items:
-            index: dict = self._indices[k]
-            identifiers: dict = index[v]
-            del identifiers[jti_hash]
-            if not identifiers:
-                del index[v]
-            if not index:
-                del self._indices[k]
-
-        del self._tokens[jti_hash]
+        if self._indices:
+            claims = self._claims_of(jti_hash)
+            for key, index in self._indices.items():
+                if key not in claims:
+                    continue
+                identifiers: dict = index[claims[key]]
+                del identifiers[jti_hash]
+                if not identifiers:
+                    del index[claims[key]]
+
+        token, _ = self._tokens.pop(jti_hash)
         return token
 
+    def _matches(self, jti_hash, claims):
+        token_claims = self._claims_of(jti_hash)
+        return all(k in token_claims and token_claims[k] == v for k, v in claims.items())
+
     def _get_jti_hashes(self, **claims):
         if not claims:
             return self._tokens.keys()
@@ -241,10 +447,11 @@ class JWTStore(MutableSet):
         jti_hash = hash(jti)
         if jti:
             return {jti_hash} if jti_hash in self._tokens else set()
+        if len(self._tokens) <= self.SCAN_LIMIT:
+            return [jti_hash for jti_hash in self._tokens if self._matches(jti_hash, claims)]
         jtis: set = None
         for k, v in claims.items():
-            index: dict = self._indices.get(k, {})
-            identifiers: dict = index.get(v, {})
+            identifiers: dict = self._get_index(k).get(v, {})
             jtis = identifiers.keys() if jtis is None else jtis & identifiers.keys()
             if not jtis:
                 return set()
@@ -252,14 +459,21 @@ class JWTStore(MutableSet):
 
     def get(self, **claims):
         jtis = self._get_jti_hashes(**claims)
-        return self._tokens[list(jtis)[0]] if jtis else {}
+        return self._tokens[next(iter(jtis))][0] if jtis else {}
 
     def get_all(self, **claims):
-        return [self._tokens[jti] for jti in self._get_jti_hashes(**claims)]
+        return [self._tokens[jti][0] for jti in self._get_jti_hashes(**claims)]
 
 
 def get_jwtstore() -> JWTStore:
-    return getattr(_app_ctx_stack.top, 'jwtstore', JWTStore())
+    # Created on first use, so that requests that do not deal with tokens do not pay for it
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return JWTStore()
+    store = getattr(ctx, 'jwtstore', None)
+    if store is None:
+        store = ctx.jwtstore = JWTStore()
+    return store
 
 
 def get_jwt(**query) -> Dict:
@@ -0,0 +1,111 @@
+# pipeline.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Compiled response header pipelines.
+
+Each combination of enabled features is compiled once into a :class ResponsePlan:,
+which maps every header name that needs special treatment to an operation, so
+that the headers of a remote response are transformed in a single pass.
+"""
+
+from typing import Mapping
+
+import requests
+from flask import Response
+from werkzeug.datastructures import Headers
+
+from . import fetch, security
+from .urls import URLContext
+
+COPY = 0
+SKIP = 1
+LOCATION = 2
+CSP = 3
+CORS = 4
+
+
+class ResponsePlan:
+    __slots__ = ('ops', 'default', 'replace', 'cookies', 'cors', 'clear_site_data', 'hijack')
+
+    def __init__(self, prefs):
+        self.replace = 'set_headers' in prefs
+        if self.replace:
+            self.default = COPY
+            self.ops = {'set-cookie': SKIP, 'transfer-encoding': SKIP, 'location': LOCATION}
+        else:
+            self.default = SKIP
+            self.ops = {'content-encoding': COPY}
+
+        self.cors = 'enforce_cors' in prefs
+        if self.cors:
+            self.ops['access-control-allow-origin'] = CORS
+        if 'break_csp' in prefs:
+            self.ops.update({h.lower(): CSP for h in security.CSP_HEADERS})
+
+        self.cookies = 'set_cookies' in prefs
+        self.clear_site_data = 'clear_cookies_on_navigate' in prefs
+        self.hijack = 'break_csp' in prefs and 'script_injection' in prefs
+
+    def apply(self, p5, remote: requests.Response, response: Response, url_context: URLContext) -> Mapping:
+        """Transform the headers of :param remote: onto :param response:.
+
+        :return: The parsed Content-Security-Policy after it was broken, if any
+        """
+        remote_headers = remote.headers
+        if self.cors:
+            cors = security.cors_verdict(
+                remote_headers.get('Access-Control-Allow-Origin'),
+                p5.mode, p5.origin, url_context.remote_origin,
+            )
+
+        ops = self.ops
+        default = self.default
+        csp = None
+        headers = []
+        for name, value in remote_headers.items():
+            op = ops.get(name.lower(), default)
+            if op == SKIP:
+                continue
+            if op == LOCATION:
+                value = fetch.rewrite_location(value, remote.url, url_context.server_origin)
+            elif op == CSP and value:
+                value, policies = security.rewrite_policy(value, url_context.server_origins, p5.origin)
+                if csp is None or name.lower() == 'content-security-policy':
+                    csp = policies
+            elif op == CORS:
+                if not self.replace or cors != security.CORS_KEEP:
+                    continue
+            headers.append((name, value))
+
+        if self.replace:
+            response.headers = Headers(headers)
+        else:
+            for name, value in headers:
+                response.headers[name] = value
+
+        if self.cors and cors == security.CORS_ALLOW:
+            response.headers['Access-Control-Allow-Origin'] = url_context.server_origin
+
+        if self.cookies:
+            fetch.copy_cookies(remote, response, url_context=url_context)
+
+        if self.clear_site_data:
+            security.add_clear_site_data_header(remote, response, request_mode=p5.mode, request_origin=p5.origin, url_context=url_context)
+
+        csp = csp or {}
+        if self.hijack and "'strict-dynamic'" not in csp.get('script-src', set()) | csp.get('script-src-elem', set()):
+            p5.set_signal('hijack')
+
+        return csp
@@ -0,0 +1,153 @@
+# probe.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Concurrent HEAD probing of candidate URLs.
+
+When the destination of a navigation is ambiguous, all candidates are tested
+at once with a HEAD request, under a common deadline, so that disambiguation
+costs a single round trip instead of one per candidate. Verdicts (the status
+code returned for a candidate, 0 if its server could not be reached, or None
+if it timed out) are cached for a while.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+ACCEPTED = 0
+REDIRECTED = 1
+UNKNOWN = 2
+REJECTED = 3
+
+
+def rank(status):
+    """Return the rank of a probe verdict, lower being more likely to be the intended destination."""
+    if status is None:
+        return UNKNOWN
+    if 200 <= status < 300 or status == 405:
+        return ACCEPTED
+    if 300 <= status < 400:
+        return REDIRECTED
+    return REJECTED
+
+
+class Prober:
+    DEFAULTS = {
+        'workers': 16,
+        'deadline': 2.5,
+        'ttl': 300,
+        'max_entries': 4096,
+    }
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.workers = self.DEFAULTS['workers']
+        self.deadline = self.DEFAULTS['deadline']
+        self.ttl = self.DEFAULTS['ttl']
+        self.max_entries = self.DEFAULTS['max_entries']
+        self.stats = {k: 0 for k in ('probes', 'hits', 'errors', 'late')}
+        self._verdicts = OrderedDict()
+        self._executor = None
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = {**self.DEFAULTS, **app.config.get_namespace('UPSTREAM_PROBE_')}
+        self.workers = conf['workers']
+        self.deadline = conf['deadline']
+        self.ttl = conf['ttl']
+        self.max_entries = conf['max_entries']
+        with self.lock:
+            executor, self._executor = self._executor, None
+            self._verdicts.clear()
+        if executor:
+            executor.shutdown(wait=False)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self.lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='portal5-probe')
+            return self._executor
+
+    def lookup(self, url):
+        with self.lock:
+            verdict = self._verdicts.get(url)
+            if verdict is None:
+                return False, None
+            status, expires = verdict
+            if expires < time.monotonic():
+                del self._verdicts[url]
+                return False, None
+            self.stats['hits'] += 1
+            return True, status
+
+    def remember(self, url, status):
+        with self.lock:
+            self._verdicts[url] = (status, time.monotonic() + self.ttl)
+            self._verdicts.move_to_end(url)
+            while len(self._verdicts) > self.max_entries:
+                self._verdicts.popitem(last=False)
+
+    def _probe(self, url, send, timeout):
+        outbound = requests.Request('HEAD', url).prepare()
+        try:
+            response = send(outbound, timeout=timeout)
+        except requests.RequestException as e:
+            with self.lock:
+                self.stats['errors'] += 1
+            status = None if isinstance(e, requests.Timeout) else 0
+        else:
+            status = response.status_code
+            response.close()
+        self.remember(url, status)
+        return status
+
+    def probe(self, urls, send):
+        """Probe :param urls: concurrently with HEAD requests sent using :param send:.
+
+        Returns a dict mapping each URL to its verdict: the status code, 0 if the server
+        could not be reached, or None if it did not answer before the deadline.
+
+        :param urls: Iterable of absolute URLs
+        :param send: Callable taking a :class requests.PreparedRequest: and a `timeout` keyword argument
+        """
+        verdicts = {}
+        pending = {}
+        for url in dict.fromkeys(urls):
+            cached, status = self.lookup(url)
+            if cached:
+                verdicts[url] = status
+                continue
+            with self.lock:
+                self.stats['probes'] += 1
+            pending[self.executor.submit(self._probe, url, send, self.deadline)] = url
+
+        if pending:
+            done, late = wait(pending, timeout=self.deadline)
+            for future in done:
+                verdicts[pending[future]] = future.result()
+            for future in late:
+                verdicts[pending[future]] = None
+            with self.lock:
+                self.stats['late'] += len(late)
+        return verdicts
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'entries': len(self._verdicts)}
@@ -0,0 +1,178 @@
+# redirects.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Server-side following of upstream redirects.
+
+Safe redirects (of GET and HEAD requests without a body, that do not set
+cookies) are followed on the server up to a limit, so that chains such as
+http -> https -> www -> locale cost the client a single round trip. Permanent
+redirects (301 and 308) are remembered in a bounded cache, so that later
+requests skip the hop entirely.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import parse_cache_control_header
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+PERMANENT_STATUSES = {301, 308}
+CREDENTIAL_HEADERS = ('Authorization', 'Cookie')
+DRAIN_LIMIT = 64 * 1024
+
+
+class RedirectFollower:
+    DEFAULTS = {
+        'follow': False,
+        'max_hops': 5,
+        'cache_size': 4096,
+        'cache_ttl': 86400,
+    }
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.max_hops = self.DEFAULTS['max_hops']
+        self.cache_size = self.DEFAULTS['cache_size']
+        self.cache_ttl = self.DEFAULTS['cache_ttl']
+        self.stats = {k: 0 for k in ('followed', 'cache_hits', 'stored', 'stopped')}
+        self._permanent = OrderedDict()
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = {**self.DEFAULTS, **app.config.get_namespace('UPSTREAM_REDIRECTS_')}
+        self.enabled = bool(conf['follow'])
+        self.max_hops = conf['max_hops']
+        self.cache_size = conf['cache_size']
+        self.cache_ttl = conf['cache_ttl']
+        with self.lock:
+            self._permanent.clear()
+
+    def incr(self, counter, value=1):
+        with self.lock:
+            self.stats[counter] += value
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self._permanent.get(url)
+            if entry is None:
+                return None
+            location, expires = entry
+            if expires < time.monotonic():
+                del self._permanent[url]
+                return None
+            self._permanent.move_to_end(url)
+            self.stats['cache_hits'] += 1
+            return location
+
+    def remember(self, url, location, response: requests.Response):
+        if 'Vary' in response.headers:
+            return
+        cc = parse_cache_control_header(response.headers.get('Cache-Control'), cls=ResponseCacheControl)
+        if cc.no_store or cc.no_cache or cc.private is not None:
+            return
+        ttl = cc.max_age if cc.max_age is not None else self.cache_ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self._permanent[url] = (location, time.monotonic() + min(ttl, self.cache_ttl))
+            self._permanent.move_to_end(url)
+            while len(self._permanent) > self.cache_size:
+                self._permanent.popitem(last=False)
+            self.stats['stored'] += 1
+
+    @staticmethod
+    def discard(response: requests.Response):
+        # Consume small bodies so that the connection can be reused, like requests does
+        try:
+            if int(response.headers.get('Content-Length') or 0) <= DRAIN_LIMIT:
+                response.content
+        except (ValueError, requests.RequestException):
+            pass
+        response.close()
+
+    @staticmethod
+    def is_followable(outbound: requests.PreparedRequest):
+        return outbound.method in {'GET', 'HEAD'} and outbound.body is None
+
+    @staticmethod
+    def get_location(outbound: requests.PreparedRequest, response: requests.Response):
+        if response.status_code not in REDIRECT_STATUSES or 'Set-Cookie' in response.headers:
+            return None
+        location = response.headers.get('Location')
+        if not location:
+            return None
+        location = urljoin(outbound.url, location)
+        if urlsplit(location).scheme not in {'http', 'https'}:
+            return None
+        return location
+
+    @staticmethod
+    def redirect(outbound: requests.PreparedRequest, location) -> requests.PreparedRequest:
+        redirected = outbound.copy()
+        redirected.prepare_url(location, None)
+        if urlsplit(location)[:2] != urlsplit(outbound.url)[:2]:
+            for header in CREDENTIAL_HEADERS:
+                redirected.headers.pop(header, None)
+        return redirected
+
+    def send(self, outbound: requests.PreparedRequest, send, allow=None) -> requests.Response:
+        """Send :param outbound: using :param send:, following safe redirects.
+
+        The returned response is that of the last request sent; its `url` is the final URL.
+
+        :param allow: Optional predicate called with each redirected :class requests.PreparedRequest:;
+            a redirect is not followed if it returns False
+        """
+        if not self.enabled or not self.is_followable(outbound):
+            return send(outbound)
+
+        seen = {outbound.url}
+        hops = 0
+        while True:
+            location = self.lookup(outbound.url)
+            if location is None:
+                response = send(outbound)
+                location = self.get_location(outbound, response)
+                if location is None:
+                    return response
+            else:
+                response = None
+
+            redirected = self.redirect(outbound, location)
+            if hops >= self.max_hops or redirected.url in seen or allow and not allow(redirected):
+                self.incr('stopped')
+                if response is None:
+                    response = send(outbound)
+                return response
+
+            if response is not None:
+                if response.status_code in PERMANENT_STATUSES:
+                    self.remember(outbound.url, location, response)
+                self.discard(response)
+                self.incr('followed')
+
+            seen.add(redirected.url)
+            outbound = redirected
+            hops += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'entries': len(self._permanent)}
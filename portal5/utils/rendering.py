@@ -0,0 +1,141 @@
+# rendering.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Render-once caching of templates.
+
+Scripts and pages of the bundle only vary with the template build, the
+language, the server origins and, for some, the preferences. Each such
+variant is identified by a digest of these inputs, which is used both as the
+cache key and as the ETag, so that revalidation is answered before anything is
+rendered, and the same variant has the same ETag in every worker. Values that
+come from the client are not part of the key; they are filled into the cached
+body for each response.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+
+from flask import Response, current_app, g, render_template, request
+from flask_babel import get_locale
+from werkzeug.http import quote_etag
+
+
+def digest(*parts) -> str:
+    return blake2b('\0'.join(map(str, parts)).encode('utf8'), digest_size=16).hexdigest()
+
+
+def tojson(value) -> str:
+    """Write :param value: like the `tojson` template filter does, for plain JSON values, without the app's JSON settings."""
+    return json.dumps(value, sort_keys=True).replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026').replace("'", '\\u0027')
+
+
+class RenderCache:
+    DEFAULTS = {
+        'size': 256,
+    }
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.size = self.DEFAULTS['size']
+        self.stats = {k: 0 for k in ('hits', 'misses', 'not_modified', 'evictions')}
+        self._rendered = OrderedDict()
+        self._templates = {}
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = {**self.DEFAULTS, **app.config.get_namespace('BUNDLE_RENDER_CACHE_')}
+        self.size = conf['size']
+        with self.lock:
+            self._rendered.clear()
+            self._templates.clear()
+
+    def incr(self, counter, value=1):
+        with self.lock:
+            self.stats[counter] += value
+
+    def template_digest(self, name) -> str:
+        """Digest of the source of template :param name:, recomputed whenever Jinja reloads it."""
+        env = current_app.jinja_env
+        template = env.get_template(name)
+        entry = self._templates.get(name)
+        if entry is None or entry[0] is not template:
+            source, _, _ = env.loader.get_source(env, name)
+            entry = self._templates[name] = (template, digest(source))
+        return entry[1]
+
+    def variant(self, name, *vary) -> str:
+        """Return the cache key of template :param name: as it would be rendered for this request, without rendering it.
+
+        :param vary: Anything else the output depends on
+        """
+        origins = g.server_map['origins']
+        return digest(name, self.template_digest(name), get_locale(), origins['main'], origins['static'], *vary)
+
+    def render(self, key, name, context=dict) -> str:
+        """Return template :param name: rendered for the variant :param key:.
+
+        :param context: Called for the template context, only if it needs rendering
+        """
+        with self.lock:
+            body = self._rendered.get(key)
+            if body is not None:
+                self._rendered.move_to_end(key)
+                self.stats['hits'] += 1
+                return body
+            self.stats['misses'] += 1
+
+        body = render_template(name, **context())
+        with self.lock:
+            self._rendered[key] = body
+            while len(self._rendered) > self.size:
+                self._rendered.popitem(last=False)
+                self.stats['evictions'] += 1
+        return body
+
+    def respond(self, name, *vary, context=dict, fill=None, fill_vary=(), headers=(), **kwargs) -> Response:
+        """Respond with template :param name:, rendered at most once per variant.
+
+        Answers 304 without rendering if the client holds the current variant.
+
+        :param vary: Anything else the output depends on; only pass values from a small, server-controlled set,
+                     since each value is cached separately
+        :param context: Called for the template context, only if it needs rendering
+        :param fill: Called with the cached body to fill in the parts that differ between clients;
+                     the ETag is then weak, since it only identifies the variant
+        :param fill_vary: What the filled in parts depend on, if they should be revalidated;
+                          added to the ETag but not to the cache key
+        """
+        key = self.variant(name, *vary)
+        etag = digest(key, *fill_vary) if fill_vary else key
+        headers = [*dict(headers).items(), ('ETag', quote_etag(etag, fill is not None)), ('Cache-Control', 'no-cache')]
+        if request.if_none_match.contains_weak(etag):
+            self.incr('not_modified')
+            return Response(status=304, headers=headers, **kwargs)
+        body = self.render(key, name, context)
+        return Response(fill(body) if fill else body, headers=headers, **kwargs)
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'entries': len(self._rendered)}
+
+
+render_cache = RenderCache()
+
+
+def setup_rendering(app):
+    render_cache.init_app(app)
@@ -15,17 +15,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import secrets
-from functools import wraps
-from typing import Dict, Union
+from functools import lru_cache, wraps
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Mapping, Tuple, Union
 from urllib.parse import SplitResult, urlsplit
 
 import requests
 from flask import Request, Response, abort, g, request
-from jwt import InvalidTokenError
 from werkzeug.datastructures import MultiDict
+from werkzeug.utils import get_content_type
 
 from . import fetch
 from .jwtkit import JWTKit, get_jwt, verify_claims, verify_exp
+from .urls import URLContext
 
 request: Request
 
@@ -54,13 +56,7 @@ def expects_jwt_in(where, *, key='jwt', **jwtkit_kwargs):
     def wrapper(view_func):
         @wraps(view_func)
         def decode(*args, **kwargs):
-            jwtkit = JWTKit.get_jwtkit()
-            jwt = getter(kwargs) or ''
-            for token in jwt.split(' '):
-                try:
-                    jwtkit.decode_token(token.strip(), **jwtkit_kwargs)
-                except InvalidTokenError:
-                    pass
+            JWTKit.get_jwtkit().decode_tokens(getter(kwargs) or '', **jwtkit_kwargs)
             return view_func(*args, **kwargs)
         return decode
     return wrapper
@@ -96,106 +92,203 @@ def jwt_does_not_claim(**claims):
     return check
 
 
-def access_control_same_origin(view_func):
-    @wraps(view_func)
-    def postprocess(*args, **kwargs):
-        out = fetch.wrap_response(view_func(*args, **kwargs))
-        out.headers['Access-Control-Allow-Origin'] = g.server_map['origins']['main']
-        return out
-    return postprocess
+SAME_ORIGIN = object()
+
+CSP_HEADER = 'Content-Security-Policy'
+CSP_REPORT_ONLY_HEADER = 'Content-Security-Policy-Report-Only'
+
+
+class ResponsePolicy:
+    """Headers that the responses of a view get, added in one step after the view returns.
+
+    Policy decorators stacked directly on top of each other merge into one policy
+    when the view is defined, instead of each wrapping the view again.
+    """
+    __slots__ = ('wrapper', 'headers', 'allow_origin', 'csp', 'nonces', 'mimetype', 'cookies', 'dynamic', '_compiled')
+
+    def __init__(self):
+        self.wrapper = None
+        self.headers = {}
+        self.allow_origin = None
+        self.csp = ()
+        self.nonces = ()
+        self.mimetype = None
+        self.cookies = None
+        self.dynamic = False
+        self._compiled = {}
+
+    def update(self, *, allow_origin=None, csp=(), nonces=(), referrer=None, clear_site_data=(),
+               frame_options=None, mimetype=None, cookies=None):
+        """Add to the policy; where both set the same header, the later one wins.
+
+        :param allow_origin: `Access-Control-Allow-Origin`, or `SAME_ORIGIN` for the main server origin
+        :param csp: CSP directives, or callables returning directives given the server map
+        :param nonces: CSP directives to add a new nonce to for every request, available in `g.csp_nonce`
+        :param clear_site_data: Types of `Clear-Site-Data`
+        :param mimetype: Mimetype of successful responses
+        :param cookies: Called with the response after the headers are set, to write cookies
+        """
+        if allow_origin is not None:
+            self.allow_origin = allow_origin
+        if referrer is not None:
+            self.headers['Referrer-Policy'] = referrer
+        if clear_site_data:
+            self.headers['Clear-Site-Data'] = ', '.join([f'"{t}"' for t in clear_site_data])
+        if frame_options is not None:
+            self.headers['X-Frame-Options'] = frame_options
+        self.csp = (*self.csp, *csp, *(f'{d} {CSP_NONCE_SLOT % d}' for d in nonces))
+        self.nonces = (*self.nonces, *nonces)
+        self.mimetype = mimetype or self.mimetype
+        self.cookies = cookies or self.cookies
+        # Whether the headers depend on the server map
+        self.dynamic = self.allow_origin is SAME_ORIGIN or any(callable(d) for d in self.csp)
+        self._compiled.clear()
+
+    def compile(self, server_map):
+        compiled = self._compiled.get(id(server_map))
+        if compiled is None or compiled[0] is not server_map:
+            headers = dict(self.headers)
+            if self.allow_origin is SAME_ORIGIN:
+                headers['Access-Control-Allow-Origin'] = server_map['origins']['main']
+            elif self.allow_origin is not None:
+                headers['Access-Control-Allow-Origin'] = self.allow_origin
+            directives = []
+            for directive in self.csp:
+                if callable(directive):
+                    directives.extend(directive(server_map))
+                else:
+                    directives.append(directive)
+            headers = {name.lower(): (name, value) for name, value in headers.items()}
+            compiled = self._compiled[id(server_map)] = (server_map, headers, tuple(directives))
+        return compiled[1:]
+
+    def apply(self, response: Response) -> Response:
+        headers, directives = self.compile(g.server_map if self.dynamic else None)
+        updates = {**headers}
+        if directives:
+            updates['content-security-policy'] = (CSP_HEADER, merge_csp(response, CSP_HEADER, directives))
+        if self.mimetype and response.status_code < 300:
+            updates['content-type'] = ('Content-Type', get_content_type(self.mimetype, response.charset))
+
+        # Replace existing headers in place and add the rest, in one pass over the headers
+        current = response.headers
+        replaced = []
+        stale = []
+        for i, (name, _) in enumerate(current):
+            name = name.lower()
+            if name in updates:
+                current[i] = updates.pop(name)
+                replaced.append(name)
+            elif name in replaced:
+                stale.append(i)
+        for i in reversed(stale):
+            del current[i]
+        for name, value in updates.values():
+            current.add(name, value)
+
+        if self.cookies:
+            self.cookies(response)
+        return response
+
+
+def response_policy(**policy):
+    """Declare headers for the responses of a view; see :meth ResponsePolicy.update: for the options."""
+    def wrapper(view_func):
+        existing = getattr(view_func, 'response_policy', None)
+        if existing is not None and existing.wrapper is view_func:
+            existing.update(**policy)
+            return view_func
 
+        compiled = ResponsePolicy()
+        compiled.update(**policy)
 
-def access_control_allow_origin(origin):
-    def wrapper(view_func):
         @wraps(view_func)
-        def postprocess(*args, **kwargs):
-            out = fetch.wrap_response(view_func(*args, **kwargs))
-            out.headers['Access-Control-Allow-Origin'] = origin
-            return out
-        return postprocess
+        def apply_policy(*args, **kwargs):
+            if compiled.nonces:
+                g.csp_nonce = {d: secrets.token_hex(8) for d in compiled.nonces}
+            return compiled.apply(fetch.wrap_response(view_func(*args, **kwargs)))
+
+        compiled.wrapper = apply_policy
+        apply_policy.response_policy = compiled
+        return apply_policy
     return wrapper
 
 
-def csp_no_frame_ancestor(view_func):
-    @wraps(view_func)
-    def postprocess(*args, **kwargs):
-        out = fetch.wrap_response(view_func(*args, **kwargs))
-        out.headers.add('X-Frame-Options', 'DENY')
-        update_csp(out, "frame-ancestors 'none'", g_=g)
-        return out
-    return postprocess
+def protected_directives(server_map):
+    static = server_map['origins']['static']
+    return (
+        "default-src 'self'", "img-src 'self' data:",
+        'font-src fonts.gstatic.com', "frame-ancestors 'none'",
+        f"style-src 'self' {static} fonts.googleapis.com",
+        f"script-src 'self' {static}",
+    )
 
 
-def csp_directives(*directives):
-    def wrapper(view_func):
-        @wraps(view_func)
-        def postprocess(*args, **kwargs):
-            out = fetch.wrap_response(view_func(*args, **kwargs))
-            update_csp(out, *directives, g_=g)
-            return out
-        return postprocess
-    return wrapper
+PROTECTED_CSP = (protected_directives,)
 
+access_control_same_origin = response_policy(allow_origin=SAME_ORIGIN)
+csp_no_frame_ancestor = response_policy(frame_options='DENY', csp=("frame-ancestors 'none'",))
+csp_protected = response_policy(csp=PROTECTED_CSP)
 
-def csp_protected(view_func):
-    @wraps(view_func)
-    def add_csp(*args, **kwargs):
-        out = fetch.wrap_response(view_func(*args, **kwargs))
-        static = g.server_map['origins']['static']
-        update_csp(
-            out,
-            "default-src 'self'", "img-src 'self' data:",
-            'font-src fonts.gstatic.com', "frame-ancestors 'none'",
-            f"style-src 'self' {static} fonts.googleapis.com",
-            f"script-src 'self' {static}", g_=g,
-        )
-        return out
-    return add_csp
+
+def access_control_allow_origin(origin):
+    return response_policy(allow_origin=origin)
+
+
+def csp_directives(*directives):
+    return response_policy(csp=directives)
 
 
 def csp_nonce(*directives):
-    def wrapper(view_func):
-        @wraps(view_func)
-        def supply_nonce(*args, **kwargs):
-            nonce = {d: secrets.token_hex(8) for d in directives}
-            g.csp_nonce = nonce
-            out = fetch.wrap_response(view_func(*args, **kwargs))
-            update_csp(out, '; '.join([f"{k} 'nonce-{v}'" for k, v in nonce.items()]), g_=g)
-            return out
-        return supply_nonce
-    return wrapper
+    return response_policy(nonces=directives)
 
 
 def referrer_policy(policy):
-    def wrapper(view_func):
-        @wraps(view_func)
-        def referrer(*args, **kwargs):
-            out = fetch.wrap_response(view_func(*args, **kwargs))
-            out.headers['Referrer-Policy'] = policy
-            return out
-        return referrer
-    return wrapper
+    return response_policy(referrer=policy)
+
+
+CSP_NONCE_SLOT = "'nonce-{%s}'"
+
+
+@lru_cache(maxsize=256)
+def compile_csp(base, directives: Tuple[str, ...]) -> str:
+    """Merge :param directives: into the policy :param base:.
+
+    Directives and sources keep the order they first appeared in, so that the
+    same inputs always give the same header.
+    """
+    policies = {}
+    for directive in (*(base or '').split(';'), *directives):
+        directive = directive.split()
+        if directive:
+            policies.setdefault(directive[0], {}).update(dict.fromkeys(directive[1:]))
+    return '; '.join([' '.join([k, *v]) for k, v in policies.items()])
 
 
-def update_csp(response, *directives, method=set.union, g_=None, report_only=False):
-    header = 'Content-Security-Policy' if not report_only else 'Content-Security-Policy-Report-Only'
-    policies = None
-    if g_:
-        policies = getattr(g_, 'csp', None)
-    if not policies:
-        csp = response.headers.get(header, None)
-        if csp:
-            policies = [p.strip().split(' ') for p in csp.split(';') if p]
-            policies = {p[0]: set(p[1:]) for p in policies}
-        else:
-            policies = {}
-    directives = [d.strip().split(' ') for d in directives if d]
-    updates = {d[0]: set(d[1:]) for d in directives}
-    for k, v in updates.items():
-        values = policies.setdefault(k, set())
-        policies[k] = method(v, values)
-    g_.csp = policies
-    response.headers[header] = '; '.join([' '.join([k, *v]) for k, v in policies.items()])
+def merge_csp(response, header, directives: Tuple[str, ...]) -> str:
+    """Return the policy in :param header: of :param response: with :param directives: added.
+
+    The policy is compiled from the directives added so far, which are static,
+    and nonces from `g.csp_nonce` are only filled in afterwards.
+    """
+    templates = getattr(response, 'csp_templates', None)
+    if templates is None:
+        templates = response.csp_templates = {}
+    base = templates.get(header)
+    if base is None:
+        base = response.headers.get(header)
+    policy = templates[header] = compile_csp(base, directives)
+    nonces = g.get('csp_nonce')
+    if nonces:
+        for directive, nonce in nonces.items():
+            policy = policy.replace(CSP_NONCE_SLOT % directive, f"'nonce-{nonce}'")
+    return policy
+
+
+def update_csp(response, *directives, report_only=False):
+    """Add :param directives: to the CSP of :param response:."""
+    header = CSP_HEADER if not report_only else CSP_REPORT_ONLY_HEADER
+    response.headers[header] = merge_csp(response, header, directives)
 
 
 def allow_referrer(*urls, allow_self=True, samesite=True):
@@ -215,7 +308,9 @@ def allow_referrer(*urls, allow_self=True, samesite=True):
     return wrapper
 
 
-def conceal_origin(find, replace, url: SplitResult, **multidicts: MultiDict) -> Dict[str, Union[SplitResult, MultiDict]]:
+def conceal_origin(url_context: URLContext, **multidicts: MultiDict) -> Dict[str, Union[SplitResult, MultiDict]]:
+    """Replace this server's host with the client's domain in the requested URL and in :param multidicts:."""
+    find, replace, url = url_context.server_host, url_context.client_domain, url_context.requested
     path = url.path.replace(find, replace)
     query = url.query.replace(find, replace)
     url = SplitResult(url.scheme, url.netloc, path, query, url.fragment)
@@ -229,75 +324,118 @@ def conceal_origin(find, replace, url: SplitResult, **multidicts: MultiDict) ->
     return {'url': url, **multidicts}
 
 
-def enforce_cors(remote: requests.Response, response: Response, *, request_mode, request_origin, server_map, **kwargs) -> None:
-    remote_origin = urlsplit(remote.url)
-    remote_origin = f'{remote_origin.scheme}://{remote_origin.netloc}'
-    allow_origin = remote.headers.get('Access-Control-Allow-Origin', None)
+CORS_KEEP = 0
+CORS_DROP = 1
+CORS_ALLOW = 2
+
+CSP_HEADERS = (CSP_HEADER, CSP_REPORT_ONLY_HEADER)
+CSP_NON_SOURCE_DIRECTIVES = {
+    'plugin-types', 'sandbox',
+    'block-all-mixed-content', 'referrer',
+    'require-sri-for', 'require-trusted-types-for',
+    'trusted-types', 'upgrade-insecure-requests',
+}
+CSP_ADVERSE_DIRECTIVES = {'report-uri', 'report-to'}
+CSP_CACHE_SIZE = 1024
+
+
+def cors_verdict(allow_origin, request_mode, request_origin, remote_origin):
+    """Decide what to do with the `Access-Control-Allow-Origin` header of a remote response.
+
+    Aborts with 403 if a CORS request would have been rejected by the remote server.
+
+    :return: One of `CORS_KEEP` (pass it along), `CORS_DROP` (remove it),
+        or `CORS_ALLOW` (replace it with the server origin)
+    """
     if allow_origin == '*' or not allow_origin and request_mode != 'cors':
-        return
+        return CORS_KEEP
 
     if allow_origin and allow_origin != request_origin:
-        response.headers.pop('Access-Control-Allow-Origin', None)
-        return
+        return CORS_DROP
 
     if not allow_origin and request_mode == 'cors' and request_origin != remote_origin:
         return abort(403)
 
-    response.headers['Access-Control-Allow-Origin'] = server_map['origins']['main']
+    return CORS_ALLOW
+
+
+def enforce_cors(remote: requests.Response, response: Response, *, request_mode, request_origin, url_context: URLContext, **kwargs) -> None:
+    allow_origin = remote.headers.get('Access-Control-Allow-Origin', None)
+    verdict = cors_verdict(allow_origin, request_mode, request_origin, url_context.remote_origin)
+    if verdict == CORS_DROP:
+        response.headers.pop('Access-Control-Allow-Origin', None)
+    elif verdict == CORS_ALLOW:
+        response.headers['Access-Control-Allow-Origin'] = url_context.server_origin
+
+
+def _break_policy(csp, origins, request_origin) -> Dict[str, dict]:
+    policies = [p.strip().split(' ') for p in csp.split(';')]
+    policies = {p[0]: dict.fromkeys(p[1:]) for p in policies if p[0] not in CSP_ADVERSE_DIRECTIVES}
+
+    for directive, options in policies.items():
+        if not directive:
+            continue
+        if directive in CSP_NON_SOURCE_DIRECTIVES:
+            continue
+        if "'strict-dynamic'" in options:
+            continue
+        if "'none'" not in options:
+            options.update(dict.fromkeys(sorted(origins)))
+        if "'self'" in options:
+            options[request_origin] = None
+
+    return policies
+
 
+def break_policy(csp, origins, request_origin) -> dict:
+    """Parse the CSP :param csp: and allow :param origins: (and :param request_origin: where `'self'` is allowed) in all its source lists."""
+    return {k: set(v) for k, v in _break_policy(csp, origins, request_origin).items()}
 
-def break_csp(remote: requests.Response, response: Response, *, request_origin, server_map, **kwargs) -> dict:
-    origins = set(server_map['origins'].values())
-    non_source_directives = {
-        'plugin-types', 'sandbox',
-        'block-all-mixed-content', 'referrer',
-        'require-sri-for', 'require-trusted-types-for',
-        'trusted-types', 'upgrade-insecure-requests',
+
+def format_policy(policies: dict) -> str:
+    return '; '.join([' '.join([k, *filter(None, v)]) for k, v in policies.items()])
+
+
+@lru_cache(maxsize=CSP_CACHE_SIZE)
+def rewrite_policy(csp, origins: FrozenSet[str], request_origin) -> Tuple[str, Mapping[str, FrozenSet[str]]]:
+    """Memoised :func break_policy: and :func format_policy:.
+
+    :return: The rewritten header, and the parsed policy after rewriting (read-only, as it is shared)
+    """
+    policies = _break_policy(csp, origins, request_origin)
+    return format_policy(policies), MappingProxyType({k: frozenset(v) for k, v in policies.items()})
+
+
+def get_csp_stats():
+    info = rewrite_policy.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits, 'misses': info.misses, 'entries': info.currsize,
+        'hit_ratio': round(info.hits / lookups, 3) if lookups else 0,
     }
-    adverse_directives = {'report-uri', 'report-to'}
 
-    for header in {'Content-Security-Policy', 'Content-Security-Policy-Report-Only'}:
-        csp = remote.headers.get(header, None)
-        if not csp:
+
+def break_csp(remote: requests.Response, response: Response, *, request_origin, url_context: URLContext, **kwargs) -> Mapping:
+    """Rewrite both the enforced and the report-only CSP of :param remote: onto :param response:.
+
+    :return: The parsed enforced policy, or the report-only one if there is none
+    """
+    csp = None
+    for header in CSP_HEADERS:
+        value = remote.headers.get(header, None)
+        if not value:
             continue
 
-        policies = [p.strip().split(' ') for p in csp.split(';')]
-        policies = {p[0]: set(p[1:]) for p in policies if p[0] not in adverse_directives}
-
-        for directive, options in policies.items():
-            if not directive:
-                continue
-            if directive in non_source_directives:
-                continue
-            if "'strict-dynamic'" in options:
-                continue
-            if "'none'" not in options:
-                options |= origins
-            if "'self'" in options:
-                options.add(request_origin)
-
-        broken_csp = '; '.join([' '.join([k, *filter(None, v)]) for k, v in policies.items()])
-        response.headers[header] = broken_csp
-        return policies
-    return {}
-
-
-def add_clear_site_data_header(remote: requests.Response, response: Response, *, request_mode, request_origin, **kwargs):
-    remote_url = urlsplit(remote.url)
-    remote_origin = f'{remote_url.scheme}://{remote_url.netloc}'
-    if request_mode == 'navigate' and request_origin != remote_origin:
+        response.headers[header], policies = rewrite_policy(value, url_context.server_origins, request_origin)
+        if csp is None:
+            csp = policies
+    return csp or {}
+
+
+def add_clear_site_data_header(remote: requests.Response, response: Response, *, request_mode, request_origin, url_context: URLContext, **kwargs):
+    if request_mode == 'navigate' and request_origin != url_context.remote_origin:
         response.headers.add('Clear-Site-Data', '"cookies"')
 
 
 def clear_site_data(*types):
-    if not types:
-        types = ('cache', 'cookies', 'storage')
-
-    def wrapper(view_func):
-        @wraps(view_func)
-        def wrapper(*args, **kwargs):
-            out = fetch.wrap_response(view_func(*args, **kwargs))
-            out.headers['Clear-Site-Data'] = ', '.join([f'"{t}"' for t in types])
-            return out
-        return wrapper
-    return wrapper
+    return response_policy(clear_site_data=types or ('cache', 'cookies', 'storage'))
@@ -0,0 +1,205 @@
+# sessions.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Compact session tokens.
+
+A session token carries all grants issued to one client in a single signed value,
+instead of one JWT per grant, each repeating the issuer, audience and subject:
+
+    p5.<base64url(body + mac)>
+
+The body holds the subject and the worker version once, followed by the grants in
+binary (privilege, jti, iat, exp and the optional variant, session and signals);
+the MAC is a truncated HMAC-SHA256 over the audience and the body. Grants are
+converted from and to JWT-shaped payloads, so that they are queried like JWTs.
+"""
+
+import hmac
+import json
+import struct
+from hashlib import sha256
+from typing import List, Optional, Tuple
+
+from jwt import DecodeError, InvalidSignatureError
+from jwt.utils import base64url_decode, base64url_encode
+
+PREFIX = 'p5.'
+FORMAT = 1
+MAC_SIZE = 16
+MAX_GRANTS = 255
+
+PRIVILEGES = ('init', 'nochange', 'update')
+PRIVATE_CLAIMS = frozenset({'version', 'variant', 'privilege', 'session', 'signals'})
+RESERVED_CLAIMS = frozenset({'iss', 'aud', 'iat', 'nbf', 'exp', 'sub', 'jti'})
+
+HAS_VARIANT = 1
+HAS_SESSION = 2
+HAS_SIGNALS = 4
+
+GRANT = struct.Struct('>B8sIIB')
+VARIANT = struct.Struct('>H')
+SESSION = struct.Struct('>8s')
+
+UINT32 = range(1 << 32)
+
+
+def is_jti(value):
+    """Whether :param value: is a token identifier that packs into 8 bytes."""
+    try:
+        return isinstance(value, str) and len(value) == 16 and bytes.fromhex(value).hex() == value
+    except ValueError:
+        return False
+
+
+def _short_string(value):
+    return isinstance(value, str) and len(value.encode('utf8')) < 256
+
+
+def session_of(payload: dict, iss, aud) -> Optional[Tuple[str, str]]:
+    """Return the (subject, version) of the session that :param payload: can be packed in, or None if it cannot."""
+    if not RESERVED_CLAIMS.issuperset(payload.keys() - {aud}):
+        return None
+    if payload.get('iss') != iss or payload.get('aud') != aud:
+        return None
+    iat = payload.get('iat')
+    if not isinstance(iat, int) or iat not in UINT32 or payload.get('nbf', iat) != iat:
+        return None
+    exp = payload.get('exp', 0)
+    if not isinstance(exp, int) or exp not in UINT32:
+        return None
+    sub = payload.get('sub')
+    if not _short_string(sub) or not is_jti(payload.get('jti')):
+        return None
+
+    claims = payload.get(aud)
+    if not isinstance(claims, dict) or not PRIVATE_CLAIMS.issuperset(claims.keys()):
+        return None
+    if claims.get('privilege') not in PRIVILEGES or not _short_string(claims.get('version')):
+        return None
+    variant = claims.get('variant', 0)
+    if not isinstance(variant, int) or not 0 <= variant <= 0xFFFF:
+        return None
+    if 'session' in claims and not is_jti(claims['session']):
+        return None
+    if 'signals' in claims and (not isinstance(claims['signals'], dict) or len(_dump_signals(claims['signals'])) > 255):
+        return None
+
+    return sub, claims['version']
+
+
+def _dump_signals(signals):
+    return json.dumps(signals, separators=(',', ':')).encode()
+
+
+def _mac(key: bytes, aud, body: bytes) -> bytes:
+    return hmac.new(key, aud.encode('utf8') + b'\0' + body, sha256).digest()[:MAC_SIZE]
+
+
+def encode(payloads: List[dict], key: bytes, aud) -> str:
+    """Pack :param payloads: into a session token.
+
+    They must all belong to the same session (see :func session_of:), and there may be at most `MAX_GRANTS` of them.
+    """
+    sub = payloads[0]['sub'].encode('utf8')
+    version = payloads[0][aud]['version'].encode('utf8')
+    body = bytearray((FORMAT, len(sub)))
+    body += sub
+    body.append(len(version))
+    body += version
+    body.append(len(payloads))
+
+    for payload in payloads:
+        claims = payload[aud]
+        flags = 0
+        extra = bytearray()
+        if 'variant' in claims:
+            flags |= HAS_VARIANT
+            extra += VARIANT.pack(claims['variant'])
+        if 'session' in claims:
+            flags |= HAS_SESSION
+            extra += SESSION.pack(bytes.fromhex(claims['session']))
+        if 'signals' in claims:
+            flags |= HAS_SIGNALS
+            signals = _dump_signals(claims['signals'])
+            extra.append(len(signals))
+            extra += signals
+        body += GRANT.pack(
+            PRIVILEGES.index(claims['privilege']) + 1, bytes.fromhex(payload['jti']),
+            payload['iat'], payload.get('exp', 0), flags,
+        )
+        body += extra
+
+    body = bytes(body)
+    return PREFIX + base64url_encode(body + _mac(key, aud, body)).decode('ascii')
+
+
+def decode(token: str, key: bytes, iss, aud) -> List[dict]:
+    """Verify the session token :param token: and unpack its grants into JWT-shaped payloads.
+
+    Times are not checked here.
+    """
+    try:
+        data = base64url_decode(token[len(PREFIX):].encode('ascii'))
+    except (ValueError, UnicodeError):
+        raise DecodeError('Invalid session token padding')
+    body, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+    if len(mac) != MAC_SIZE or not hmac.compare_digest(mac, _mac(key, aud, body)):
+        raise InvalidSignatureError('Session token signature verification failed')
+
+    try:
+        if body[0] != FORMAT:
+            raise DecodeError('Unsupported session token format')
+        offset = 1
+        sub, offset = _read_string(body, offset)
+        version, offset = _read_string(body, offset)
+        count = body[offset]
+        offset += 1
+
+        payloads = []
+        for _ in range(count):
+            privilege, jti, iat, exp, flags = GRANT.unpack_from(body, offset)
+            offset += GRANT.size
+            if not 0 < privilege <= len(PRIVILEGES):
+                raise ValueError('unknown privilege')
+            claims = {'version': version, 'privilege': PRIVILEGES[privilege - 1]}
+            if flags & HAS_VARIANT:
+                claims['variant'], = VARIANT.unpack_from(body, offset)
+                offset += VARIANT.size
+            if flags & HAS_SESSION:
+                session, = SESSION.unpack_from(body, offset)
+                claims['session'] = session.hex()
+                offset += SESSION.size
+            if flags & HAS_SIGNALS:
+                signals, offset = _read_string(body, offset)
+                claims['signals'] = json.loads(signals)
+
+            payload = {'iss': iss, 'aud': aud, 'iat': iat, 'nbf': iat, 'sub': sub, 'jti': jti.hex()}
+            if exp:
+                payload['exp'] = exp
+            payload[aud] = claims
+            payloads.append(payload)
+    except (IndexError, struct.error, UnicodeError, ValueError) as e:
+        raise DecodeError(f'Malformed session token: {e}')
+
+    return payloads
+
+
+def _read_string(body: bytes, offset) -> Tuple[str, int]:
+    length = body[offset]
+    offset += 1
+    end = offset + length
+    if end > len(body):
+        raise ValueError('string out of bounds')
+    return body[offset:end].decode('utf8'), end
@@ -0,0 +1,88 @@
+# streaming.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Streaming of upstream response bodies to the client.
+
+Bodies are read with "read what is available" semantics, so that a slow
+response is forwarded as soon as data arrives instead of waiting for a full
+chunk, while the chunk size grows as long as the remote server keeps up.
+Bodies backed by an actual file (e.g. disk cache entries) are handed to the
+WSGI server's ``wsgi.file_wrapper`` instead.
+"""
+
+import io
+
+from urllib3 import HTTPResponse
+from urllib3.exceptions import IncompleteRead
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+
+
+def read_available(raw, size):
+    """Read at most :param size: bytes from :param raw:, returning early if fewer bytes are available.
+
+    Returns an empty bytes object at the end of the stream.
+
+    :param raw: A file-like object, usually the `raw` attribute of a :class requests.Response:
+    :param size: Maximum number of bytes to return
+    :rtype: bytes
+    """
+    if isinstance(raw, HTTPResponse) and not raw.decode_content:
+        fp = raw._fp
+        if fp is None:
+            return b''
+        # Mirror HTTPResponse.read: translate socket and protocol errors into urllib3's,
+        # keep the length bookkeeping, and at the end of the body close the response,
+        # which returns the connection to its pool.
+        with raw._error_catcher():
+            data = fp.read1(size) if not getattr(fp, 'closed', False) else b''
+            if not data:
+                fp.close()
+                if raw.enforce_content_length and raw.length_remaining not in (0, None):
+                    raise IncompleteRead(raw._fp_bytes_read, raw.length_remaining)
+        if data:
+            raw._fp_bytes_read += len(data)
+            if raw.length_remaining is not None:
+                raw.length_remaining -= len(data)
+        return data
+
+    read1 = getattr(raw, 'read1', None)
+    if read1 is not None:
+        return read1(size)
+    return raw.read(size)
+
+
+def iter_raw(raw, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """Iterate over the contents of :param raw:, doubling the chunk size (up to :param max_size:) whenever a read fills it."""
+    size = min_size
+    while True:
+        chunk = read_available(raw, size)
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) >= size and size < max_size:
+            size = min(size * 2, max_size)
+
+
+def file_source(raw):
+    """Return :param raw: if it is a regular file that can be given to `wsgi.file_wrapper`, or None otherwise."""
+    if not isinstance(raw, io.BufferedReader):
+        return None
+    try:
+        raw.fileno()
+    except (OSError, ValueError):
+        return None
+    return raw
@@ -0,0 +1,284 @@
+# upstream.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Process-wide HTTP client for upstream (remote) requests.
+
+Connections to remote servers are kept alive in per-host pools shared by all
+worker threads, so that consecutive requests to the same origin (e.g. the
+subresources of a page) do not pay for a new TCP connection and TLS handshake
+every time.
+
+Every request is sent with a connect timeout, a read timeout (applied to each
+socket read) and a total timeout covering everything up to the response
+headers, so that an unresponsive server cannot hold a worker thread for long.
+"""
+
+import ssl
+import threading
+import time
+from collections import OrderedDict
+
+import certifi
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool, PoolManager
+from urllib3.util import Timeout
+
+
+class PoolStats:
+    __slots__ = ('_lock', 'hits', 'connections', 'waits', 'expired')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.connections = 0
+        self.waits = 0
+        self.expired = 0
+
+    def incr(self, counter, value=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__[1:]}
+
+
+class KeepAlivePoolMixin:
+    """Connection pool that retires connections after being idle or alive for too long, and keeps usage counters.
+
+    A connection is counted as a hit if it is checked out of the pool with its socket still open,
+    and as a new connection otherwise (in which case it will connect when the request is sent).
+    A wait is counted whenever a connection is requested while the pool has none available.
+    """
+
+    idle_timeout = None
+    max_lifetime = None
+
+    def _get_conn(self, timeout=None):
+        pool = self.pool
+        if pool is not None and pool.empty():
+            self.stats.incr('waits')
+
+        conn = super()._get_conn(timeout)
+
+        now = time.monotonic()
+        if conn.sock is not None:
+            created = getattr(conn, '_portal5_created', now)
+            last_used = getattr(conn, '_portal5_last_used', now)
+            if (
+                self.max_lifetime is not None and now - created > self.max_lifetime
+                or self.idle_timeout is not None and now - last_used > self.idle_timeout
+            ):
+                self.stats.incr('expired')
+                conn.close()
+
+        if conn.sock is None:
+            self.stats.incr('connections')
+            conn._portal5_created = now
+        else:
+            self.stats.incr('hits')
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._portal5_last_used = time.monotonic()
+            remember = getattr(getattr(conn, 'ssl_context', None), 'remember', None)
+            if remember:
+                remember(conn.server_hostname or conn.host, conn.sock)
+        return super()._put_conn(conn)
+
+
+class KeepAliveHTTPConnectionPool(KeepAlivePoolMixin, HTTPConnectionPool):
+    pass
+
+
+class KeepAliveHTTPSConnectionPool(KeepAlivePoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class SessionReusingSSLContext(ssl.SSLContext):
+    """SSL context that resumes TLS sessions with servers it has previously connected to.
+
+    Sessions are remembered per server hostname, up to :attr max_sessions:.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, *args, max_sessions=1024, **kwargs):
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.check_hostname = False  # urllib3 matches hostnames itself, as with its own contexts
+        self.verify_mode = ssl.CERT_REQUIRED
+        self.load_verify_locations(certifi.where())
+        self.stats = {'resumed': 0, 'handshakes': 0}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and server_hostname:
+            with self._lock:
+                session = self._sessions.get(server_hostname)
+        try:
+            sslsock = super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+        except ssl.SSLError:
+            if session is not None:
+                self.forget(server_hostname)
+            raise
+        with self._lock:
+            self.stats['resumed' if sslsock.session_reused else 'handshakes'] += 1
+        self.remember(server_hostname, sslsock)
+        return sslsock
+
+    def remember(self, server_hostname, sslsock):
+        session = getattr(sslsock, 'session', None)
+        if not server_hostname or session is None:
+            return
+        with self._lock:
+            self._sessions[server_hostname] = session
+            self._sessions.move_to_end(server_hostname)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def forget(self, server_hostname):
+        with self._lock:
+            self._sessions.pop(server_hostname, None)
+
+
+class UpstreamPoolManager(PoolManager):
+    def __init__(self, *args, idle_timeout=None, max_lifetime=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_classes_by_scheme = {
+            'http': KeepAliveHTTPConnectionPool,
+            'https': KeepAliveHTTPSConnectionPool,
+        }
+        self.pools.dispose_func = self._dispose_pool
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.stats = {}
+        self._stats_refs = {}
+        self._stats_lock = threading.Lock()
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.idle_timeout = self.idle_timeout
+        pool.max_lifetime = self.max_lifetime
+        pool.stats_key = f'{scheme}://{host}:{port}'
+        with self._stats_lock:
+            pool.stats = self.stats.setdefault(pool.stats_key, PoolStats())
+            self._stats_refs[pool.stats_key] = self._stats_refs.get(pool.stats_key, 0) + 1
+        return pool
+
+    def _dispose_pool(self, pool):
+        pool.close()
+        with self._stats_lock:
+            refs = self._stats_refs.pop(pool.stats_key, 0) - 1
+            if refs > 0:
+                self._stats_refs[pool.stats_key] = refs
+            else:
+                self.stats.pop(pool.stats_key, None)
+
+
+class UpstreamAdapter(HTTPAdapter):
+    def __init__(self, *, idle_timeout=None, max_lifetime=None, **kwargs):
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
+        self.ssl_context = SessionReusingSSLContext()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        self.poolmanager = UpstreamPoolManager(
+            num_pools=connections, maxsize=maxsize, block=block, strict=True,
+            idle_timeout=self._idle_timeout, max_lifetime=self._max_lifetime,
+            ssl_context=self.ssl_context, **pool_kwargs,
+        )
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if verify is True and url.lower().startswith('https'):
+            # The default CA bundle is already loaded into the shared context
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+
+class UpstreamClient:
+    DEFAULTS = {
+        'pool_connections': 64,
+        'pool_maxsize': 16,
+        'pool_block': False,
+        'idle_timeout': 60,
+        'max_lifetime': 600,
+    }
+    TIMEOUTS = {
+        'connect_timeout': 5,
+        'read_timeout': 30,
+        'total_timeout': 60,
+    }
+
+    def __init__(self, app=None):
+        self._conf = {**self.DEFAULTS}
+        self._adapter = None
+        self._lock = threading.Lock()
+        self.timeout = self.make_timeout(self.TIMEOUTS)
+        if app:
+            self.init_app(app)
+
+    @staticmethod
+    def make_timeout(conf):
+        return Timeout(connect=conf['connect_timeout'], read=conf['read_timeout'], total=conf['total_timeout'])
+
+    def init_app(self, app):
+        conf = app.config.get_namespace('UPSTREAM_')
+        self._conf.update({k: v for k, v in conf.items() if k in self.DEFAULTS})
+        self.timeout = self.make_timeout({**self.TIMEOUTS, **{k: v for k, v in conf.items() if k in self.TIMEOUTS}})
+        self.close()
+
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['upstream'] = self
+
+    @property
+    def adapter(self) -> UpstreamAdapter:
+        adapter = self._adapter
+        if adapter is None:
+            with self._lock:
+                if self._adapter is None:
+                    self._adapter = UpstreamAdapter(**self._conf)
+                adapter = self._adapter
+        return adapter
+
+    def send(self, outbound: requests.PreparedRequest, **kwargs) -> requests.Response:
+        kwargs = {'stream': True, 'timeout': self.timeout, 'verify': True, 'cert': None, 'proxies': {}, **kwargs}
+        return self.adapter.send(outbound, **kwargs)
+
+    def close(self):
+        with self._lock:
+            adapter, self._adapter = self._adapter, None
+        if adapter:
+            adapter.close()
+
+    def stats(self):
+        adapter = self._adapter
+        if adapter is None:
+            return {'pools': {}, 'tls': {}}
+        pools = adapter.poolmanager.stats
+        return {
+            'pools': {k: v.to_dict() for k, v in list(pools.items())},
+            'tls': {**adapter.ssl_context.stats},
+        }
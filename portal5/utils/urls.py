@@ -0,0 +1,72 @@
+# urls.py
+# Copyright (C) 2020  Tony Wu <tony[dot]wu(at)nyu[dot]edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Memoised URL parsing and the per-request URL context.
+
+The requested URL, the client origin and the server origins are needed by most
+steps that handle a proxied request. They are parsed once, when the request URL
+is, into a :class URLContext: that is passed along to the steps, and completed
+with the remote URL once the response arrives. Parsing of recurring inputs is
+memoised.
+"""
+
+from functools import lru_cache
+from typing import FrozenSet, NamedTuple, Optional
+from urllib.parse import SplitResult, urlsplit
+
+CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def split_url(url) -> SplitResult:
+    return urlsplit(url)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def origin_of(url) -> str:
+    parts = split_url(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def netloc_of(url) -> str:
+    return split_url(url).netloc
+
+
+class URLContext(NamedTuple):
+    requested: SplitResult
+    client_origin: Optional[str]
+    client_domain: Optional[str]
+    server_host: str
+    server_origin: str
+    server_domain: str
+    server_origins: FrozenSet[str]
+    remote: Optional[SplitResult] = None
+    remote_origin: Optional[str] = None
+
+    @classmethod
+    def build(cls, requested: SplitResult, client_origin, server_host, server_map):
+        return cls(
+            requested=requested,
+            client_origin=client_origin,
+            client_domain=netloc_of(client_origin) if client_origin else None,
+            server_host=server_host,
+            server_origin=server_map['origins']['main'],
+            server_domain=server_map['domains']['main'],
+            server_origins=server_map['all_origins'],
+        )
+
+    def with_remote(self, remote_url) -> 'URLContext':
+        return self._replace(remote=split_url(remote_url), remote_origin=origin_of(remote_url))